@@ -0,0 +1,145 @@
+"""
+API密钥内存索引
+按密钥哈希建立字典索引，仅在密钥文件变化时重新加载，
+last_used 更新先记录在内存中，由后台线程定期写回文件
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def hash_api_key(api_key):
+    """计算API密钥的索引哈希"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def key_file_lock(path):
+    """密钥文件的进程间互斥锁：服务写回 last_used 和 manage_api_keys.py 修改密钥时都持有它"""
+    with open(f"{path}.lock", 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_key_file(path, api_keys):
+    """原子地写入密钥文件（需持有 key_file_lock）"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(api_keys, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class ApiKeyIndex:
+    """API密钥索引：O(1) 查找，文件 mtime/inode 变化时失效"""
+
+    def __init__(self, path, check_interval=1.0, flush_interval=30.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._index = {}  # 密钥哈希 -> (名称, 密钥信息)
+        self._signature = None
+        self._next_check = 0.0
+        self._pending_lock = threading.Lock()
+        self._pending_last_used = {}
+        self._flusher = None
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _load_file(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _refresh(self):
+        """文件变化时重建索引（检查频率受 check_interval 限制）"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            signature = self._file_signature()
+            if signature != self._signature:
+                api_keys = self._load_file()
+                self._index = {hash_api_key(info['key']): (name, info)
+                               for name, info in api_keys.items() if info.get('key')}
+                self._signature = signature
+            # 索引就绪后再推迟下次检查，避免并发请求读到未加载的索引
+            self._next_check = now + self.check_interval
+
+    def lookup(self, api_key):
+        """查找API密钥，返回 (名称, 密钥信息)，不存在返回 None"""
+        if not api_key:
+            return None
+        self._refresh()
+        return self._index.get(hash_api_key(api_key))
+
+    def touch(self, name):
+        """记录密钥使用时间（延迟写回）"""
+        with self._pending_lock:
+            self._pending_last_used[name] = datetime.now().isoformat()
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name='api-key-flusher', daemon=True)
+                    self._flusher.start()
+                    atexit.register(self.flush)
+
+    def flush(self):
+        """把内存中的 last_used 写回密钥文件
+
+        在文件锁内重新读取文件，只更新仍然存在的密钥的 last_used，
+        不会覆盖 manage_api_keys.py 同时做出的修改（如删除密钥）。
+        """
+        if not self._pending_last_used:
+            return
+        with self._pending_lock:
+            pending, self._pending_last_used = self._pending_last_used, {}
+        with self._lock, key_file_lock(self.path):
+            api_keys = self._load_file()
+            for name, last_used in pending.items():
+                if name in api_keys:
+                    api_keys[name]['last_used'] = last_used
+            write_key_file(self.path, api_keys)
+            # 自身写入不需要触发重新加载
+            self._index = {hash_api_key(info['key']): (name, info)
+                           for name, info in api_keys.items() if info.get('key')}
+            self._signature = self._file_signature()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush API key usage: {e}")
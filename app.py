@@ -1,58 +1,388 @@
 import os
 import uuid
 import hashlib
+import hmac
+import secrets
 import json
 from datetime import datetime
 from PIL import Image
 import torch
-from flask import Flask, request, jsonify, render_template, send_file, abort
+from flask import Flask, request, jsonify, render_template, send_file, abort, g, Response, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 from diffusers import QwenImageEditPipeline
+from diffusers.pipelines.qwenimage.pipeline_qwenimage_edit import calculate_dimensions
 import io
 import base64
+import time
+import math
+import atexit
+import threading
+from config import Config
+from jobs import JobQueue, QueueFullError
+from inference_process import InferenceProcess
+from api_key_store import ApiKeyIndex
+from result_cache import ResultCache, make_cache_key
+from prompt_cache import PromptEmbeddingCache, concat_prompt_embeds, encode_prompt
+from image_cache import ImageCache, resize_image
+from previews import latent_previews
+from ingest import ImageRejected, open_image, decode_image
+from metrics import Registry, PipelineTimer, reset_peak_memory, peak_memory, synchronize
+from model_loader import (load_pipeline_from_snapshot, format_load_report, check_settings,
+                          profile_load_device, apply_execution_profile, compile_pipeline)
+from request_trace import TraceWriter
+from output_store import OutputStore
+from variants import VariantCache, parse_sizes
+from scheduling import KeyScheduler, QuotaExceededError
+from buckets import (ResolutionBuckets, parse_aspect_ratios, text_length_bucket, batch_sizes, warmup_shapes,
+                     OUTPUT_SIZES, TEXT_LENGTH_BUCKETS)
 
 app = Flask(__name__)
 CORS(app)
+# 上传大小在接收请求体时即受限制，超出时返回 413
+app.config['MAX_CONTENT_LENGTH'] = Config.MAX_CONTENT_LENGTH
 
 # 配置
-UPLOAD_FOLDER = 'uploads'
-OUTPUT_FOLDER = 'outputs'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
-API_KEYS_FILE = 'api_keys.json'
+UPLOAD_FOLDER = Config.UPLOAD_FOLDER
+OUTPUT_FOLDER = Config.OUTPUT_FOLDER
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+ALLOWED_IMAGE_FORMATS = {'PNG', 'JPEG', 'GIF', 'BMP', 'WEBP'}
+# 与 PIL 的解压炸弹保护保持一致
+Image.MAX_IMAGE_PIXELS = Config.MAX_IMAGE_PIXELS
+API_KEYS_FILE = Config.API_KEYS_FILE
+api_key_index = ApiKeyIndex(API_KEYS_FILE, flush_interval=Config.API_KEY_FLUSH_INTERVAL)
+# 按密钥的优先级、限额和加权公平排队
+key_scheduler = KeyScheduler(Config.DEFAULT_KEY_PRIORITY)
 print(torch.cuda.is_available())
 # 确保文件夹存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-# 初始化模型管道
-pipeline = None
+# 结果缓存
+result_cache = None
+if Config.RESULT_CACHE_ENABLED:
+    result_cache = ResultCache(
+        Config.RESULT_CACHE_FOLDER,
+        memory_bytes=Config.RESULT_CACHE_MEMORY_MB * 1024 * 1024,
+        disk_bytes=Config.RESULT_CACHE_DISK_MB * 1024 * 1024,
+    )
 
-def load_pipeline():
-    global pipeline
-    if pipeline is None:
-        print("Loading Qwen Image Edit Pipeline...")
-        pipeline = QwenImageEditPipeline.from_pretrained("Qwen/Qwen-Image-Edit")
-        pipeline.to(torch.bfloat16)
-        pipeline.to("cuda")
-        pipeline.set_progress_bar_config(disable=None)
-        print("Pipeline loaded successfully!")
-        print(next(pipeline.unet.parameters()).device)
+# 提示词嵌入缓存（可选）
+prompt_cache = None
+if Config.PROMPT_CACHE_ENABLED:
+    prompt_cache = PromptEmbeddingCache(
+        Config.PROMPT_CACHE_MB * 1024 * 1024,
+        storage_device=Config.PROMPT_CACHE_DEVICE,
+    )
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# 输入图像缓存（缩放后的图像和 VAE 潜变量）
+image_cache = ImageCache(Config.IMAGE_CACHE_MB * 1024 * 1024)
+
+# 管道把输入图像缩放到约这么多像素（宽高为 32 的倍数）
+TARGET_AREA = 1024 * 1024
+
+# 执行配置和编译组件在启动时检查，名称错误时立即退出，而不是让工作线程加载模型失败后反复重启
+check_settings(Config.EXECUTION_PROFILE, Config.TORCH_COMPILE.split(','))
+
+# 分辨率分桶（可选）：输入图像对齐到固定的几种分辨率，配合 torch.compile 按形状编译
+resolution_buckets = None
+if Config.RESOLUTION_BUCKETS:
+    resolution_buckets = ResolutionBuckets(parse_aspect_ratios(Config.RESOLUTION_BUCKETS), TARGET_AREA)
+    if Config.BUCKET_OUTPUT_SIZE not in OUTPUT_SIZES:
+        raise ValueError(f"Unknown BUCKET_OUTPUT_SIZE: {Config.BUCKET_OUTPUT_SIZE}, expected one of {', '.join(OUTPUT_SIZES)}")
+
+# 编译 Transformer 时提示词嵌入按长度桶填充（被填充的位置由掩码排除），文本长度不同不会触发重新编译；
+# 动态批处理和变体分批可能出现的每种批量大小都在预热时编译
+PAD_PROMPT_EMBEDS = 'transformer' in Config.TORCH_COMPILE.split(',')
+WARMUP_BATCH_SIZES = batch_sizes(Config.MAX_BATCH_SIZE, Config.VARIATION_BATCH_SIZE)
+
+# 请求追踪（可选）
+trace_writer = None
+if Config.TRACE_ENABLED:
+    trace_writer = TraceWriter(
+        Config.TRACE_FILE,
+        image_folder=Config.TRACE_IMAGE_FOLDER if Config.TRACE_STORE_IMAGES else None,
+    )
+
+# 输出图像格式
+OUTPUT_MIMETYPES = {'png': 'image/png', 'webp': 'image/webp', 'jpg': 'image/jpeg'}
+RESPONSE_MODES = ('inline', 'binary', 'url')
+# 编码参数也参与缓存键，修改配置后不会返回旧格式的缓存结果
+OUTPUT_ENCODING = {
+    'png': f"png-{Config.PNG_COMPRESS_LEVEL}",
+    'webp': f"webp-{Config.WEBP_QUALITY}",
+    'jpeg': f"jpeg-{Config.JPEG_QUALITY}",
+}.get(Config.OUTPUT_FORMAT, Config.OUTPUT_FORMAT)
+# 分桶配置同样影响输出结果
+RESOLUTION_MODE = (f"buckets-{resolution_buckets.describe()}-{Config.BUCKET_OUTPUT_SIZE}"
+                   if resolution_buckets is not None else None)
+
+# 影响输出结果、可公开返回的编辑参数
+EDIT_PARAMETERS = ('prompt', 'negative_prompt', 'true_cfg_scale', 'num_inference_steps', 'seed')
+# torch.Generator.manual_seed 接受的种子范围（64 位）
+MIN_SEED, MAX_SEED = -2 ** 63, 2 ** 64 - 1
+
+# 运行指标（/metrics 以 Prometheus 文本格式导出）
+metrics = Registry()
+HTTP_REQUESTS = metrics.counter('qwen_edit_http_requests_total', 'HTTP requests by endpoint and status code', ('endpoint', 'status'))
+HTTP_REQUEST_SECONDS = metrics.histogram('qwen_edit_http_request_seconds', 'HTTP request latency', ('endpoint',))
+STAGE_SECONDS = metrics.histogram('qwen_edit_stage_seconds', 'Latency of each processing stage', ('stage',))
+DENOISE_STEP_SECONDS = metrics.histogram(
+    'qwen_edit_denoise_step_seconds', 'Latency of a single denoising step (per batch)',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+BATCH_SIZE = metrics.histogram('qwen_edit_batch_size', 'Jobs per inference batch', buckets=(1, 2, 4, 8, 16, 32))
+PEAK_MEMORY_BYTES = metrics.histogram(
+    'qwen_edit_peak_memory_bytes', 'Peak GPU memory per batch, or process peak RSS on CPU', ('device',),
+    buckets=tuple(2 ** i * 1024 ** 3 for i in range(7)))
+ERRORS = metrics.counter('qwen_edit_errors_total', 'Errors by type', ('type',))
+ADMISSION_REJECTIONS = metrics.counter('qwen_edit_admission_rejections_total',
+                                       'Requests rejected because the queue was full, by limit', ('reason',))
+metrics.gauge('qwen_edit_queue_depth', 'Jobs waiting in the queue', function=lambda: len(job_queue))
+metrics.gauge('qwen_edit_queue_backlog_seconds', 'Estimated seconds of queued and running work',
+              function=lambda: job_queue.backlog())
+metrics.gauge('qwen_edit_queue_backlog_limit_seconds', 'Admission limit on the estimated backlog (0 = unlimited)',
+              function=lambda: Config.MAX_QUEUED_GPU_SECONDS)
+metrics.gauge('qwen_edit_model_ready', 'Whether at least one worker has its model loaded and warmed up',
+              function=lambda: int(model_ready()))
+metrics.gauge('qwen_edit_worker_up', 'Whether each inference worker is ready', ('worker', 'device'),
+              function=lambda: [({'worker': w['worker'], 'device': w['device']}, int(w['state'] in ('idle', 'busy')))
+                                for w in job_queue.workers()])
+metrics.gauge('qwen_edit_worker_queue_depth', 'Jobs waiting for each inference worker', ('worker', 'device'),
+              function=lambda: [({'worker': w['worker'], 'device': w['device']}, w['queued'])
+                                for w in job_queue.workers()])
+metrics.gauge('qwen_edit_worker_restarts', 'Restarts of each inference worker', ('worker', 'device'),
+              function=lambda: [({'worker': w['worker'], 'device': w['device']}, w['restarts'])
+                                for w in job_queue.workers()])
+metrics.gauge('qwen_edit_worker_seconds_per_step', 'Moving average of measured seconds per denoising step',
+              ('worker', 'device'),
+              function=lambda: [({'worker': w['worker'], 'device': w['device']}, w['seconds_per_unit'])
+                                for w in job_queue.workers() if w['seconds_per_unit'] is not None])
+metrics.gauge('qwen_edit_key_jobs', 'Queued and running jobs of each API key', ('key', 'state'),
+              function=lambda: [({'key': owner or '', 'state': state}, count)
+                                for owner, counts in job_queue.owners().items()
+                                for state, count in counts.items()])
+pipeline_timer = PipelineTimer(STAGE_SECONDS, DENOISE_STEP_SECONDS)
+
+# 输出图像存储（分目录、后台写盘、定期清理）
+output_store = OutputStore(
+    OUTPUT_FOLDER,
+    shard_levels=Config.OUTPUT_SHARD_LEVELS,
+    async_writes=Config.OUTPUT_ASYNC_WRITES,
+    max_pending=Config.OUTPUT_MAX_PENDING_WRITES,
+    max_bytes=Config.OUTPUT_MAX_MB * 1024 * 1024,
+    max_age=Config.OUTPUT_RETENTION_HOURS * 3600,
+    upload_folder=UPLOAD_FOLDER,
+    upload_max_age=Config.UPLOAD_RETENTION_HOURS * 3600,
+    stage_seconds=STAGE_SECONDS,
+)
+# 下载时按需生成的缩略图和转码版本
+variant_store = OutputStore(
+    Config.VARIANT_CACHE_FOLDER,
+    shard_levels=Config.OUTPUT_SHARD_LEVELS,
+    async_writes=Config.OUTPUT_ASYNC_WRITES,
+    max_pending=Config.OUTPUT_MAX_PENDING_WRITES,
+    max_bytes=Config.VARIANT_CACHE_MB * 1024 * 1024,
+    max_age=Config.OUTPUT_RETENTION_HOURS * 3600,
+)
+if Config.OUTPUT_GC_INTERVAL > 0:
+    output_store.start_gc(Config.OUTPUT_GC_INTERVAL)
+    variant_store.start_gc(Config.OUTPUT_GC_INTERVAL)
+metrics.gauge('qwen_edit_output_pending_writes', 'Output images waiting to be written to disk',
+              function=output_store.pending)
+metrics.gauge('qwen_edit_output_store_bytes', 'Size of the output store at the last GC scan',
+              function=lambda: output_store.stats()['bytes'])
+
+def worker_devices():
+    """推理工作线程使用的设备列表，每个设备一个工作线程"""
+    spec = Config.WORKER_DEVICES.strip()
+    if spec == 'auto':
+        count = torch.cuda.device_count()
+        return [f"cuda:{i}" for i in range(count)] if count else [Config.DEVICE]
+    if spec:
+        return [device.strip() for device in spec.split(',') if device.strip()]
+    return [Config.DEVICE]
+
+def load_pipeline(worker):
+    """在工作线程的设备上加载模型管道并预热（工作线程启动或重启时调用）"""
+    device = worker.device
+    if device.startswith('cuda'):
+        # 使显存统计和同步作用于该线程的设备
+        torch.cuda.set_device(device)
+    elif Config.CPU_THREADS_PER_WORKER > 0:
+        # 对进程全局生效，每个 CPU 工作线程各自使用这么多计算线程
+        torch.set_num_threads(Config.CPU_THREADS_PER_WORKER)
+    
+    profile = Config.EXECUTION_PROFILE
+    worker.info['phase'] = 'loading'
+    print(f"Loading Qwen Image Edit Pipeline on {device} ({profile} profile)...")
+    reset_peak_memory(device)
+    # 各组件并行加载，直接以目标精度读取并移动到目标设备（需要换入换出时先保留在内存中）
+    with STAGE_SECONDS.time(stage='model_load'):
+        loaded, load_report = load_pipeline_from_snapshot(
+            QwenImageEditPipeline,
+            Config.MODEL_NAME,
+            revision=Config.MODEL_REVISION,
+            torch_dtype=Config.TORCH_DTYPE,
+            device=profile_load_device(profile, device),
+            max_workers=Config.MODEL_LOAD_WORKERS,
+        )
+        optimizations = apply_execution_profile(loaded, profile, device)
+        if Config.TORCH_COMPILE:
+            # 每个桶、每种批量大小和每个提示词长度桶各编译一份静态形状的图
+            shapes = len(warmup_sizes()) * len(WARMUP_BATCH_SIZES) * len(TEXT_LENGTH_BUCKETS)
+            optimizations += compile_pipeline(loaded, Config.TORCH_COMPILE.split(','), Config.TORCH_COMPILE_MODE,
+                                              profile, device, max_shapes=shapes)
+    worker.info['load_report'] = load_report
+    loaded.set_progress_bar_config(disable=None)
+    image_cache.install(loaded)
+    print("Pipeline loaded successfully!")
+    print(format_load_report(load_report))
+    
+    profile_report = {'profile': profile, 'device': device, 'optimizations': optimizations}
+    if Config.WARMUP_STEPS > 0:
+        worker.info['phase'] = 'warming_up'
+        started = time.perf_counter()
+        steps = []
+        with STAGE_SECONDS.time(stage='warmup'), DENOISE_STEP_SECONDS.record(steps):
+            runs = warmup_pipeline(loaded)
+        elapsed = time.perf_counter() - started
+        if steps:
+            # 最后一次运行不再包含首次运行（或编译）的开销，以其去噪步的平均耗时作为每步耗时的估计
+            seconds_per_step = sum(seconds for _, seconds in steps) / len(steps)
+        else:
+            # 只预热一步时无法单独测出去噪步的耗时，使用整次运行的耗时（含编码和解码，偏保守）
+            seconds_per_step = runs[-1][2] / Config.WARMUP_STEPS
+        profile_report.update(warmup_steps=Config.WARMUP_STEPS, warmup_seconds=round(elapsed, 3),
+                              warmup_seconds_per_step=round(seconds_per_step, 3))
+        if len(runs) > 1:
+            profile_report['warmup_runs'] = [
+                {'size': f"{width}x{height}", 'batch_size': batch_size, 'seconds': round(seconds, 3)}
+                for (width, height), batch_size, seconds in runs]
+        if worker.seconds_per_unit is None:
+            # 首个任务完成前，准入控制以预热的每步耗时估计任务耗时
+            worker.seconds_per_unit = seconds_per_step
+    peak = peak_memory(device)
+    if peak is not None:
+        profile_report['peak_memory_bytes'] = peak[1]
+    worker.info['profile_report'] = profile_report
+    print(f"Execution profile: {json.dumps(profile_report)}")
+    # 预热之后再安装计时，首次运行的开销不计入各阶段耗时
+    pipeline_timer.install(loaded)
+    worker.context['pipeline'] = loaded
+    worker.info.update(phase='ready', ready_at=time.time())
+
+def warmup_sizes():
+    """预热使用的输入图像尺寸：启用分桶时每个桶一张（宽高比与桶完全一致），否则一张方形图像"""
+    if resolution_buckets is None:
+        # 管道总是把输入缩放到约 1024x1024 像素，方形图像即对应最常见的目标分辨率
+        return [(1024, 1024)]
+    return resolution_buckets.sample_sizes()
+
+def warmup_prompt_inputs(pipe, image, batch_size):
+    """预热使用的提示词嵌入：与请求一样按长度桶填充，预热编译的正是请求会用到的形状"""
+    width, height = target_resolution(image)
+    prompt_image = pipe.image_processor.resize(image, height, width)
+    inputs = {}
+    for name, prompt in (('prompt', 'warmup'), ('negative_prompt', ' ')):
+        entry = encode_prompt(pipe, prompt, prompt_image)
+        inputs[f"{name}_embeds"], inputs[f"{name}_embeds_mask"] = concat_prompt_embeds(
+            [entry] * batch_size, bucket_length=text_length_bucket)
+    return inputs
+
+def warmup_pipeline(pipe):
+    """用空白图像执行短推理，提前完成首次运行的内核选择、显存分配和各形状的编译
+
+    返回每次运行的 (目标分辨率, 批量大小, 耗时秒数)；启用 torch.compile 时每个桶的每种批量大小各运行一次，
+    最后再运行一次已编译的形状，其耗时即为稳定状态下的耗时。最后一次运行的去噪步耗时（第二步起）
+    记录到 DENOISE_STEP_SECONDS。
+    """
+    shapes = warmup_shapes(warmup_sizes(), WARMUP_BATCH_SIZES, bool(Config.TORCH_COMPILE))
+    print(f"Warming up pipeline ({Config.WARMUP_STEPS} steps, {len(shapes)} runs)...")
+    runs = []
+    for i, (size, batch_size) in enumerate(shapes):
+        image = Image.new('RGB', size)
+        inputs = {'image': [image] * batch_size if batch_size > 1 else image}
+        started = time.perf_counter()
+        with torch.inference_mode():
+            if PAD_PROMPT_EMBEDS:
+                inputs.update(warmup_prompt_inputs(pipe, image, batch_size))
+            else:
+                inputs.update(prompt='warmup', negative_prompt=' ')
+            pipe(
+                **inputs,
+                true_cfg_scale=4.0,
+                num_inference_steps=Config.WARMUP_STEPS,
+                generator=torch.Generator().manual_seed(0),
+                callback_on_step_end=warmup_step_timer() if i == len(shapes) - 1 else None,
+            )
+        runs.append((target_resolution(image), batch_size, time.perf_counter() - started))
+        print(f"Warmup at {runs[-1][0][0]}x{runs[-1][0][1]} x{batch_size}: {runs[-1][2]:.2f}s")
+    print("Warmup finished!")
+    return runs
 
-def load_api_keys():
-    """加载API密钥"""
-    if os.path.exists(API_KEYS_FILE):
-        with open(API_KEYS_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+def warmup_step_timer():
+    """预热的步进回调：相邻两步结束之间的耗时即一个去噪步的耗时（不含文本编码、VAE 编码和解码）"""
+    last = None
+    
+    def callback(pipe, step, timestep, callback_kwargs):
+        nonlocal last
+        synchronize()
+        now = time.perf_counter()
+        if last is not None:
+            DENOISE_STEP_SECONDS.observe(now - last)
+        last = now
+        return {}
+    
+    return callback
 
-def save_api_keys(api_keys):
-    """保存API密钥"""
-    with open(API_KEYS_FILE, 'w') as f:
-        json.dump(api_keys, f, indent=2)
+# 服务模式下每个推理工作线程的推理进程：工作线程序号 -> InferenceProcess
+inference_processes = {}
+inference_processes_lock = threading.Lock()
+
+def start_worker(worker):
+    """工作线程启动（或重启）时调用：服务模式下启动该设备的推理进程，否则在本线程中加载模型"""
+    if not Config.INFERENCE_PROCESS:
+        load_pipeline(worker)
+        return
+    process = InferenceProcess(worker.device, {'STAGE_SECONDS': STAGE_SECONDS,
+                                               'DENOISE_STEP_SECONDS': DENOISE_STEP_SECONDS},
+                               setup=Config.INFERENCE_SETUP)
+    with inference_processes_lock:
+        previous = inference_processes.pop(worker.index, None)
+        inference_processes[worker.index] = process
+    if previous is not None:
+        # 重启前结束旧进程，同一设备上的模型不会同时存在两份
+        previous.stop(timeout=0)
+    worker.info['phase'] = 'loading'
+    print(f"Starting inference process on {worker.device}...")
+    info, seconds_per_unit = process.start()
+    worker.info.update(info, inference_pid=process.pid)
+    if worker.seconds_per_unit is None:
+        worker.seconds_per_unit = seconds_per_unit
+    worker.context['pipeline'] = process
+
+def stop_inference_processes(timeout=30.0):
+    """通知各推理进程在当前推理完成后退出（服务关闭时调用）"""
+    with inference_processes_lock:
+        processes = list(inference_processes.values())
+        inference_processes.clear()
+    for process in processes:
+        process.stop(timeout)
+
+# 前端进程退出时确保推理进程随之退出
+atexit.register(stop_inference_processes)
+
+def start_model_loader():
+    """启动推理工作线程，各线程在后台加载并预热自己设备上的模型，不阻塞服务启动"""
+    job_queue.start()
+
+def model_ready():
+    """是否至少有一个工作线程已加载并预热模型"""
+    return any(worker['state'] in ('idle', 'busy') for worker in job_queue.workers())
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def generate_api_key():
     """生成新的API密钥"""
@@ -60,19 +390,21 @@ def generate_api_key():
 
 def validate_api_key(api_key):
     """验证API密钥"""
-    api_keys = load_api_keys()
-    print(api_keys.values())
-    for key in api_keys.values():
-        if api_key == key['key']:
-            return True
-    return False
+    entry = api_key_index.lookup(api_key)
+    if entry is None:
+        return False
+    name, info = entry
+    g.api_key_name = name
+    g.api_key_info = info
+    api_key_index.touch(name)
+    return True
 
 def require_api_key(f):
     """装饰器：要求API密钥"""
     def decorated_function(*args, **kwargs):
         api_key = request.headers.get('X-API-Key')
         if not api_key or not validate_api_key(api_key):
-            return jsonify({'error': 'Invalid or missing API key'}), 401
+            return request_error('Invalid or missing API key', 401, 'unauthorized')
         return f(*args, **kwargs)
     decorated_function.__name__ = f.__name__
     return decorated_function
@@ -82,163 +414,1087 @@ def index():
     """主页面"""
     return render_template('index.html')
 
-@app.route('/api/edit-image', methods=['POST'])
-@require_api_key
-def api_edit_image():
-    """API端点：编辑图像"""
+def parse_upload():
+    """解析 multipart 请求体并读取上传的图像，返回 (文件, 图像数据)
+
+    每个请求只解析一次，耗时计入 parse 阶段。
+    """
+    if 'upload' not in g:
+        with STAGE_SECONDS.time(stage='parse'):
+            file = request.files.get('image')
+            g.upload = (file, file.read() if file is not None else None)
+    return g.upload
+
+def request_error(message, status_code, error_type):
+    """记录错误类型并构造 JSON 错误响应"""
+    ERRORS.inc(type=error_type)
+    trace_request(error=error_type)
+    return jsonify({'error': message}), status_code
+
+def retry_later(message, error_type, retry_after, status_code=429):
+    """构造 429（或指定状态码的）错误响应，Retry-After 为建议的重试等待秒数"""
+    response, status_code = request_error(message, status_code, error_type)
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response, status_code
+
+def quota_error(e):
+    """密钥超出限额：Retry-After 为令牌补足或队列排空的预计时间"""
+    retry_after = e.retry_after if e.retry_after is not None else job_queue.estimated_wait()
+    return retry_later(str(e), e.reason, retry_after)
+
+def queue_full_error(e):
+    """队列已满（排队任务数或预计耗时超出上限）：Retry-After 为队列腾出空间的预计时间"""
+    ADMISSION_REJECTIONS.inc(reason=e.reason)
+    return retry_later(str(e), 'queue_full', e.retry_after or 1)
+
+def check_key_quota():
+    """扣除当前密钥的一次请求（超出每分钟请求数时抛出 QuotaExceededError）"""
+    key_scheduler.check_request(g.api_key_name, g.api_key_info)
+
+def begin_trace():
+    """开始记录当前请求的追踪信息，返回收集阶段耗时的字典（未启用追踪时返回 None）"""
+    if trace_writer is None:
+        return None
+    g.trace = {'ts': round(time.time(), 3), 'endpoint': request.endpoint, 'stages': {}}
+    return g.trace['stages']
+
+def trace_request(**fields):
+    """向当前请求的追踪记录添加字段（未启用追踪时忽略）"""
+    trace = g.get('trace')
+    if trace is not None:
+        trace.update(fields)
+
+def trace_job(job, trace=None):
+    """把任务在推理工作线程中的各阶段耗时并入追踪记录（默认为当前请求的记录）"""
+    if trace is None:
+        trace = g.get('trace')
+    if trace is None:
+        return
+    for stage, seconds in job.timings.items():
+        trace['stages'][stage] = trace['stages'].get(stage, 0.0) + seconds
+    trace.update(worker=job.worker, batch_size=job.batch_size)
+
+def trace_job_later(job):
+    """异步任务：响应时任务尚未完成，等任务完成后再并入其耗时并写入追踪记录"""
+    if 'trace' in g:
+        g.traced_job = job
+
+def write_trace(trace):
+    trace['stages'] = {stage: round(seconds, 4) for stage, seconds in trace['stages'].items()}
+    trace_writer.write(trace)
+
+def write_job_trace(trace, job):
+    trace_job(job, trace)
+    trace.update(job_status=job.status, job_latency=round(job.finished_at - trace['ts'], 4))
+    write_trace(trace)
+
+def parse_image_upload():
+    """检查请求中的图像文件，返回 (图像数据, 错误响应)"""
+    file, image_bytes = parse_upload()
+    if file is None:
+        return None, request_error('No image file provided', 400, 'invalid_request')
+    
+    if file.filename == '':
+        return None, request_error('No image file selected', 400, 'invalid_request')
+    
+    if not allowed_file(file.filename):
+        return None, request_error('Invalid file type', 400, 'invalid_request')
+    return image_bytes, None
+
+def parse_shared_params():
+    """各编辑请求共用的参数（不含提示词和种子），返回 (参数, 错误响应)
+
+    推理步数和 CFG Scale 超出允许范围时返回 400：按步数估计的耗时用于准入控制和限额。
+    """
     try:
-        # 检查是否有文件上传
-        if 'image' not in request.files:
-            return jsonify({'error': 'No image file provided'}), 400
-        
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({'error': 'No image file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file type'}), 400
-        
-        # 获取参数
-        prompt = request.form.get('prompt', '')
-        if not prompt:
-            return jsonify({'error': 'Prompt is required'}), 400
-        
-        negative_prompt = request.form.get('negative_prompt', ' ')
-        true_cfg_scale = float(request.form.get('true_cfg_scale', 4.0))
-        num_inference_steps = int(request.form.get('num_inference_steps', 50))
-        seed = int(request.form.get('seed', 0))
-        
-        # 加载模型
-        load_pipeline()
-        
-        # 处理图像
-        image = Image.open(file.stream).convert("RGB")
-        
-        # 设置输入参数
-        inputs = {
-            "image": image,
-            "prompt": prompt,
-            "generator": torch.manual_seed(seed),
-            "true_cfg_scale": true_cfg_scale,
-            "negative_prompt": negative_prompt,
-            "num_inference_steps": num_inference_steps,
+        params = {
+            'negative_prompt': request.form.get('negative_prompt', ' '),
+            'true_cfg_scale': float(request.form.get('true_cfg_scale', 4.0)),
+            'num_inference_steps': int(request.form.get('num_inference_steps', 50)),
+            # 每隔多少步生成一次进度预览，0 表示不生成
+            'preview_interval': int(request.form.get('preview_interval', Config.PREVIEW_INTERVAL)),
         }
-        
-        # 生成图像
-        with torch.inference_mode():
-            output = pipeline(**inputs)
-            output_image = output.images[0]
-        
-        # 保存输出图像
-        output_filename = f"output_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.png"
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        output_image.save(output_path)
-        
-        # 将图像转换为base64返回
-        img_buffer = io.BytesIO()
-        output_image.save(img_buffer, format='PNG')
-        img_str = base64.b64encode(img_buffer.getvalue()).decode()
-        
-        return jsonify({
-            'success': True,
-            'output_image': f"data:image/png;base64,{img_str}",
-            'output_path': output_path,
-            'parameters': {
-                'prompt': prompt,
-                'negative_prompt': negative_prompt,
-                'true_cfg_scale': true_cfg_scale,
-                'num_inference_steps': num_inference_steps,
-                'seed': seed
-            }
-        })
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    except ValueError as e:
+        return None, request_error(f"Invalid parameter: {e}", 400, 'invalid_request')
+    if not Config.MIN_INFERENCE_STEPS <= params['num_inference_steps'] <= Config.MAX_INFERENCE_STEPS:
+        return None, request_error(
+            f"num_inference_steps must be between {Config.MIN_INFERENCE_STEPS} and {Config.MAX_INFERENCE_STEPS}",
+            400, 'invalid_request')
+    if not Config.MIN_CFG_SCALE <= params['true_cfg_scale'] <= Config.MAX_CFG_SCALE:
+        return None, request_error(
+            f"true_cfg_scale must be between {Config.MIN_CFG_SCALE} and {Config.MAX_CFG_SCALE}",
+            400, 'invalid_request')
+    if params['preview_interval'] < 0:
+        return None, request_error('preview_interval must not be negative', 400, 'invalid_request')
+    return params, None
 
-@app.route('/edit-image', methods=['POST'])
-def web_edit_image():
-    """Web端点：编辑图像（用于前端表单）"""
+def inspect_input_image(params, image_bytes):
+    """只读取文件头检查格式和尺寸并设置 params 的 image_hash，返回 (未解码的图像, 错误响应)"""
     try:
-        # 检查API密钥
-        api_key = request.form.get('api_key')
-        if not api_key or not validate_api_key(api_key):
-            return jsonify({'error': 'Invalid or missing API key'}), 401
-        
-        # 检查是否有文件上传
-        if 'image' not in request.files:
-            return jsonify({'error': 'No image file provided'}), 400
-        
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({'error': 'No image file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file type'}), 400
-        
-        # 获取参数
-        prompt = request.form.get('prompt', '')
-        if not prompt:
-            return jsonify({'error': 'Prompt is required'}), 400
-        
-        negative_prompt = request.form.get('negative_prompt', ' ')
-        true_cfg_scale = float(request.form.get('true_cfg_scale', 4.0))
-        num_inference_steps = int(request.form.get('num_inference_steps', 50))
-        seed = int(request.form.get('seed', 0))
-        
-        # 加载模型
-        load_pipeline()
-        
-        # 处理图像
-        image = Image.open(file.stream).convert("RGB")
-        
-        # 设置输入参数
-        inputs = {
-            "image": image,
-            "prompt": prompt,
-            "generator": torch.manual_seed(seed),
-            "true_cfg_scale": true_cfg_scale,
-            "negative_prompt": negative_prompt,
-            "num_inference_steps": num_inference_steps,
+        image = open_image(image_bytes, ALLOWED_IMAGE_FORMATS, Config.MAX_IMAGE_PIXELS, Config.MAX_IMAGE_SIDE)
+    except ImageRejected as e:
+        trace_request(input={'bytes': len(image_bytes)})
+        return None, request_error(str(e), e.status_code, 'image_rejected')
+    
+    params['image_hash'] = hashlib.sha256(image_bytes).hexdigest()
+    original_size = request.form.get('original_size')
+    if original_size:
+        try:
+            params['original_size'] = parse_original_size(original_size)
+        except ValueError as e:
+            return None, request_error(str(e), 400, 'invalid_request')
+    if 'trace' in g:
+        traced_input = {
+            'format': image.format,
+            'width': image.width,
+            'height': image.height,
+            'bytes': len(image_bytes),
+            'sha256': params['image_hash'],
+            'file': trace_writer.store_image(params['image_hash'], image.format, image_bytes),
+        }
+        if original_size:
+            # 客户端缩小过的图像：重放时一并发送原图尺寸，目标分辨率和输出尺寸才与原请求一致
+            traced_input['original_size'] = original_size
+        trace_request(input=traced_input)
+    return image, None
+
+def parse_seed(value):
+    """解析种子，不是整数或超出 64 位范围时抛出 ValueError"""
+    seed = int(value)
+    if not MIN_SEED <= seed <= MAX_SEED:
+        raise ValueError(f"seed must be between {MIN_SEED} and {MAX_SEED}")
+    return seed
+
+def parse_original_size(spec):
+    """解析客户端声明的原图尺寸（'宽x高'），不合法时抛出 ValueError"""
+    width, _, height = spec.lower().partition('x')
+    try:
+        size = (int(width), int(height))
+    except ValueError:
+        raise ValueError('original_size must be formatted as WIDTHxHEIGHT')
+    if min(size) <= 0 or max(size) > Config.MAX_IMAGE_SIDE or size[0] * size[1] > Config.MAX_IMAGE_PIXELS:
+        raise ValueError(f"Invalid original_size {spec}")
+    return size
+
+def decode_input_image(params, image):
+    """在请求线程中解码和缩放图像（同一图像命中缓存时跳过），设置 params 的 image
+
+    客户端已把图像缩小到目标分辨率时，按其声明的原图尺寸（original_size）计算目标分辨率和还原输出，
+    结果与上传原图时一致。
+    """
+    source_size = params.get('original_size', image.size)
+    target_size = target_resolution(source_size)
+    pipeline_size = source_size
+    if resolution_buckets is not None:
+        # 管道按图像尺寸的宽高比计算目标分辨率：传入桶的宽高比，使其正好等于桶的分辨率；
+        # 原始尺寸用于按 BUCKET_OUTPUT_SIZE 还原输出
+        pipeline_size = resolution_buckets.nearest(*source_size)[0]
+        params['input_size'] = source_size
+    
+    def decode():
+        with STAGE_SECONDS.time(stage='decode'):
+            return decode_image(image, target_size, draft=Config.JPEG_DRAFT_DECODE)
+    
+    params['image'] = image_cache.prepare(params['image_hash'], pipeline_size, target_size, decode)
+
+def admission_error(params, cache_keys):
+    """解码图像前按预计 GPU 秒数检查队列能否接受请求，不能时返回 429 错误响应
+
+    结果均已缓存，或相同任务正在执行（单个结果）时不占用队列，不做检查。
+    """
+    if result_cache is not None and all(key in result_cache for key in cache_keys):
+        return None
+    try:
+        job_queue.check_admission(params, dedupe_key=cache_keys[0] if len(cache_keys) == 1 else None)
+    except QueueFullError as e:
+        return queue_full_error(e)
+    return None
+
+def edit_cache_key(image_hash, params):
+    """单次编辑结果的缓存键"""
+    key_params = {key: params[key] for key in EDIT_PARAMETERS}
+    key_params['output_encoding'] = OUTPUT_ENCODING
+    if RESOLUTION_MODE is not None:
+        key_params['resolution'] = RESOLUTION_MODE
+    if 'original_size' in params:
+        key_params['original_size'] = list(params['original_size'])
+    return make_cache_key(image_hash, key_params)
+
+def parse_edit_request():
+    """解析图像编辑请求，返回 (任务参数, 错误响应)"""
+    image_bytes, error = parse_image_upload()
+    if error:
+        return None, error
+    
+    # 获取参数
+    prompt = request.form.get('prompt', '')
+    if not prompt:
+        return None, request_error('Prompt is required', 400, 'invalid_request')
+    
+    params, error = parse_shared_params()
+    if error:
+        return None, error
+    try:
+        seed = parse_seed(request.form.get('seed', 0))
+    except ValueError as e:
+        return None, request_error(f"Invalid parameter: {e}", 400, 'invalid_request')
+    params.update(prompt=prompt, seed=seed)
+    trace_request(params={key: params[key] for key in EDIT_PARAMETERS + ('preview_interval',)})
+    
+    image, error = inspect_input_image(params, image_bytes)
+    if error:
+        return None, error
+    params['cache_key'] = edit_cache_key(params['image_hash'], params)
+    error = admission_error(params, [params['cache_key']])
+    if error:
+        return None, error
+    decode_input_image(params, image)
+    return params, None
+
+def parse_variation_request():
+    """解析变体请求：一张图像配合多个提示词和/或种子
+
+    返回 (共用参数, 变体列表, 错误响应)，每个变体为提示词和种子的一种组合。
+    """
+    image_bytes, error = parse_image_upload()
+    if error:
+        return None, None, error
+    
+    # 提示词可重复提交多个，相同的只保留一个
+    prompts = list(dict.fromkeys(p for p in request.form.getlist('prompt') if p))
+    if not prompts:
+        return None, None, request_error('Prompt is required', 400, 'invalid_request')
+    
+    # seeds 为逗号分隔的种子列表；否则从 seed 开始取 num_variations 个连续种子
+    try:
+        if request.form.get('seeds'):
+            seeds = list(dict.fromkeys(parse_seed(seed) for seed in request.form['seeds'].split(',') if seed.strip()))
+            count = len(seeds)
+        else:
+            seeds = None
+            base_seed = parse_seed(request.form.get('seed', 0))
+            count = int(request.form.get('num_variations', 1 if len(prompts) > 1 else 4))
+            if count > 0:
+                parse_seed(base_seed + count - 1)
+    except ValueError as e:
+        return None, None, request_error(f"Invalid parameter: {e}", 400, 'invalid_request')
+    if count < 1:
+        return None, None, request_error('At least one seed is required', 400, 'invalid_request')
+    # 在生成种子列表之前检查数量
+    if len(prompts) * count > Config.MAX_VARIATIONS:
+        return None, None, request_error(
+            f"Too many variations ({len(prompts)} prompts x {count} seeds), "
+            f"the limit is {Config.MAX_VARIATIONS}", 400, 'invalid_request')
+    if seeds is None:
+        seeds = list(range(base_seed, base_seed + count))
+    
+    params, error = parse_shared_params()
+    if error:
+        return None, None, error
+    trace_request(params=dict(params, prompt=prompts, seeds=','.join(str(seed) for seed in seeds)))
+    image, error = inspect_input_image(params, image_bytes)
+    if error:
+        return None, None, error
+    variations = []
+    for prompt in prompts:
+        for seed in seeds:
+            variation = {'prompt': prompt, 'seed': seed}
+            variation['cache_key'] = edit_cache_key(params['image_hash'], dict(params, **variation))
+            variations.append(variation)
+    error = admission_error(dict(params, variations=variations), [v['cache_key'] for v in variations])
+    if error:
+        return None, None, error
+    decode_input_image(params, image)
+    return params, variations, None
+
+def target_resolution(image):
+    """模型实际使用的分辨率（与管道内部计算一致；启用分桶时为宽高比最接近的桶）
+
+    image 为图像或 (宽, 高)。
+    """
+    width, height = image if isinstance(image, tuple) else image.size
+    if resolution_buckets is not None:
+        return resolution_buckets.nearest(width, height)[1]
+    target_width, target_height, _ = calculate_dimensions(TARGET_AREA, width / height)
+    return target_width, target_height
+
+def batch_key(params):
+    """可合并为一批的任务：推理步数、CFG Scale 和输入分辨率一致（变体任务自行分批，不与其他任务合并）"""
+    if 'variations' in params:
+        return None
+    return (params['num_inference_steps'], params['true_cfg_scale'], target_resolution(params['image']))
+
+def encode_output_image(output_image, output_format=None):
+    """按配置的格式（或指定的格式）和压缩参数编码输出图像（每个结果只编码一次）"""
+    output_format = output_format or Config.OUTPUT_FORMAT
+    img_buffer = io.BytesIO()
+    if output_format == 'webp':
+        output_image.save(img_buffer, format='WEBP', quality=Config.WEBP_QUALITY)
+    elif output_format == 'jpeg':
+        output_image.save(img_buffer, format='JPEG', quality=Config.JPEG_QUALITY)
+    else:
+        output_image.save(img_buffer, format='PNG', compress_level=Config.PNG_COMPRESS_LEVEL)
+    return img_buffer.getvalue()
+
+variants = VariantCache(variant_store, parse_sizes(Config.DOWNLOAD_VARIANT_SIZES), encode_output_image)
+
+def output_mimetype(filename):
+    """根据输出文件扩展名返回 MIME 类型"""
+    return OUTPUT_MIMETYPES.get(filename.rsplit('.', 1)[-1].lower(), 'application/octet-stream')
+
+def save_output_image(output_image):
+    """编码并保存输出图像，返回 (结果信息, 编码后的数据)"""
+    with STAGE_SECONDS.time(stage='encode'):
+        data = encode_output_image(output_image)
+    
+    extension = 'jpg' if Config.OUTPUT_FORMAT == 'jpeg' else Config.OUTPUT_FORMAT
+    output_filename = f"output_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.{extension}"
+    # 异步写入时只计入交给后台线程的耗时，实际写盘耗时记为 write 阶段
+    with STAGE_SECONDS.time(stage='save'):
+        output_path = output_store.put(output_filename, data)
+    return {
+        'output_filename': output_filename,
+        'output_path': output_path,
+    }, data
+
+def encoded_prompt_inputs(pipe, items, images, true_cfg_scale, memo):
+    """一批推理的提示词嵌入：相同的 (图像, 提示词) 只编码一次，启用提示词嵌入缓存时跨请求复用
+
+    memo 保存本次已编码的结果，可在同一任务的多次推理之间共享。
+    """
+    def encode(prompt, image, image_hash):
+        key = (image_hash, image.size, prompt)
+        if key not in memo:
+            if prompt_cache is not None:
+                memo[key] = prompt_cache.get_or_encode(pipe, prompt, image, image_hash)
+            else:
+                memo[key] = encode_prompt(pipe, prompt, image)
+        return memo[key]
+    
+    entries = [encode(item['prompt'], image, item['image_hash']) for item, image in zip(items, images)]
+    bucket_length = text_length_bucket if PAD_PROMPT_EMBEDS else None
+    prompt_embeds, prompt_embeds_mask = concat_prompt_embeds(entries, bucket_length)
+    inputs = {
+        "prompt_embeds": prompt_embeds,
+        "prompt_embeds_mask": prompt_embeds_mask,
+    }
+    # 与管道一致：仅在 CFG Scale > 1 时使用负面提示词
+    if true_cfg_scale > 1:
+        entries = [encode(item['negative_prompt'], image, item['image_hash']) for item, image in zip(items, images)]
+        inputs["negative_prompt_embeds"], inputs["negative_prompt_embeds_mask"] = concat_prompt_embeds(entries, bucket_length)
+    return inputs
+
+def make_progress_callback(jobs, width, height, extra=None):
+    """构建管道的步进回调：更新每个任务的进度（附加 extra 中的字段），并按需生成预览"""
+    total_steps = jobs[0].params['num_inference_steps']
+    started = time.time()
+    
+    def callback(pipe, step, timestep, callback_kwargs):
+        pipeline_timer.step()
+        done_steps = step + 1
+        elapsed = time.time() - started
+        progress = {
+            'step': done_steps,
+            'total_steps': total_steps,
+            'elapsed': round(elapsed, 3),
+            'eta': round(elapsed / done_steps * (total_steps - done_steps), 3),
         }
-        
-        # 生成图像
+        if extra:
+            progress.update(extra)
+        wants_preview = [
+            job.params['preview_interval'] > 0 and done_steps % job.params['preview_interval'] == 0
+            and done_steps < total_steps
+            for job in jobs
+        ]
+        previews = None
+        if any(wants_preview):
+            previews = latent_previews(pipe, callback_kwargs['latents'], height, width)
+        for i, job in enumerate(jobs):
+            job.update_progress(progress, previews[i] if wants_preview[i] else None)
+        return {}
+    
+    return callback
+
+def run_edit_batch(jobs, worker):
+    """推理工作线程：执行一批图像编辑（同一批任务的步数、CFG和分辨率一致）
+
+    批次内各阶段的耗时同时累加到每个任务的 timings 中。
+    """
+    started = time.time()
+    for job in jobs:
+        job.timings['queue_wait'] = started - job.created_at
+        STAGE_SECONDS.observe(job.timings['queue_wait'], stage='queue_wait')
+    try:
+        with STAGE_SECONDS.collect(*[job.timings for job in jobs]):
+            return execute_edit_batch(jobs, worker)
+    except Exception as e:
+        ERRORS.inc(type=type(e).__name__)
+        raise
+
+def run_pipeline(pipe, items, true_cfg_scale, num_inference_steps, callback, prompt_memo=None):
+    """执行一次（批量）推理，返回输出图像列表
+
+    items 中每项为一张输出图像的 prompt、negative_prompt、seed、image 和 image_hash。
+    """
+    # 设置输入参数（每张图像使用独立的随机数生成器）
+    images = [item['image'] for item in items]
+    generators = [torch.Generator().manual_seed(item['seed']) for item in items]
+    inputs = {
+        "image": images if len(images) > 1 else images[0],
+        "generator": generators if len(generators) > 1 else generators[0],
+        "true_cfg_scale": true_cfg_scale,
+        "num_inference_steps": num_inference_steps,
+        "callback_on_step_end": callback,
+    }
+    # 有缓存、需要跨推理复用、需要按长度桶填充或同一批中有重复的提示词时预先编码，否则交给管道批量编码
+    repeated = len({(item['image_hash'], item['image'].resized.size, item['prompt']) for item in items}) < len(items)
+    if prompt_cache is not None or prompt_memo is not None or PAD_PROMPT_EMBEDS or repeated:
         with torch.inference_mode():
-            output = pipeline(**inputs)
-            output_image = output.images[0]
-        
-        # 保存输出图像
-        output_filename = f"output_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.png"
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        output_image.save(output_path)
-        
-        # 将图像转换为base64返回
-        img_buffer = io.BytesIO()
-        output_image.save(img_buffer, format='PNG')
-        img_str = base64.b64encode(img_buffer.getvalue()).decode()
-        
+            inputs.update(encoded_prompt_inputs(pipe, items, [image.resized for image in images], true_cfg_scale,
+                                                prompt_memo if prompt_memo is not None else {}))
+    else:
+        inputs["prompt"] = [item['prompt'] for item in items]
+        inputs["negative_prompt"] = [item['negative_prompt'] for item in items]
+    
+    # 生成图像
+    with torch.inference_mode(), image_cache.activate(images):
+        return pipe(**inputs).images
+
+def restore_output_size(output_image, params):
+    """启用分桶时按 BUCKET_OUTPUT_SIZE 把输出图像缩放回原图宽高比的目标分辨率或原始尺寸"""
+    input_size = params.get('input_size')
+    if input_size is None or Config.BUCKET_OUTPUT_SIZE == 'bucket':
+        return output_image
+    if Config.BUCKET_OUTPUT_SIZE == 'original':
+        size = input_size
+    else:
+        size = calculate_dimensions(TARGET_AREA, input_size[0] / input_size[1])[:2]
+    with STAGE_SECONDS.time(stage='restore'):
+        return resize_image(output_image, *size)
+
+def save_result(cache_key, output_image):
+    """保存输出图像并写入结果缓存，返回结果信息"""
+    result, data = save_output_image(output_image)
+    if result_cache is not None:
+        result_cache.put(cache_key, data, result)
+    return dict(result, cache_hit=False)
+
+def generate(worker, jobs, items, true_cfg_scale, num_inference_steps, extra=None, prompt_memo=None):
+    """在工作线程的模型上执行一次（批量）推理，返回输出图像列表，进度（附加 extra 中的字段）更新到 jobs
+
+    服务模式下由推理进程执行，进度、预览和各阶段耗时同样回到本进程。
+    """
+    pipe = worker.context['pipeline']
+    size = target_resolution(items[0]['image'])
+    if isinstance(pipe, InferenceProcess):
+        return pipe.generate(jobs, items, true_cfg_scale, num_inference_steps, size, extra, prompt_memo)
+    return run_pipeline(pipe, items, true_cfg_scale, num_inference_steps,
+                        make_progress_callback(jobs, *size, extra), prompt_memo)
+
+def reset_worker_peak_memory(worker):
+    """重置工作线程所用设备（或推理进程中）的显存峰值统计"""
+    pipe = worker.context['pipeline']
+    if isinstance(pipe, InferenceProcess):
+        pipe.reset_peak_memory()
+    else:
+        reset_peak_memory(worker.device)
+
+def observe_peak_memory(worker):
+    """记录本次推理的显存（或内存）峰值"""
+    pipe = worker.context['pipeline']
+    peak = pipe.last_peak if isinstance(pipe, InferenceProcess) else peak_memory(worker.device)
+    if peak is not None:
+        PEAK_MEMORY_BYTES.observe(peak[1], device=peak[0])
+
+def execute_edit_batch(jobs, worker):
+    """在工作线程的设备上执行一批图像编辑，返回每个任务的结果"""
+    if 'variations' in jobs[0].params:
+        return [execute_variations(jobs[0], worker)]
+    
+    params_list = [job.params for job in jobs]
+    first = params_list[0]
+    BATCH_SIZE.observe(len(jobs))
+    
+    reset_worker_peak_memory(worker)
+    output_images = generate(worker, jobs, params_list, first['true_cfg_scale'], first['num_inference_steps'])
+    observe_peak_memory(worker)
+    
+    # 保存输出图像、写入缓存并释放输入图像
+    results = []
+    for params, output_image in zip(params_list, output_images):
+        params.pop('image', None)
+        results.append(save_result(params['cache_key'], restore_output_size(output_image, params)))
+    return results
+
+def execute_variations(job, worker):
+    """执行一组变体：输入图像只做一次 VAE 编码，每个不同的提示词只编码一次，
+    按 VARIATION_BATCH_SIZE 分批去噪，返回 {'variations': 每个变体的结果}
+    """
+    params = job.params
+    variations = params['variations']
+    reset_worker_peak_memory(worker)
+    
+    prompt_memo = {}
+    results = []
+    chunk_size = max(1, Config.VARIATION_BATCH_SIZE)
+    for start in range(0, len(variations), chunk_size):
+        chunk = variations[start:start + chunk_size]
+        items = [dict(variation, negative_prompt=params['negative_prompt'], image=params['image'],
+                      image_hash=params['image_hash']) for variation in chunk]
+        BATCH_SIZE.observe(len(items))
+        output_images = generate(worker, [job], items, params['true_cfg_scale'], params['num_inference_steps'],
+                                 extra={'variations_done': start, 'variations_total': len(variations)},
+                                 prompt_memo=prompt_memo)
+        for variation, output_image in zip(chunk, output_images):
+            results.append(save_result(variation['cache_key'], restore_output_size(output_image, params)))
+    observe_peak_memory(worker)
+    params.pop('image', None)
+    return {'variations': results}
+
+# 表示设备已不可用（CUDA 上下文损坏）的错误信息；显存不足等错误只使当前批次失败
+FATAL_DEVICE_ERRORS = ('CUDA error', 'CUBLAS_STATUS', 'CUDNN_STATUS', 'cuDNN error')
+
+def is_fatal_error(error):
+    """推理错误是否使工作线程的设备不可用，需要重启并重新加载模型"""
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return False
+    return any(marker in str(error) for marker in FATAL_DEVICE_ERRORS)
+
+job_queue = JobQueue(
+    run_edit_batch,
+    max_size=Config.MAX_QUEUED_JOBS,
+    retention=Config.JOB_RETENTION_SECONDS,
+    batch_key=batch_key,
+    max_batch_size=Config.MAX_BATCH_SIZE,
+    batch_window=Config.BATCH_WINDOW_MS / 1000.0,
+    devices=worker_devices(),
+    on_start=start_worker,
+    # 按推理步数（变体任务乘以变体数）估计任务耗时，用于选择预计等待最短的工作线程和加权公平排队
+    cost=lambda params: params['num_inference_steps'] * len(params.get('variations', (None,))),
+    weight=key_scheduler.weight,
+    admit=key_scheduler.admit,
+    # 按实测每步耗时估计的排队总耗时上限，超出时立即返回 429
+    max_backlog=Config.MAX_QUEUED_GPU_SECONDS,
+    # 只有设备级错误计入工作线程的连续失败次数，无效输入或显存不足只使相应任务失败
+    fatal=is_fatal_error,
+)
+
+def job_parameters(job):
+    """任务的可公开参数"""
+    return {key: job.params[key] for key in EDIT_PARAMETERS}
+
+def lookup_cached_result(params):
+    """查询结果缓存，命中返回 (结果信息, PNG数据)"""
+    if result_cache is None:
+        return None
+    cached = result_cache.get(params['cache_key'])
+    if cached is None:
+        return None
+    data, meta = cached
+    params.pop('image', None)
+    return dict(meta, cache_hit=True), data
+
+def edit_image_sync():
+    """提交任务并等待完成
+
+    response_mode 决定响应形式：
+    - inline: JSON 中包含 base64 图像（默认，与原接口一致）
+    - binary: 直接返回图像数据，元信息放在响应头中
+    - url: JSON 中只包含下载链接
+    """
+    response_mode = request.values.get('response_mode', 'inline')
+    trace_request(response_mode=response_mode)
+    if response_mode not in RESPONSE_MODES:
+        return request_error(f"Invalid response_mode, expected one of {', '.join(RESPONSE_MODES)}", 400,
+                             'invalid_request')
+    
+    try:
+        check_key_quota()
+    except QuotaExceededError as e:
+        return quota_error(e)
+    params, error = parse_edit_request()
+    if error:
+        return error
+    
+    coalesced = False
+    data = None
+    cached = lookup_cached_result(params)
+    if cached is not None:
+        result, data = cached
+    else:
+        # 相同请求正在执行时直接等待同一个任务
+        try:
+            job, coalesced = job_queue.submit_shared(params['cache_key'], params, owner=g.api_key_name)
+        except QueueFullError as e:
+            return queue_full_error(e)
+        except QuotaExceededError as e:
+            return quota_error(e)
+        job.wait()
+        trace_job(job)
+        if job.error is not None:
+            return jsonify({'error': job.error}), 500
+        result = job.result
+    
+    trace_request(cache_hit=result['cache_hit'], coalesced=coalesced)
+    parameters = {key: params[key] for key in EDIT_PARAMETERS}
+    download_url = f"/download/{result['output_filename']}"
+    mimetype = output_mimetype(result['output_filename'])
+    if response_mode == 'url':
+        if data is not None:
+            # 结果缓存命中时输出文件可能已被清理
+            output_store.ensure(result['output_filename'], data)
         return jsonify({
             'success': True,
-            'output_image': f"data:image/png;base64,{img_str}",
-            'output_path': output_path,
-            'parameters': {
-                'prompt': prompt,
-                'negative_prompt': negative_prompt,
-                'true_cfg_scale': true_cfg_scale,
-                'num_inference_steps': num_inference_steps,
-                'seed': seed
-            }
+            'download_url': download_url,
+            'output_path': result['output_path'],
+            'cache_hit': result['cache_hit'],
+            'coalesced': coalesced,
+            'parameters': parameters
         })
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    
+    if data is None:
+        data = output_store.read(result['output_filename'])
+        if data is None:
+            return request_error('Output image is no longer available', 500, 'output_missing')
+    
+    if response_mode == 'binary':
+        return Response(data, mimetype=mimetype, headers={
+            'X-Output-Path': result['output_path'],
+            'X-Download-Url': download_url,
+            'X-Cache-Hit': str(result['cache_hit']).lower(),
+            'X-Coalesced': str(coalesced).lower(),
+            'X-Edit-Parameters': json.dumps(parameters),
+        })
+    
+    # 将图像转换为base64返回
+    with STAGE_SECONDS.time(stage='base64'):
+        img_str = base64.b64encode(data).decode()
+    
+    return jsonify({
+        'success': True,
+        'output_image': f"data:{mimetype};base64,{img_str}",
+        'output_path': result['output_path'],
+        'cache_hit': result['cache_hit'],
+        'coalesced': coalesced,
+        'parameters': parameters
+    })
+
+@app.route('/api/edit-image', methods=['POST'], endpoint='api_edit_image')
+@app.route('/edit-image', methods=['POST'], endpoint='web_edit_image')
+def edit_image():
+    """编辑图像：API端点从请求头读取密钥，Web端点（前端表单）从表单字段读取"""
+    # 启用追踪时，请求线程中各阶段的耗时同时记录到追踪记录中
+    with STAGE_SECONDS.collect(begin_trace()):
+        try:
+            if request.endpoint == 'web_edit_image':
+                parse_upload()
+                api_key = request.form.get('api_key')
+            else:
+                api_key = request.headers.get('X-API-Key')
+            if not api_key or not validate_api_key(api_key):
+                return request_error('Invalid or missing API key', 401, 'unauthorized')
+            
+            return edit_image_sync()
+        except HTTPException:
+            raise
+        except Exception as e:
+            return request_error(str(e), 500, type(e).__name__)
+
+@app.route('/api/jobs', methods=['POST'])
+@require_api_key
+def api_submit_job():
+    """API端点：提交异步编辑任务，立即返回任务ID"""
+    with STAGE_SECONDS.collect(begin_trace()):
+        try:
+            check_key_quota()
+            params, error = parse_edit_request()
+            if error:
+                return error
+            
+            coalesced = False
+            cached = lookup_cached_result(params)
+            if cached is not None:
+                # 结果缓存命中时输出文件可能已被清理，下载链接需要它
+                output_store.ensure(cached[0]['output_filename'], cached[1])
+                job = job_queue.add_completed(params, cached[0], owner=g.api_key_name)
+            else:
+                job, coalesced = job_queue.submit_shared(params['cache_key'], params, owner=g.api_key_name)
+                trace_job_later(job)
+            trace_request(cache_hit=cached is not None, coalesced=coalesced)
+            return jsonify({
+                'success': True,
+                'job_id': job.id,
+                'coalesced': coalesced,
+                'status': job.status,
+                'queue_position': job_queue.position(job),
+                'status_url': f"/api/jobs/{job.id}",
+                'events_url': job_events_url(job)
+            }), 202
+        except QueueFullError as e:
+            return queue_full_error(e)
+        except QuotaExceededError as e:
+            return quota_error(e)
+        except HTTPException:
+            raise
+        except Exception as e:
+            return request_error(str(e), 500, type(e).__name__)
+
+@app.route('/api/variations', methods=['POST'])
+@require_api_key
+def api_variations():
+    """API端点：对一张图像生成一组变体（多个种子和/或提示词）
+
+    图像只解码和 VAE 编码一次，每个不同的提示词只编码一次，去噪按批执行；
+    已缓存的变体直接返回。response_mode 为 url（默认）或 inline。
+    """
+    with STAGE_SECONDS.collect(begin_trace()):
+        try:
+            response_mode = request.values.get('response_mode', 'url')
+            trace_request(response_mode=response_mode)
+            if response_mode not in ('url', 'inline'):
+                return request_error('Invalid response_mode, expected one of url, inline', 400, 'invalid_request')
+            
+            check_key_quota()
+            params, variations, error = parse_variation_request()
+            if error:
+                return error
+            
+            results = [lookup_cached_result(variation) for variation in variations]
+            missing = [variation for variation, cached in zip(variations, results) if cached is None]
+            coalesced = False
+            if missing:
+                # 只为未缓存的变体提交一个任务；同一组变体正在执行时直接等待它
+                params['variations'] = missing
+                dedupe_key = make_cache_key(params['image_hash'], {'variations': [v['cache_key'] for v in missing]})
+                job, coalesced = job_queue.submit_shared(dedupe_key, params, owner=g.api_key_name)
+                job.wait()
+                trace_job(job)
+                if job.error is not None:
+                    return jsonify({'error': job.error}), 500
+                generated = iter(job.result['variations'])
+                results = [cached if cached is not None else (next(generated), None) for cached in results]
+            else:
+                params.pop('image', None)
+            
+            trace_request(generated=len(missing), coalesced=coalesced)
+            items = []
+            for variation, (result, data) in zip(variations, results):
+                item = {
+                    'prompt': variation['prompt'],
+                    'seed': variation['seed'],
+                    'download_url': f"/download/{result['output_filename']}",
+                    'output_path': result['output_path'],
+                    'cache_hit': result['cache_hit'],
+                }
+                if response_mode == 'url':
+                    if data is not None:
+                        output_store.ensure(result['output_filename'], data)
+                else:
+                    if data is None:
+                        data = output_store.read(result['output_filename'])
+                        if data is None:
+                            return request_error('Output image is no longer available', 500, 'output_missing')
+                    with STAGE_SECONDS.time(stage='base64'):
+                        item['output_image'] = (f"data:{output_mimetype(result['output_filename'])};base64,"
+                                                f"{base64.b64encode(data).decode()}")
+                items.append(item)
+            
+            return jsonify({
+                'success': True,
+                'count': len(items),
+                'generated': len(missing),
+                'coalesced': coalesced,
+                'parameters': {key: params[key] for key in ('negative_prompt', 'true_cfg_scale', 'num_inference_steps')},
+                'variations': items,
+            })
+        except QueueFullError as e:
+            return queue_full_error(e)
+        except QuotaExceededError as e:
+            return quota_error(e)
+        except HTTPException:
+            raise
+        except Exception as e:
+            return request_error(str(e), 500, type(e).__name__)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@require_api_key
+def api_get_job(job_id):
+    """API端点：查询任务状态和结果"""
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    response = job.to_dict()
+    response['queue_position'] = job_queue.position(job)
+    response['events_url'] = job_events_url(job)
+    response['parameters'] = job_parameters(job)
+    if job.status == 'succeeded':
+        response['result'] = {
+            'output_path': job.result['output_path'],
+            'download_url': f"/download/{job.result['output_filename']}",
+            'cache_hit': job.result['cache_hit']
+        }
+    return jsonify(response)
+
+def find_job(job_id):
+    """当前密钥提交（或复用）的任务；不存在或属于其他密钥时返回 None，不暴露任务是否存在"""
+    job = job_queue.get(job_id)
+    if job is None or g.api_key_name not in job.viewers:
+        return None
+    return job
+
+# 事件流令牌的签名密钥：每次启动随机生成，重启后旧令牌失效
+EVENTS_TOKEN_SECRET = secrets.token_bytes(32)
+
+def events_token_signature(job_id, expires):
+    message = f"{job_id}:{expires}".encode('utf-8')
+    return hmac.new(EVENTS_TOKEN_SECRET, message, hashlib.sha256).hexdigest()
+
+def job_events_url(job):
+    """任务事件流的地址，附带只对该任务有效、EVENTS_TOKEN_TTL 秒后过期的令牌
+
+    EventSource 无法设置请求头，令牌代替 API 密钥放在 URL 中，访问日志中不会出现密钥。
+    """
+    expires = int(time.time()) + Config.EVENTS_TOKEN_TTL
+    return f"/api/jobs/{job.id}/events?token={expires}.{events_token_signature(job.id, expires)}"
+
+def valid_events_token(job_id, token):
+    """检查事件流令牌是否属于该任务且未过期"""
+    expires, _, signature = token.partition('.')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, events_token_signature(job_id, int(expires)))
+
+def job_event(job):
+    """任务当前状态对应的 SSE 事件 (事件名, 数据)"""
+    data = {
+        'job_id': job.id,
+        'status': job.status,
+        'queue_position': job_queue.position(job),
+        'progress': job.progress,
+    }
+    if job.status == 'succeeded':
+        data['result'] = {
+            'output_path': job.result['output_path'],
+            'download_url': f"/download/{job.result['output_filename']}",
+            'cache_hit': job.result['cache_hit']
+        }
+        data['parameters'] = job_parameters(job)
+        return 'done', data
+    if job.status == 'failed':
+        data['error'] = job.error
+        return 'failed', data
+    return 'progress', data
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def api_job_events(job_id):
+    """API端点：以 Server-Sent Events 推送任务进度
+
+    EventSource 无法设置请求头，因此也接受提交或查询任务时返回的 events_url 中的短期令牌。
+    """
+    token = request.args.get('token')
+    if token is not None:
+        if not valid_events_token(job_id, token):
+            return request_error('Invalid or expired events token', 401, 'unauthorized')
+        job = job_queue.get(job_id)
+    else:
+        api_key = request.headers.get('X-API-Key')
+        if not api_key or not validate_api_key(api_key):
+            return request_error('Invalid or missing API key', 401, 'unauthorized')
+        job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def generate():
+        version = -1
+        sent_preview = None
+        while True:
+            # 排队位置变化不会通知，因此定期超时后重新发送状态
+            version = job.wait_for_update(version, timeout=1.0)
+            event, data = job_event(job)
+            if job.preview is not None and job.preview is not sent_preview:
+                data['preview'] = sent_preview = job.preview
+            yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+            if event != 'progress':
+                break
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/api/cache/stats', methods=['GET'])
+@require_api_key
+def api_cache_stats():
+    """API端点：缓存统计"""
+    if result_cache is None:
+        stats = {'enabled': False}
+    else:
+        stats = dict(result_cache.stats(), enabled=True)
+    if prompt_cache is None:
+        stats['prompt_embeddings'] = {'enabled': False}
+    else:
+        stats['prompt_embeddings'] = dict(prompt_cache.stats(), enabled=True)
+    stats['images'] = image_cache.stats()
+    stats['outputs'] = output_store.stats()
+    stats['variants'] = dict(variants.stats(), store=variant_store.stats())
+    return jsonify(stats)
+
+@app.route('/api/upload-settings', methods=['GET'])
+def api_upload_settings():
+    """网页端上传前缩小图像所需的设置（不需要 API 密钥）
+
+    target_area 和 multiple_of 用于按原图宽高比计算模型的目标分辨率，启用分桶时 buckets
+    为各桶的宽高比和分辨率；client_resize 为默认的重新编码格式和质量。
+    """
+    buckets = None
+    if resolution_buckets is not None:
+        buckets = [{'aspect_ratio': list(ratio), 'size': list(size)}
+                   for ratio, size in zip(resolution_buckets.ratios, resolution_buckets.sizes)]
+    return jsonify({
+        'target_area': TARGET_AREA,
+        'multiple_of': 32,
+        'buckets': buckets,
+        'formats': sorted(ALLOWED_EXTENSIONS),
+        'max_upload_bytes': app.config['MAX_CONTENT_LENGTH'],
+        'client_resize': {
+            'enabled': Config.CLIENT_RESIZE,
+            'format': Config.CLIENT_UPLOAD_FORMAT,
+            'quality': Config.CLIENT_UPLOAD_QUALITY,
+        },
+    })
+
+@app.route('/api/quota', methods=['GET'])
+@require_api_key
+def api_quota():
+    """API端点：当前密钥的优先级、限额、令牌余额和任务数"""
+    status = key_scheduler.status(g.api_key_name, g.api_key_info)
+    status['jobs'] = job_queue.owner_jobs(g.api_key_name)
+    return jsonify(status)
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_entity_too_large(e):
+    """上传超过 MAX_CONTENT_LENGTH"""
+    return request_error(f"Upload exceeds the {app.config['MAX_CONTENT_LENGTH']} byte limit", 413, 'upload_too_large')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+# 关闭前排空队列：不再接受新任务，已提交任务的状态查询、事件流和下载不受影响
+draining = threading.Event()
+SUBMIT_ENDPOINTS = {'api_edit_image', 'web_edit_image', 'api_submit_job', 'api_variations'}
+
+@app.before_request
+def reject_while_draining():
+    if draining.is_set() and request.endpoint in SUBMIT_ENDPOINTS:
+        return retry_later('Server is shutting down', 'draining', Config.DRAIN_RETRY_AFTER, 503)
+
+def drain(timeout):
+    """停止接受新任务，等待排队和执行中的任务完成（最多 timeout 秒）并把输出写入磁盘
+
+    返回是否全部完成。
+    """
+    draining.set()
+    print(f"Draining: waiting up to {timeout}s for {len(job_queue)} queued jobs and running batches...")
+    finished = job_queue.wait_idle(timeout)
+    if not finished:
+        print("Drain timed out, unfinished jobs will be lost")
+    output_store.flush()
+    variant_store.flush()
+    api_key_index.flush()
+    return finished
+
+@app.after_request
+def record_request_metrics(response):
+    """记录每个请求的状态码和耗时（SSE 只计到响应开始）"""
+    endpoint = request.endpoint or 'unknown'
+    HTTP_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if 'request_started' in g:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    trace = g.pop('trace', None)
+    if trace is not None:
+        trace.update(
+            key=g.get('api_key_name'),
+            status=response.status_code,
+            latency=round(time.perf_counter() - g.request_started, 4),
+        )
+        job = g.pop('traced_job', None)
+        if job is not None:
+            job.add_done_callback(lambda job: write_job_trace(trace, job))
+        else:
+            write_trace(trace)
+    return response
+
+@app.route('/healthz')
+def healthz():
+    """存活检查：进程可以响应请求"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """就绪检查：至少一个工作线程已加载模型并完成预热时返回 200，否则（或正在关闭时）返回 503"""
+    ready = model_ready() and not draining.is_set()
+    return jsonify({'ready': ready, 'draining': draining.is_set(), 'workers': job_queue.workers()}), \
+        200 if ready else 503
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 指标"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/download/<filename>')
 def download_file(filename):
-    """下载生成的图像"""
+    """下载生成的图像（包括尚未写入磁盘的图像）
+
+    ?size=<最长边>&format=<png|webp|jpeg> 返回按需生成并缓存的缩略图或转码版本。
+    """
+    if secure_filename(filename) != filename or '.' not in filename:
+        abort(404)
+    try:
+        variant = variants.parse(request.args, filename)
+    except ValueError as e:
+        return request_error(str(e), 400, 'invalid_request')
+    if variant is None:
+        return send_stored_file(output_store, filename)
+    name = variants.resolve(variant, lambda: output_store.read(filename))
+    if name is None:
+        abort(404)
+    return send_stored_file(variant_store, name)
+
+def send_stored_file(store, filename):
+    """发送存储中的文件：强 ETag、Last-Modified 和 304、Range 请求，并允许长期缓存
+
+    输出文件名唯一且内容写入后不再改变，因此标记为 immutable。
+    """
+    path = store.locate(filename)
+    if path is not None:
+        file, last_modified = os.path.abspath(path), None
+    else:
+        entry = store.pending_entry(filename)
+        if entry is None:
+            abort(404)
+        file, last_modified = io.BytesIO(entry[0]), entry[1]
     try:
-        return send_file(os.path.join(OUTPUT_FOLDER, filename), as_attachment=True)
+        response = send_file(
+            file,
+            mimetype=output_mimetype(filename),
+            as_attachment=True,
+            download_name=filename,
+            etag=store.etag(filename),
+            last_modified=last_modified,
+            max_age=Config.DOWNLOAD_CACHE_MAX_AGE,
+            conditional=True,
+        )
     except FileNotFoundError:
+        # 刚被清理
         abort(404)
+    response.cache_control.immutable = True
+    return response
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # 开发服务器；生产环境使用 serve.py（异步前端 + 独立推理进程）
+    # 调试模式的重载器会先启动一个监视进程，只在实际提供服务的子进程中加载模型
+    if Config.EAGER_MODEL_LOAD and (not Config.DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        start_model_loader()
+    app.run(debug=Config.DEBUG, host=Config.HOST, port=Config.PORT)
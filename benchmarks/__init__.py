@@ -0,0 +1,5 @@
+"""
+性能基准测试
+stub_pipeline 提供可配置耗时的替身管道，stub_server 用它启动服务，
+loadgen 以固定并发或开环到达率压测编辑接口并报告延迟、吞吐和服务端资源占用
+"""
@@ -0,0 +1,348 @@
+"""
+压测工具
+以固定并发（闭环）或固定到达率（开环，泊松到达）请求 /api/edit-image，
+报告延迟分位数、吞吐量以及服务端进程的 CPU 和内存占用，并保存为 JSON
+
+用法:
+    python -m benchmarks.loadgen --spawn-stub --stub-args "--step-seconds 0.02" --concurrency 8 --duration 30
+    python -m benchmarks.loadgen --url http://127.0.0.1:5000 --api-key KEY --rate 2 --requests 200 --server-pid 1234
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, q):
+    """线性插值的分位数（q 取 0-100）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return round(ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower), 4)
+
+
+def make_image(path=None, size=(1024, 768), image_format='JPEG', seed=0):
+    """读取输入图像，或生成指定尺寸的噪声图像，返回 (文件名, 数据)"""
+    if path:
+        with open(path, 'rb') as f:
+            return os.path.basename(path), f.read()
+    image = Image.frombytes('RGB', size, random.Random(seed).randbytes(size[0] * size[1] * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=90)
+    return f"input.{'jpg' if image_format == 'JPEG' else image_format.lower()}", buffer.getvalue()
+
+
+class ServerMonitor:
+    """定期读取 /proc 采样服务端进程的 CPU 时间和常驻内存（仅 Linux）"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._ticks = os.sysconf('SC_CLK_TCK')
+
+    def _read(self):
+        with open(f'/proc/{self.pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / self._ticks  # utime + stime
+        rss = 0
+        with open(f'/proc/{self.pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                    break
+        return time.monotonic(), cpu_seconds, rss
+
+    def start(self):
+        self.samples.append(self._read())
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.samples.append(self._read())
+            except OSError:
+                break
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        try:
+            self.samples.append(self._read())
+        except OSError:
+            pass
+
+    def summary(self):
+        (t0, cpu0, _), (t1, cpu1, _) = self.samples[0], self.samples[-1]
+        rss = [sample[2] for sample in self.samples]
+        return {
+            'pid': self.pid,
+            'cpu_seconds': round(cpu1 - cpu0, 3),
+            'cpu_utilization': round((cpu1 - cpu0) / (t1 - t0), 3) if t1 > t0 else None,  # 平均占用的核数
+            'rss_start_bytes': rss[0],
+            'rss_max_bytes': max(rss),
+            'rss_end_bytes': rss[-1],
+            'samples': len(self.samples),
+        }
+
+
+class LoadGenerator:
+    """发送编辑请求并记录每个请求的结果"""
+
+    def __init__(self, url, api_key, image=None, params=None, vary_seed=True, timeout=600):
+        self.base_url = url.rstrip('/')
+        self.url = self.base_url + '/api/edit-image'
+        self.api_key = api_key
+        self.filename, self.image_bytes = image or (None, None)
+        self.params = params or {}
+        self.vary_seed = vary_seed
+        self.timeout = timeout
+        self.results = []
+        self._lock = threading.Lock()
+        self._counter = 0
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def send(self, scheduled=None, params=None, image=None, tag=None, path=None):
+        """发送一个请求；开环模式下延迟从计划到达时间算起，计入客户端排队
+
+        params 和 image 默认使用构造时给定的参数和图像；tag 随结果保存，用于对应原始请求；
+        path 为其他端点的路径（如 /api/variations），默认发送到 /api/edit-image。
+        """
+        with self._lock:
+            index = self._counter
+            self._counter += 1
+        filename, image_bytes = image or (self.filename, self.image_bytes)
+        data = dict(params or self.params)
+        if self.vary_seed:
+            # 每个请求使用不同的种子，避免命中结果缓存或被合并
+            data['seed'] = int(data.get('seed', 0)) + index
+            if data.get('seeds'):
+                seeds = [int(seed) for seed in data['seeds'].split(',')]
+                data['seeds'] = ','.join(str(seed + index * len(seeds)) for seed in seeds)
+        started = time.monotonic()
+        result = {'index': index, 'tag': tag}
+        try:
+            response = self._session().post(
+                self.base_url + path if path else self.url,
+                headers={'X-API-Key': self.api_key},
+                data=data,
+                files={'image': (filename, image_bytes)},
+                timeout=self.timeout,
+            )
+            result['status'] = response.status_code
+            result['bytes'] = len(response.content)
+        except requests.RequestException as e:
+            result['status'] = None
+            result['error'] = type(e).__name__
+        finished = time.monotonic()
+        result['latency'] = finished - (scheduled if scheduled is not None else started)
+        result['finished'] = finished
+        with self._lock:
+            self.results.append(result)
+        return result
+
+    def run_closed_loop(self, concurrency, duration=None, total=None):
+        """固定并发：每个客户端线程收到响应后立即发送下一个请求"""
+        deadline = time.monotonic() + duration if duration else None
+        remaining = [total]
+
+        def take():
+            with self._lock:
+                if remaining[0] is not None:
+                    if remaining[0] <= 0:
+                        return False
+                    remaining[0] -= 1
+            return deadline is None or time.monotonic() < deadline
+
+        def client():
+            while take():
+                self.send()
+
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open_loop(self, rate, duration=None, total=None, max_inflight=256, seed=0):
+        """固定到达率：按泊松过程发送请求，不等待之前的响应"""
+        rng = random.Random(seed)
+        started = time.monotonic()
+        next_arrival = started
+        sent = 0
+        with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+            while True:
+                if total is not None and sent >= total:
+                    break
+                if duration is not None and next_arrival - started >= duration:
+                    break
+                delay = next_arrival - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.send, next_arrival)
+                sent += 1
+                next_arrival += rng.expovariate(rate)
+
+    def summary(self, wall_seconds):
+        ok = [result for result in self.results if result['status'] == 200]
+        latencies = [result['latency'] for result in ok]
+        statuses = {}
+        for result in self.results:
+            key = str(result['status'] if result['status'] is not None else result.get('error'))
+            statuses[key] = statuses.get(key, 0) + 1
+        return {
+            'requests': len(self.results),
+            'succeeded': len(ok),
+            'statuses': statuses,
+            'wall_seconds': round(wall_seconds, 3),
+            'throughput_rps': round(len(ok) / wall_seconds, 3) if wall_seconds > 0 else None,
+            'latency_seconds': {
+                'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': round(max(latencies), 4) if latencies else None,
+            },
+            'response_bytes_mean': round(sum(r['bytes'] for r in ok) / len(ok)) if ok else None,
+        }
+
+
+def spawn_stub_server(port, api_key, stub_args):
+    """启动替身服务并等待就绪"""
+    command = [sys.executable, '-m', 'benchmarks.stub_server', '--port', str(port), '--api-key', api_key]
+    command += shlex.split(stub_args or '')
+    process = subprocess.Popen(command, cwd=REPO_ROOT)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Stub server exited with code {process.returncode}')
+        try:
+            if requests.get(url + '/readyz', timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Stub server did not become ready')
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for /api/edit-image')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--api-key', default='benchmark-key')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--concurrency', type=int, help='closed loop with this many concurrent clients')
+    mode.add_argument('--rate', type=float, help='open loop with this many Poisson arrivals per second')
+    parser.add_argument('--duration', type=float, help='seconds to send requests for')
+    parser.add_argument('--requests', type=int, help='total number of requests')
+    parser.add_argument('--max-inflight', type=int, default=256, help='open loop: max concurrent requests')
+    parser.add_argument('--image', help='input image file (default: a synthetic noise JPEG)')
+    parser.add_argument('--image-size', type=parse_size, default=(1024, 768), help='synthetic image size WxH')
+    parser.add_argument('--prompt', default='Change the background to a sunset')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--cfg', type=float, default=4.0)
+    parser.add_argument('--response-mode', default='url', choices=['inline', 'binary', 'url'])
+    parser.add_argument('--same-request', action='store_true',
+                        help='send identical requests (exercises result cache and coalescing)')
+    parser.add_argument('--server-pid', type=int, help='server process to sample CPU and RSS from')
+    parser.add_argument('--spawn-stub', action='store_true', help='start benchmarks.stub_server and measure it')
+    parser.add_argument('--stub-port', type=int, default=5055)
+    parser.add_argument('--stub-args', default='', help='extra arguments for the stub server')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    if args.duration is None and args.requests is None:
+        parser.error('one of --duration or --requests is required')
+    if args.concurrency is None and args.rate is None:
+        args.concurrency = 1
+
+    process = None
+    url, server_pid = args.url, args.server_pid
+    if args.spawn_stub:
+        process, url = spawn_stub_server(args.stub_port, args.api_key, args.stub_args)
+        server_pid = process.pid
+
+    try:
+        generator = LoadGenerator(url, args.api_key, make_image(args.image, args.image_size), {
+            'prompt': args.prompt,
+            'num_inference_steps': args.steps,
+            'true_cfg_scale': args.cfg,
+            'response_mode': args.response_mode,
+        }, vary_seed=not args.same_request)
+        monitor = ServerMonitor(server_pid) if server_pid else None
+        if monitor is not None:
+            monitor.start()
+        started = time.monotonic()
+        if args.rate is not None:
+            generator.run_open_loop(args.rate, args.duration, args.requests, args.max_inflight)
+        else:
+            generator.run_closed_loop(args.concurrency, args.duration, args.requests)
+        wall_seconds = time.monotonic() - started
+        if monitor is not None:
+            monitor.stop()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'config': {
+            'url': url,
+            'mode': 'open' if args.rate is not None else 'closed',
+            'concurrency': args.concurrency,
+            'rate': args.rate,
+            'duration': args.duration,
+            'requests': args.requests,
+            'image': args.image or f'synthetic {args.image_size[0]}x{args.image_size[1]}',
+            'image_bytes': len(generator.image_bytes),
+            'steps': args.steps,
+            'cfg': args.cfg,
+            'response_mode': args.response_mode,
+            'same_request': args.same_request,
+            'stub_args': args.stub_args if args.spawn_stub else None,
+        },
+        'summary': generator.summary(wall_seconds),
+        'server': monitor.summary() if monitor is not None else None,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        report['latencies'] = [round(result['latency'], 4) for result in generator.results]
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""
+追踪重放
+按追踪文件（TRACE_ENABLED 时服务端写入的 JSONL）中记录的到达时间、图像尺寸和参数
+重新向服务发送请求，可按原速或加速重放，并比较多次运行的延迟分布
+
+用法:
+    python -m benchmarks.replay run traces/requests.jsonl --url http://127.0.0.1:5000 --api-key KEY \
+        --speed 10 --output run.json
+    python -m benchmarks.replay compare traces/requests.jsonl baseline.json candidate.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from benchmarks.loadgen import LoadGenerator, ServerMonitor, make_image, percentile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from request_trace import read_trace  # noqa: E402
+
+
+class TraceImages:
+    """重放使用的输入图像：优先读取追踪时保存的原图，否则按记录的尺寸和格式生成噪声图像
+
+    生成的图像以原图哈希为随机种子，原本相同的图像重放时仍然相同（保留缓存和请求合并的效果）。
+    """
+
+    def __init__(self, trace_path):
+        self.directory = os.path.dirname(os.path.abspath(trace_path))
+        self._images = {}
+        self.synthesized = 0
+
+    def get(self, record):
+        info = record['input']
+        key = info.get('sha256') or (info['width'], info['height'], info['format'])
+        if key not in self._images:
+            path = os.path.join(self.directory, info['file']) if info.get('file') else None
+            if path and os.path.exists(path):
+                self._images[key] = make_image(path)
+            else:
+                self._images[key] = make_image(size=(info['width'], info['height']),
+                                               image_format=info['format'], seed=str(key))
+                self.synthesized += 1
+        return self._images[key]
+
+
+# 各端点的追踪记录重放到的端点：异步任务按同步编辑重放，延迟计到结果返回
+REPLAY_PATHS = {
+    'api_edit_image': '/api/edit-image',
+    'web_edit_image': '/api/edit-image',
+    'api_submit_job': '/api/edit-image',
+    'api_variations': '/api/variations',
+}
+
+
+def replayable(record):
+    """只有通过了参数和图像检查的请求可以重放"""
+    return ('params' in record and 'width' in record.get('input', {})
+            and record.get('endpoint', 'api_edit_image') in REPLAY_PATHS)
+
+
+def recorded_result(record):
+    """追踪记录的 (是否成功, 延迟)：异步任务计到任务完成（命中缓存时提交即完成）"""
+    if 'job_status' in record:
+        return record['job_status'] == 'succeeded', record['job_latency']
+    return record.get('status') in (200, 202), record.get('latency')
+
+
+def request_params(record):
+    """重放请求的表单参数"""
+    params = dict(record['params'])
+    if 'response_mode' in record:
+        params['response_mode'] = record['response_mode']
+    elif record.get('endpoint') != 'api_variations':
+        params['response_mode'] = 'inline'
+    if record['input'].get('original_size'):
+        params['original_size'] = record['input']['original_size']
+    return params
+
+
+def replay(records, generator, images, speed=1.0, max_inflight=256):
+    """按记录的相对到达时间（除以 speed）发送请求"""
+    first = records[0]['ts']
+    # 先准备好全部图像，避免编码耗时影响发送时间
+    prepared = [images.get(record) for record in records]
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+        for i, (record, image) in enumerate(zip(records, prepared)):
+            scheduled = started + (record['ts'] - first) / speed
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            path = REPLAY_PATHS[record.get('endpoint', 'api_edit_image')]
+            executor.submit(generator.send, scheduled, request_params(record), image, i, path)
+    return time.monotonic() - started
+
+
+def latency_summary(latencies):
+    return {
+        'count': len(latencies),
+        'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': round(max(latencies), 4) if latencies else None,
+    }
+
+
+def run_command(args):
+    records = sorted((r for r in read_trace(args.trace) if replayable(r)), key=lambda r: r['ts'])
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        sys.exit('No replayable records in the trace')
+
+    images = TraceImages(args.trace)
+    generator = LoadGenerator(args.url, args.api_key, vary_seed=args.vary_seed)
+    monitor = ServerMonitor(args.server_pid) if args.server_pid else None
+    if monitor is not None:
+        monitor.start()
+    wall_seconds = replay(records, generator, images, args.speed, args.max_inflight)
+    if monitor is not None:
+        monitor.stop()
+
+    requests = []
+    for result in sorted(generator.results, key=lambda result: result['tag']):
+        record = records[result['tag']]
+        requests.append({
+            'offset': round(record['ts'] - records[0]['ts'], 3),
+            'steps': record['params']['num_inference_steps'],
+            'status': result['status'],
+            'latency': round(result['latency'], 4),
+            'recorded_status': record.get('status'),
+            'recorded_latency': recorded_result(record)[1],
+        })
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'config': {
+            'trace': args.trace,
+            'url': args.url,
+            'speed': args.speed,
+            'records': len(records),
+            'trace_seconds': round(records[-1]['ts'] - records[0]['ts'], 3),
+            'synthesized_images': images.synthesized,
+            'vary_seed': args.vary_seed,
+        },
+        'summary': generator.summary(wall_seconds),
+        'server': monitor.summary() if monitor is not None else None,
+        'requests': requests,
+    }
+    output = {key: value for key, value in report.items() if key != 'requests'}
+    print(json.dumps(output, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def load_run(path):
+    """读取一次运行的 (名称, [(推理步数, 延迟), ...])；追踪文件本身即为原始运行"""
+    if path.endswith('.jsonl'):
+        samples = [(r['params']['num_inference_steps'], recorded_result(r)[1])
+                   for r in read_trace(path) if replayable(r) and recorded_result(r)[0]]
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            samples = [(r['steps'], r['latency']) for r in json.load(f)['requests'] if r['status'] == 200]
+    return os.path.basename(path), samples
+
+
+def ks_statistic(a, b):
+    """两样本 Kolmogorov-Smirnov 统计量：两个经验分布函数的最大差距（0 到 1）"""
+    if not a or not b:
+        return None
+    a, b = sorted(a), sorted(b)
+    i = j = 0
+    distance = 0.0
+    while i < len(a) and j < len(b):
+        value = min(a[i], b[j])
+        while i < len(a) and a[i] <= value:
+            i += 1
+        while j < len(b) and b[j] <= value:
+            j += 1
+        distance = max(distance, abs(i / len(a) - j / len(b)))
+    return round(distance, 4)
+
+
+def compare_command(args):
+    runs = [load_run(path) for path in args.runs]
+    groups = [('all', None)] + [(f'steps={steps}', steps)
+                                for steps in sorted({steps for _, samples in runs for steps, _ in samples})]
+    baseline_name, baseline = runs[0]
+    comparison = {'baseline': baseline_name, 'groups': {}}
+    print(f"{'group':<12} {'run':<28} {'count':>6} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} "
+          f"{'p50 Δ':>8} {'p95 Δ':>8} {'KS':>6}")
+    for group, steps in groups:
+        base = [latency for s, latency in baseline if steps is None or s == steps]
+        base_summary = latency_summary(base)
+        comparison['groups'][group] = []
+        for name, samples in runs:
+            latencies = [latency for s, latency in samples if steps is None or s == steps]
+            summary = latency_summary(latencies)
+            deltas = {}
+            for q in ('p50', 'p95'):
+                if summary[q] is not None and base_summary[q]:
+                    deltas[q] = round((summary[q] - base_summary[q]) / base_summary[q] * 100, 1)
+            summary.update(run=name, delta_percent=deltas, ks=ks_statistic(base, latencies))
+            comparison['groups'][group].append(summary)
+            cells = [f"{summary[key]:>9.3f}" if summary[key] is not None else f"{'-':>9}"
+                     for key in ('mean', 'p50', 'p95', 'p99', 'max')]
+            delta_cells = [f"{deltas[q]:>+7.1f}%" if q in deltas else f"{'-':>8}" for q in ('p50', 'p95')]
+            ks = f"{summary['ks']:>6.3f}" if summary['ks'] is not None else f"{'-':>6}"
+            print(f"{group:<12} {name[:28]:<28} {summary['count']:>6} {' '.join(cells)} {' '.join(delta_cells)} {ks}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(comparison, f, indent=2, ensure_ascii=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a request trace and compare latency distributions')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='replay a trace against a server')
+    run.add_argument('trace', help='trace file written by the server (JSONL)')
+    run.add_argument('--url', default='http://127.0.0.1:5000')
+    run.add_argument('--api-key', default='benchmark-key')
+    run.add_argument('--speed', type=float, default=1.0, help='replay speed-up factor (1 = recorded arrival times)')
+    run.add_argument('--limit', type=int, help='replay only the first N records')
+    run.add_argument('--max-inflight', type=int, default=256)
+    run.add_argument('--vary-seed', action='store_true',
+                     help='use a unique seed per request instead of the recorded one (defeats result caching)')
+    run.add_argument('--server-pid', type=int, help='server process to sample CPU and RSS from')
+    run.add_argument('--output', help='write the run, including per-request latencies, to this JSON file')
+
+    compare = commands.add_parser('compare', help='compare latency distributions of runs')
+    compare.add_argument('runs', nargs='+', help='run JSON files or trace files; the first is the baseline')
+    compare.add_argument('--output', help='write the comparison to this JSON file')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run_command(args)
+    else:
+        compare_command(args)
+
+
+if __name__ == '__main__':
+    main()
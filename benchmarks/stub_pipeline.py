@@ -0,0 +1,130 @@
+"""
+替身管道
+与 QwenImageEditPipeline 的调用流程一致（文本编码、VAE 编码、逐步去噪回调、VAE 解码），
+每一步只按配置休眠，不加载任何模型，用于在任意机器上测量服务自身的开销；
+可选在每一步运行一个很小的 Transformer，其输入形状与真实模型一样随目标分辨率变化，
+用于在 CPU 上测试分辨率分桶、torch.compile 和按形状预热
+"""
+
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from PIL import Image
+from diffusers.image_processor import VaeImageProcessor
+from diffusers.pipelines.qwenimage.pipeline_qwenimage_edit import calculate_dimensions
+
+
+class StubTransformer(torch.nn.Module):
+    """替身 Transformer：对每个潜变量块（16x16 像素）做一次两层 MLP"""
+
+    def __init__(self, channels=64, hidden=256, layers=2):
+        super().__init__()
+        self.blocks = torch.nn.ModuleList(
+            torch.nn.Sequential(torch.nn.LayerNorm(channels), torch.nn.Linear(channels, hidden),
+                                torch.nn.GELU(), torch.nn.Linear(hidden, channels))
+            for _ in range(layers))
+
+    def forward(self, hidden_states):
+        for block in self.blocks:
+            hidden_states = hidden_states + block(hidden_states)
+        return hidden_states
+
+
+class StubVae:
+    """替身 VAE：解码为指定尺寸的噪声图像（噪声图像的编码开销接近真实照片）"""
+
+    def __init__(self, pipeline):
+        self._pipeline = pipeline
+
+    def decode(self, latents, return_dict=False):
+        return self._pipeline._decode(latents)
+
+
+class StubPipeline:
+    """可配置每步耗时和输出尺寸的替身管道
+
+    step_seconds: 每个去噪步的耗时；batch_step_factor: 批量中每多一张图像，每步耗时增加的比例
+    encode_seconds / decode_seconds: 文本编码和 VAE 解码的耗时
+    output_size: 输出图像尺寸 (宽, 高)，为 None 时与模型的目标分辨率一致
+    transformer_hidden: 大于 0 时每一步运行一个隐藏层宽度为此值的替身 Transformer
+    """
+
+    vae_scale_factor = 8
+
+    def __init__(self, step_seconds=0.05, batch_step_factor=0.0, encode_seconds=0.0, decode_seconds=0.0,
+                 output_size=None, transformer_hidden=0, transformer_layers=2):
+        self.step_seconds = step_seconds
+        self.batch_step_factor = batch_step_factor
+        self.encode_seconds = encode_seconds
+        self.decode_seconds = decode_seconds
+        self.output_size = output_size
+        self.image_processor = VaeImageProcessor(vae_scale_factor=self.vae_scale_factor * 2)
+        self.vae = StubVae(self)
+        self.transformer = StubTransformer(hidden=transformer_hidden, layers=transformer_layers) \
+            if transformer_hidden > 0 else None
+        self.components = {}
+        self._execution_device = torch.device('cpu')
+        self._noise = {}
+        self._target_size = None
+
+    def set_progress_bar_config(self, **kwargs):
+        pass
+
+    def encode_prompt(self, prompt, image=None, device=None, **kwargs):
+        prompts = [prompt] if isinstance(prompt, str) else prompt
+        time.sleep(self.encode_seconds)
+        embeds = torch.zeros(len(prompts), 8, 16)
+        return embeds, torch.ones(len(prompts), 8, dtype=torch.long)
+
+    def _encode_vae_image(self, image, generator):
+        return torch.zeros(image.shape[0], 16, 1, 4, 4)
+
+    def prepare_latents(self, image, batch_size, generator):
+        return torch.zeros(batch_size, 16, 64), self._encode_vae_image(image, generator)
+
+    def _unpack_latents(self, latents, height, width, vae_scale_factor):
+        return torch.rand(latents.shape[0], 16, 1, height // vae_scale_factor, width // vae_scale_factor)
+
+    def _noise_image(self, size):
+        """按尺寸缓存的噪声图像，避免把生成噪声的耗时算作服务开销"""
+        image = self._noise.get(size)
+        if image is None:
+            array = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+            image = self._noise[size] = Image.fromarray(array)
+        return image
+
+    def _decode(self, latents):
+        time.sleep(self.decode_seconds)
+        size = self.output_size or self._target_size
+        return [self._noise_image(size) for _ in range(latents.shape[0])]
+
+    def __call__(self, image=None, prompt=None, negative_prompt=None, prompt_embeds=None, prompt_embeds_mask=None,
+                 negative_prompt_embeds=None, negative_prompt_embeds_mask=None, true_cfg_scale=4.0,
+                 num_inference_steps=50, generator=None, callback_on_step_end=None, **kwargs):
+        images = image if isinstance(image, list) else [image]
+        batch_size = len(images)
+        width, height = images[0].size
+        width, height, _ = calculate_dimensions(1024 * 1024, width / height)
+        self._target_size = (width, height)
+        # 与真实管道一样经过图像处理器缩放，使服务端的预处理缓存照常生效
+        resized = [self.image_processor.resize(item, height, width) for item in images]
+
+        if prompt_embeds is None:
+            self.encode_prompt(prompt, resized)
+            if true_cfg_scale > 1 and negative_prompt is not None:
+                self.encode_prompt(negative_prompt, resized)
+
+        latents, _ = self.prepare_latents(torch.zeros(batch_size, 3, 1, 8, 8), batch_size, generator)
+        if self.transformer is not None:
+            # 与真实模型一样，每 16x16 像素一个潜变量块，序列长度随目标分辨率变化
+            latents = torch.randn(batch_size, (height // 16) * (width // 16), 64)
+        step_seconds = self.step_seconds * (1 + self.batch_step_factor * (batch_size - 1))
+        for step in range(num_inference_steps):
+            time.sleep(step_seconds)
+            if self.transformer is not None:
+                latents = self.transformer(latents)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, 1000 - step, {'latents': latents})
+        return SimpleNamespace(images=self.vae.decode(latents, return_dict=False))
@@ -0,0 +1,96 @@
+"""
+用替身管道启动服务，测量服务自身（上传解析、排队、编码、保存、响应）的开销
+
+用法: python -m benchmarks.stub_server --port 5055 --step-seconds 0.05 [--workers 2] [--serve]
+
+服务在临时工作目录中运行（输出文件和缓存写在那里），并写入一个基准测试专用的API密钥。
+其他服务配置仍可通过环境变量设置，例如 MAX_BATCH_SIZE、RESULT_CACHE_ENABLED。
+--serve 时与 serve.py 一样以生产模式运行（异步前端，替身管道在推理进程中加载）。
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def install_stub(server):
+    """把 app 的模型加载替换为替身管道（参数来自 STUB_PIPELINE 环境变量），其余服务流程保持不变"""
+    from benchmarks.stub_pipeline import StubPipeline
+
+    options = json.loads(os.environ['STUB_PIPELINE'])
+    output_size = tuple(options['output_size']) if options['output_size'] else None
+
+    def load_stub(pipeline_class, model_name, device=None, **kwargs):
+        stub = StubPipeline(options['step_seconds'], options['batch_step_factor'], options['encode_seconds'],
+                            options['decode_seconds'], output_size, options['transformer_hidden'],
+                            options['transformer_layers'])
+        return stub, {'snapshot': 'stub', 'dtype': 'none', 'device': device, 'resolve_seconds': 0.0,
+                      'total_seconds': 0.0, 'peak_rss_bytes': 0, 'components': []}
+
+    server.load_pipeline_from_snapshot = load_stub
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the edit server with a stub pipeline')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--api-key', default='benchmark-key')
+    parser.add_argument('--workdir', help='working directory for outputs and caches (default: a new temp dir)')
+    parser.add_argument('--workers', type=int, default=1, help='number of inference workers')
+    parser.add_argument('--step-seconds', type=float, default=0.05, help='latency of each denoising step')
+    parser.add_argument('--batch-step-factor', type=float, default=0.0,
+                        help='extra step latency per additional image in a batch (fraction of step-seconds)')
+    parser.add_argument('--encode-seconds', type=float, default=0.0, help='latency of each prompt encoding')
+    parser.add_argument('--decode-seconds', type=float, default=0.0, help='latency of the VAE decode')
+    parser.add_argument('--output-size', type=parse_size, help='output image size WxH (default: model target size)')
+    parser.add_argument('--transformer-hidden', type=int, default=0,
+                        help='run a small stub transformer of this hidden width at every step (0 = none)')
+    parser.add_argument('--transformer-layers', type=int, default=2)
+    parser.add_argument('--serve', action='store_true', help='run in production mode (see serve.py)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='qwen-edit-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    with open('api_keys.json', 'w', encoding='utf-8') as f:
+        json.dump({'benchmark': {'key': args.api_key, 'created_at': datetime.now().isoformat(), 'last_used': None}}, f)
+
+    # 配置在导入 app 时读取，必须先设置环境变量
+    os.environ['WORKER_DEVICES'] = ','.join(['cpu'] * args.workers)
+    os.environ.setdefault('WARMUP_STEPS', '0')
+    os.environ['STUB_PIPELINE'] = json.dumps({
+        'step_seconds': args.step_seconds,
+        'batch_step_factor': args.batch_step_factor,
+        'encode_seconds': args.encode_seconds,
+        'decode_seconds': args.decode_seconds,
+        'output_size': args.output_size,
+        'transformer_hidden': args.transformer_hidden,
+        'transformer_layers': args.transformer_layers,
+    })
+    sys.path.insert(0, REPO_ROOT)
+    print(f"Stub server working directory: {workdir}")
+    if args.serve:
+        # 推理进程导入 app 后安装替身管道
+        os.environ['INFERENCE_SETUP'] = 'benchmarks.stub_server:install_stub'
+        import serve
+        serve.run(args.host, args.port)
+        return
+
+    import app as server
+    install_stub(server)
+    server.start_model_loader()
+    server.app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
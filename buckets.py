@@ -0,0 +1,94 @@
+"""
+分辨率分桶
+把任意尺寸的输入图像对齐到少数几种固定宽高比的分辨率，Transformer 看到的潜变量形状
+只有有限几种：可以用 torch.compile 按形状编译并在启动时逐一预热，显存分配模式也保持稳定；
+提示词嵌入同样按长度桶填充
+"""
+
+import math
+
+from diffusers.pipelines.qwenimage.pipeline_qwenimage_edit import calculate_dimensions
+
+# 提示词嵌入的长度桶：编译 Transformer 时把嵌入填充到这几种长度之一，文本长度不同的提示词不会各自触发重新编译
+TEXT_LENGTH_BUCKETS = (128, 256, 512, 1024)
+
+# 输出尺寸：bucket 为桶的分辨率；aspect 缩放回原图宽高比下模型的目标分辨率（与不分桶时一致）；
+# original 缩放回上传图像的原始尺寸
+OUTPUT_SIZES = ('bucket', 'aspect', 'original')
+
+
+def text_length_bucket(length):
+    """提示词嵌入填充到的长度：大于 length 的最小长度桶，超过最大的桶时不填充
+
+    严格大于 length，填充后总有被掩码的位置：掩码全为有效位置时管道不再传入掩码，会形成另一份编译图。
+    """
+    for bucket in TEXT_LENGTH_BUCKETS:
+        if bucket > length:
+            return bucket
+    return length
+
+
+def batch_sizes(max_batch_size, variation_batch_size):
+    """推理可能出现的批量大小：动态批处理和变体分批都可能凑不满一批"""
+    return list(range(1, max(1, max_batch_size, variation_batch_size) + 1))
+
+
+def warmup_shapes(sizes, batch_sizes, compiled):
+    """预热的 (输入图像尺寸, 批量大小) 列表
+
+    编译时每种尺寸和批量大小各运行一次，使全部形状在就绪前编译完成，最后再以单张图像运行一次已编译的形状，
+    作为稳定状态下每步耗时的估计；不编译时每种尺寸只以单张图像运行一次。
+    """
+    if not compiled:
+        return [(size, 1) for size in sizes]
+    return [(size, batch_size) for size in sizes for batch_size in batch_sizes] + [(sizes[0], 1)]
+
+
+def parse_aspect_ratios(spec):
+    """解析逗号分隔的宽高比列表（如 '1:1,4:3,3:4'），返回 [(宽, 高), ...]
+
+    格式不合法时抛出 ValueError。
+    """
+    ratios = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        width, _, height = item.partition(':')
+        ratio = (int(width), int(height))
+        if ratio[0] <= 0 or ratio[1] <= 0:
+            raise ValueError(f"Invalid aspect ratio: {item}")
+        if ratio not in ratios:
+            ratios.append(ratio)
+    return ratios
+
+
+class ResolutionBuckets:
+    """按宽高比定义的分辨率桶，每个桶的分辨率与管道对该宽高比计算的目标分辨率一致"""
+
+    def __init__(self, ratios, target_area=1024 * 1024):
+        self.ratios = list(ratios)
+        self.target_area = target_area
+        self.sizes = [calculate_dimensions(target_area, width / height)[:2] for width, height in self.ratios]
+
+    def nearest(self, width, height):
+        """与图像宽高比最接近（按对数比较，横竖对称）的桶，返回 (宽高比, 分辨率)"""
+        aspect = math.log(width / height)
+        index = min(range(len(self.ratios)),
+                    key=lambda i: abs(aspect - math.log(self.ratios[i][0] / self.ratios[i][1])))
+        return self.ratios[index], self.sizes[index]
+
+    def sample_sizes(self):
+        """与每个桶的宽高比完全一致的输入图像尺寸（用于预热）"""
+        sizes = []
+        for width, height in self.ratios:
+            scale = max(1, 1024 // max(width, height))
+            sizes.append((width * scale, height * scale))
+        return sizes
+
+    def describe(self):
+        """参与缓存键的配置描述：修改分桶后不会返回旧分辨率的缓存结果"""
+        return ','.join(f"{width}:{height}" for width, height in self.ratios)
+
+    def __len__(self):
+        return len(self.ratios)
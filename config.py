@@ -18,15 +18,67 @@ class Config:
     UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
     OUTPUT_FOLDER = os.environ.get('OUTPUT_FOLDER', 'outputs')
     API_KEYS_FILE = os.environ.get('API_KEYS_FILE', 'api_keys.json')
+    API_KEY_FLUSH_INTERVAL = float(os.environ.get('API_KEY_FLUSH_INTERVAL', 30))  # last_used 写回间隔（秒）
+    
+    # 输出存储：按文件名哈希分目录、后台线程写盘，并定期按保留时间和总大小清理
+    OUTPUT_SHARD_LEVELS = int(os.environ.get('OUTPUT_SHARD_LEVELS', 2))  # 每级 256 个子目录
+    OUTPUT_ASYNC_WRITES = os.environ.get('OUTPUT_ASYNC_WRITES', 'True').lower() == 'true'
+    OUTPUT_MAX_PENDING_WRITES = int(os.environ.get('OUTPUT_MAX_PENDING_WRITES', 64))  # 写满时保存操作等待
+    OUTPUT_RETENTION_HOURS = float(os.environ.get('OUTPUT_RETENTION_HOURS', 168))  # 0 表示不按时间清理
+    OUTPUT_MAX_MB = int(os.environ.get('OUTPUT_MAX_MB', 10240))  # 0 表示不限制总大小
+    UPLOAD_RETENTION_HOURS = float(os.environ.get('UPLOAD_RETENTION_HOURS', 24))  # 上传目录中遗留文件的保留时间
+    OUTPUT_GC_INTERVAL = int(os.environ.get('OUTPUT_GC_INTERVAL', 600))  # 清理间隔（秒），0 表示不清理
+    
+    # 下载：输出文件名唯一且写入后不再修改，允许浏览器和 CDN 长期缓存（秒）
+    DOWNLOAD_CACHE_MAX_AGE = int(os.environ.get('DOWNLOAD_CACHE_MAX_AGE', 31536000))
+    # 按需生成的缩略图（最长边）和转码版本，如 /download/<文件名>?size=256&format=webp
+    DOWNLOAD_VARIANT_SIZES = os.environ.get('DOWNLOAD_VARIANT_SIZES', '256,512,1024')
+    VARIANT_CACHE_FOLDER = os.environ.get('VARIANT_CACHE_FOLDER', 'cache/variants')
+    VARIANT_CACHE_MB = int(os.environ.get('VARIANT_CACHE_MB', 2048))
     
     # 文件限制
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
-    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+    ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+    MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 50_000_000))  # 解码前按文件头检查
+    MAX_IMAGE_SIDE = int(os.environ.get('MAX_IMAGE_SIDE', 12000))
+    JPEG_DRAFT_DECODE = os.environ.get('JPEG_DRAFT_DECODE', 'True').lower() == 'true'  # JPEG 按目标分辨率缩小解码
+    # 网页端上传前在浏览器中把图像缩小到模型的目标分辨率并重新编码（用户可在页面上修改）
+    CLIENT_RESIZE = os.environ.get('CLIENT_RESIZE', 'True').lower() == 'true'
+    CLIENT_UPLOAD_FORMAT = os.environ.get('CLIENT_UPLOAD_FORMAT', 'webp').lower()  # 'webp' or 'jpeg'
+    CLIENT_UPLOAD_QUALITY = int(os.environ.get('CLIENT_UPLOAD_QUALITY', 90))  # 1-100
     
     # 模型配置
-    MODEL_NAME = os.environ.get('MODEL_NAME', 'Qwen/Qwen-Image-Edit')
+    MODEL_NAME = os.environ.get('MODEL_NAME', 'Qwen/Qwen-Image-Edit')  # 本地快照目录或 Hugging Face 仓库名
+    MODEL_REVISION = os.environ.get('MODEL_REVISION')  # 从仓库下载时固定的版本（提交哈希或标签）
+    MODEL_LOAD_WORKERS = int(os.environ.get('MODEL_LOAD_WORKERS', 4))  # 并行加载组件的线程数
+    # 推理工作线程使用的设备，逗号分隔（如 'cuda:0,cuda:1' 或 'cpu,cpu'），每个设备一个工作线程；
+    # 'auto' 表示每块 GPU 一个，为空时只使用 DEVICE
+    WORKER_DEVICES = os.environ.get('WORKER_DEVICES', '')
+    CPU_THREADS_PER_WORKER = int(os.environ.get('CPU_THREADS_PER_WORKER', 0))  # 0 表示使用 PyTorch 默认值
     DEVICE = os.environ.get('DEVICE', 'cuda')  # 'cuda' or 'cpu'
     TORCH_DTYPE = os.environ.get('TORCH_DTYPE', 'bfloat16')  # 'bfloat16' or 'float16' or 'float32'
+    # 执行配置：'fast'（全部常驻设备）、'balanced'（按组件换入换出）或 'lowmem'（按层换入换出并分块计算）
+    EXECUTION_PROFILE = os.environ.get('EXECUTION_PROFILE', 'fast').lower()
+    
+    # 分辨率分桶：输入图像对齐到宽高比最接近的桶（逗号分隔，如 '1:1,4:3,3:4,3:2,2:3,16:9,9:16'），为空时不分桶
+    RESOLUTION_BUCKETS = os.environ.get('RESOLUTION_BUCKETS', '')
+    # 分桶时的输出尺寸：'bucket'（桶的分辨率）、'aspect'（原图宽高比，与不分桶时一致）或 'original'（原始尺寸）
+    BUCKET_OUTPUT_SIZE = os.environ.get('BUCKET_OUTPUT_SIZE', 'aspect').lower()
+    # 用 torch.compile 编译的组件，逗号分隔（'transformer'、'vae'），为空时不编译；建议同时启用分桶
+    TORCH_COMPILE = os.environ.get('TORCH_COMPILE', '')
+    TORCH_COMPILE_MODE = os.environ.get('TORCH_COMPILE_MODE', 'default')  # 'default' / 'reduce-overhead' / 'max-autotune'
+    
+    EAGER_MODEL_LOAD = os.environ.get('EAGER_MODEL_LOAD', 'True').lower() == 'true'  # 启动时在后台加载模型
+    WARMUP_STEPS = int(os.environ.get('WARMUP_STEPS', 2))  # 加载后预热推理的步数，0 表示不预热
+    
+    # 生产服务（serve.py）：异步 HTTP 前端，模型只在每个设备一个的推理进程中加载
+    INFERENCE_PROCESS = os.environ.get('INFERENCE_PROCESS', 'False').lower() == 'true'  # serve.py 会启用
+    INFERENCE_SETUP = os.environ.get('INFERENCE_SETUP', '')  # 推理进程导入 app 后调用的函数（'模块:函数'）
+    FRONTEND_THREADS = int(os.environ.get('FRONTEND_THREADS', 32))  # 处理上传、状态查询和下载的线程数
+    FRONTEND_WAIT_THREADS = int(os.environ.get('FRONTEND_WAIT_THREADS', 256))  # 等待推理结果的同步请求和事件流的线程数
+    RESPONSE_BUFFER_MB = int(os.environ.get('RESPONSE_BUFFER_MB', 16))  # 每个响应在慢速客户端读取前可缓冲的大小
+    DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', 300))  # 关闭时等待已提交任务完成的最长时间（秒）
+    DRAIN_RETRY_AFTER = int(os.environ.get('DRAIN_RETRY_AFTER', 30))  # 关闭期间拒绝新任务时建议的重试等待（秒）
     
     # 默认参数
     DEFAULT_CFG_SCALE = float(os.environ.get('DEFAULT_CFG_SCALE', 4.0))
@@ -39,6 +91,55 @@ class Config:
     MIN_INFERENCE_STEPS = 10
     MAX_INFERENCE_STEPS = 100
     
+    # 输出图像编码配置
+    OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'png').lower()  # 'png' or 'webp' or 'jpeg'
+    PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', 6))  # 0-9，越大越小越慢
+    WEBP_QUALITY = int(os.environ.get('WEBP_QUALITY', 90))
+    JPEG_QUALITY = int(os.environ.get('JPEG_QUALITY', 95))
+    
+    # 任务队列配置
+    MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', 64))  # 0 表示不限制
+    JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 3600))
+    # 准入控制：排队和执行中任务的预计总耗时上限（秒，按实测每步耗时 × 推理步数估计），0 表示不限制
+    MAX_QUEUED_GPU_SECONDS = float(os.environ.get('MAX_QUEUED_GPU_SECONDS', 600))
+    
+    # 按API密钥调度：未在密钥上设置 priority 时使用的优先级（interactive / standard / bulk）
+    DEFAULT_KEY_PRIORITY = os.environ.get('DEFAULT_KEY_PRIORITY', 'standard')
+    
+    # 动态批处理配置（MAX_BATCH_SIZE 为 1 时关闭）
+    MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 1))
+    BATCH_WINDOW_MS = int(os.environ.get('BATCH_WINDOW_MS', 50))
+    
+    # 变体接口：每个请求最多生成的变体数，以及每次批量推理的变体数（受显存限制）
+    MAX_VARIATIONS = int(os.environ.get('MAX_VARIATIONS', 8))
+    VARIATION_BATCH_SIZE = int(os.environ.get('VARIATION_BATCH_SIZE', 4))
+    
+    # 进度预览：每隔多少步生成一次低分辨率预览，0 表示不生成（可由请求参数 preview_interval 覆盖）
+    PREVIEW_INTERVAL = int(os.environ.get('PREVIEW_INTERVAL', 0))
+    # 任务事件流 URL 中代替 API 密钥的令牌的有效期（秒）
+    EVENTS_TOKEN_TTL = int(os.environ.get('EVENTS_TOKEN_TTL', 600))
+    
+    # 结果缓存配置
+    RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'True').lower() == 'true'
+    RESULT_CACHE_FOLDER = os.environ.get('RESULT_CACHE_FOLDER', 'cache/results')
+    RESULT_CACHE_MEMORY_MB = int(os.environ.get('RESULT_CACHE_MEMORY_MB', 256))
+    RESULT_CACHE_DISK_MB = int(os.environ.get('RESULT_CACHE_DISK_MB', 2048))
+    
+    # 提示词嵌入缓存配置（默认关闭）
+    PROMPT_CACHE_ENABLED = os.environ.get('PROMPT_CACHE_ENABLED', 'False').lower() == 'true'
+    PROMPT_CACHE_MB = int(os.environ.get('PROMPT_CACHE_MB', 512))
+    PROMPT_CACHE_DEVICE = os.environ.get('PROMPT_CACHE_DEVICE', 'cpu')  # 'cpu' or 'device'
+    
+    # 输入图像缓存配置（缩放后的图像和 VAE 潜变量，0 表示不缓存）
+    IMAGE_CACHE_MB = int(os.environ.get('IMAGE_CACHE_MB', 512))
+    
+    # 请求追踪：把每个编辑请求的输入尺寸、参数、阶段耗时和结果追加到 JSONL 文件，用于离线重放（默认关闭）
+    TRACE_ENABLED = os.environ.get('TRACE_ENABLED', 'False').lower() == 'true'
+    TRACE_FILE = os.environ.get('TRACE_FILE', 'traces/requests.jsonl')
+    # 同时保存上传的图像（按内容哈希去重），否则重放时按记录的尺寸生成替代图像
+    TRACE_STORE_IMAGES = os.environ.get('TRACE_STORE_IMAGES', 'False').lower() == 'true'
+    TRACE_IMAGE_FOLDER = os.environ.get('TRACE_IMAGE_FOLDER', 'traces/images')
+    
     # 安全配置
     REQUIRE_API_KEY = os.environ.get('REQUIRE_API_KEY', 'True').lower() == 'true'
     
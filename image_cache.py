@@ -0,0 +1,173 @@
+"""
+输入图像缓存
+按上传内容哈希和目标分辨率缓存解码并缩放后的图像及其 VAE 潜变量，
+同一张图像多次编辑时跳过解码、缩放和 VAE 编码
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+from PIL import Image
+from diffusers.image_processor import VaeImageProcessor
+
+
+class PreparedImage:
+    """已预处理的输入图像
+
+    size 保持原始尺寸（启用分辨率分桶时为桶的宽高比），使管道按它计算出与 resized 一致的目标分辨率；
+    resized 为已缩放到目标分辨率的图像，由 PreparedImageProcessor 直接使用。
+    """
+
+    def __init__(self, size, resized, cache_key):
+        self.size = size
+        self.resized = resized
+        self.cache_key = cache_key
+
+
+class PreparedImageProcessor(VaeImageProcessor):
+    """识别 PreparedImage 的图像处理器，跳过重复缩放"""
+
+    def resize(self, image, height, width, resize_mode='default'):
+        if isinstance(image, list):
+            # 管道对图像列表不做缩放，这里逐张处理，使批量推理与单张推理一致
+            return [self.resize(i, height, width, resize_mode) for i in image]
+        if isinstance(image, PreparedImage):
+            image = image.resized
+        return super().resize(image, height, width, resize_mode)
+
+
+def resize_image(image, width, height):
+    """按管道默认的 lanczos 插值缩放图像"""
+    if image.size == (width, height):
+        return image
+    return image.resize((width, height), resample=Image.LANCZOS)
+
+
+class ImageCache:
+    """按 (图像哈希, 目标分辨率) 缓存缩放后的图像和 VAE 潜变量，按字节数 LRU 淘汰"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # 缓存键 -> {'image': PIL图像, 'latents': 张量或None}
+        self._size = 0
+        self._stats = {'image_hits': 0, 'image_misses': 0, 'latent_hits': 0, 'latent_misses': 0, 'evictions': 0}
+        self._active = threading.local()
+        self._inflight = {}  # 缓存键 -> {'event': 完成事件, 'image': 缩放后的图像（失败时为 None）}
+
+    def prepare(self, image_hash, original_size, target_size, decode):
+        """返回 PreparedImage；只有未命中时才调用 decode() 解码图像
+
+        并发请求同一图像时只解码一次，其余请求等待并直接使用其结果（即使结果随即被淘汰）。
+        """
+        key = (image_hash, target_size)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self._stats['image_hits'] += 1
+                    return PreparedImage(original_size, entry['image'], key)
+                inflight = self._inflight.get(key)
+                owner = inflight is None
+                if owner:
+                    inflight = self._inflight[key] = {'event': threading.Event(), 'image': None}
+                    self._stats['image_misses'] += 1
+            if not owner:
+                inflight['event'].wait()
+                if inflight['image'] is None:
+                    # 解码失败：重新检查，由下一个请求重试
+                    continue
+                with self._lock:
+                    self._stats['image_hits'] += 1
+                return PreparedImage(original_size, inflight['image'], key)
+            try:
+                resized = resize_image(decode(), *target_size)
+                inflight['image'] = resized
+                with self._lock:
+                    if key not in self._entries:
+                        self._entries[key] = {'image': resized, 'latents': None}
+                        self._size += self._entry_bytes(self._entries[key])
+                        self._evict()
+                return PreparedImage(original_size, resized, key)
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                inflight['event'].set()
+
+    @contextmanager
+    def activate(self, images):
+        """在管道调用期间登记当前批次图像对应的缓存键"""
+        self._active.keys = [image.cache_key if isinstance(image, PreparedImage) else None for image in images]
+        try:
+            yield
+        finally:
+            self._active.keys = None
+
+    def install(self, pipeline):
+        """替换管道的图像处理器和 VAE 编码方法"""
+        pipeline.image_processor = PreparedImageProcessor.from_config(pipeline.image_processor.config)
+        encode = pipeline._encode_vae_image
+
+        def cached_encode_vae_image(image, generator):
+            keys = getattr(self._active, 'keys', None)
+            if not keys or len(keys) != image.shape[0]:
+                return encode(image=image, generator=generator)
+            latents = []
+            encoded = {}  # 同一批中重复的图像（如同一张图像的多个变体）只编码一次
+            for i, key in enumerate(keys):
+                cached = encoded.get(key) if key is not None else None
+                if cached is None:
+                    cached = self._get_latents(key)
+                if cached is None:
+                    item_generator = generator[i] if isinstance(generator, list) else generator
+                    cached = encode(image=image[i:i + 1], generator=item_generator)
+                    self._put_latents(key, cached)
+                if key is not None:
+                    encoded[key] = cached
+                latents.append(cached.to(image.device))
+            return torch.cat(latents, dim=0)
+
+        pipeline._encode_vae_image = cached_encode_vae_image
+
+    def stats(self):
+        """缓存统计信息"""
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._size, limit_bytes=self.max_bytes)
+
+    def _get_latents(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            latents = entry['latents'] if entry is not None else None
+            if latents is None:
+                self._stats['latent_misses'] += 1
+            else:
+                self._entries.move_to_end(key)
+                self._stats['latent_hits'] += 1
+            return latents
+
+    def _put_latents(self, key, latents):
+        # 潜变量由 argmax 采样得到，与随机数生成器无关，可直接复用
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['latents'] is not None:
+                return
+            entry['latents'] = latents.detach().to('cpu')
+            self._size += latents.numel() * latents.element_size()
+            self._evict()
+
+    @staticmethod
+    def _entry_bytes(entry):
+        width, height = entry['image'].size
+        size = width * height * 3
+        if entry['latents'] is not None:
+            size += entry['latents'].numel() * entry['latents'].element_size()
+        return size
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= self._entry_bytes(entry)
+            self._stats['evictions'] += 1
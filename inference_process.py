@@ -0,0 +1,303 @@
+"""
+推理进程
+生产服务模式（serve.py）下每个设备的模型只由一个独立的推理进程加载和运行：
+前端进程负责 HTTP、排队、缓存和保存结果，通过进程间队列把推理请求交给推理进程。
+输入和输出图像的像素经共享内存传递，队列中只有提示词、参数和进度等小消息；
+推理进程中的进度、预览和各阶段耗时转发回前端，任务状态和指标与单进程模式一致
+"""
+
+import importlib
+import multiprocessing
+import os
+import queue
+import signal
+import traceback
+from contextlib import ExitStack
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+from jobs import Worker, WorkerLostError
+
+# 推理进程中覆盖的配置：只加载模型和执行推理，输出清理、请求追踪和结果缓存由前端进程负责
+PROCESS_ENVIRONMENT = {
+    'INFERENCE_PROCESS': 'False',
+    'EAGER_MODEL_LOAD': 'False',
+    'OUTPUT_GC_INTERVAL': '0',
+    'TRACE_ENABLED': 'False',
+    'RESULT_CACHE_ENABLED': 'False',
+}
+
+# 等待推理进程消息时检查其是否存活的间隔（秒）
+POLL_INTERVAL = 1.0
+
+
+def share_image(image):
+    """把图像像素复制到新建的共享内存中，返回 (共享内存, 可传给其他进程的描述)
+
+    创建方关闭自己的映射后共享内存仍然存在，由读取方在读取后删除。
+    """
+    data = image.tobytes()
+    memory = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    memory.buf[:len(data)] = data
+    return memory, (memory.name, image.mode, image.size, len(data))
+
+
+def read_image(descriptor, unlink=False):
+    """按描述从共享内存读取图像，unlink 为 True 时读取后删除共享内存"""
+    name, mode, size, length = descriptor
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        return Image.frombytes(mode, size, bytes(memory.buf[:length]))
+    finally:
+        memory.close()
+        if unlink:
+            memory.unlink()
+
+
+def discard_image(descriptor):
+    """删除不再读取的共享内存"""
+    try:
+        memory = shared_memory.SharedMemory(name=descriptor[0])
+    except FileNotFoundError:
+        return
+    memory.close()
+    memory.unlink()
+
+
+class InferenceProcess:
+    """前端进程中推理进程的代理：启动进程、转发推理请求并取回结果
+
+    同一时间只有一个推理请求（由所属的推理工作线程调用）。
+    """
+
+    def __init__(self, device, histograms, setup=None):
+        context = multiprocessing.get_context('spawn')
+        self.device = device
+        self._histograms = histograms  # app 中的属性名 -> 本进程的直方图，推理进程中的观测值在此重放
+        self._requests = context.Queue()
+        self._responses = context.Queue()
+        # 不设为守护进程：torch.compile 需要在推理进程中再启动编译子进程
+        self._process = context.Process(target=serve, name=f'inference-{device}',
+                                        args=(device, list(histograms), setup, self._requests, self._responses,
+                                              os.getpid()))
+        self._next_call = 0
+        self._memo = None
+        self._reset_peak = True
+        self.last_peak = None
+
+    @property
+    def alive(self):
+        return self._process.is_alive()
+
+    @property
+    def pid(self):
+        return self._process.pid
+
+    def start(self):
+        """启动推理进程并等待模型加载和预热完成，返回 (worker.info, 每步耗时)；失败时抛出 RuntimeError"""
+        self._process.start()
+        message = self._receive()
+        if message[0] == 'failed':
+            self._process.join()
+            raise RuntimeError(message[1])
+        _, info, seconds_per_unit, observations = message
+        self._replay(observations)
+        return info, seconds_per_unit
+
+    def reset_peak_memory(self):
+        """下一次推理前在推理进程中重置显存峰值统计"""
+        self._reset_peak = True
+
+    def generate(self, jobs, items, true_cfg_scale, num_inference_steps, size, extra=None, prompt_memo=None):
+        """在推理进程中执行一次（批量）推理，返回输出图像列表
+
+        参数与 app.run_pipeline 一致；jobs 接收进度和预览，size 为目标分辨率（用于生成预览）。
+        prompt_memo 为同一个对象的多次调用在推理进程中共享已编码的提示词。
+        """
+        self._next_call += 1
+        call_id = self._next_call
+        memo = None
+        if prompt_memo is not None:
+            memo = 'reuse' if prompt_memo is self._memo else 'new'
+            self._memo = prompt_memo
+        shared = []
+        indexes = {}  # id(PreparedImage) -> 在 images 中的位置，同一张输入图像只传递一次
+        images = []
+        payload = []
+        try:
+            for item in items:
+                image = item['image']
+                if id(image) not in indexes:
+                    memory, descriptor = share_image(image.resized)
+                    shared.append(memory)
+                    indexes[id(image)] = len(images)
+                    images.append({'hash': item['image_hash'], 'size': image.size,
+                                   'target': image.resized.size, 'pixels': descriptor})
+                payload.append({key: item[key] for key in ('prompt', 'negative_prompt', 'seed', 'image_hash')})
+                payload[-1]['image'] = indexes[id(image)]
+            self._requests.put((call_id, {
+                'items': payload,
+                'images': images,
+                'jobs': [{key: job.params[key] for key in ('num_inference_steps', 'preview_interval')}
+                         for job in jobs],
+                'true_cfg_scale': true_cfg_scale,
+                'num_inference_steps': num_inference_steps,
+                'size': size,
+                'extra': extra,
+                'memo': memo,
+                'reset_peak': self._reset_peak,
+            }))
+            self._reset_peak = False
+            while True:
+                message = self._receive()
+                kind, message_call = message[0], message[1]
+                if message_call != call_id:
+                    # 之前中断的请求遗留的消息
+                    if kind == 'result':
+                        for descriptor in message[2]:
+                            discard_image(descriptor)
+                    continue
+                if kind == 'progress':
+                    _, _, index, progress, preview = message
+                    jobs[index].update_progress(progress, preview)
+                elif kind == 'error':
+                    raise RuntimeError(message[2])
+                else:
+                    _, _, outputs, observations, peak = message
+                    self._replay(observations)
+                    self.last_peak = peak
+                    return [read_image(descriptor, unlink=True) for descriptor in outputs]
+        finally:
+            for memory in shared:
+                memory.close()
+                memory.unlink()
+
+    def stop(self, timeout=30.0):
+        """通知推理进程在当前请求完成后退出，超时后强制结束"""
+        if self._process.pid is None:
+            return
+        if self._process.is_alive():
+            self._requests.put(None)
+            self._process.join(timeout)
+        if self._process.is_alive():
+            # 推理进程忽略 SIGTERM，只能强制结束
+            print(f"Inference process on {self.device} did not exit, killing it")
+            self._process.kill()
+            self._process.join(5)
+        self._requests.close()
+        self._responses.close()
+
+    def _receive(self):
+        """等待推理进程的下一条消息；进程已退出时抛出 WorkerLostError"""
+        while True:
+            try:
+                return self._responses.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self._process.is_alive():
+                    continue
+            # 进程退出前发送的消息可能尚未读完
+            try:
+                return self._responses.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                raise WorkerLostError(f"Inference process on {self.device} exited "
+                                      f"with code {self._process.exitcode}")
+
+    def _replay(self, observations):
+        for name, recorded in observations.items():
+            histogram = self._histograms[name]
+            for labels, value in recorded:
+                histogram.observe(value, **labels)
+
+
+class _ProgressProxy:
+    """推理进程中代替任务对象接收进度，转发给前端进程"""
+
+    def __init__(self, responses, call_id, index, params):
+        self.params = params
+        self._responses = responses
+        self._call_id = call_id
+        self._index = index
+
+    def update_progress(self, progress, preview=None):
+        self._responses.put(('progress', self._call_id, self._index, progress, preview))
+
+
+def _recording(server, names):
+    """记录 app 中指定直方图在本线程的观测值，返回 (上下文, {名称: 观测值列表})"""
+    observations = {name: [] for name in names}
+    stack = ExitStack()
+    for name in names:
+        stack.enter_context(getattr(server, name).record(observations[name]))
+    return stack, observations
+
+
+def serve(device, histograms, setup, requests, responses, parent_pid):
+    """推理进程入口：加载模型，然后依次执行推理请求，收到 None 或前端进程退出时结束"""
+    # 终端的 Ctrl+C 和进程管理器的 SIGTERM 会发给整个进程组：只由前端进程处理，
+    # 推理进程在前端排空后收到 None 再退出，不会中断正在执行的推理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # 配置在导入 app 时读取，必须先设置环境变量
+    os.environ.update(PROCESS_ENVIRONMENT, WORKER_DEVICES=device)
+    import app as server
+    if setup:
+        module, _, function = setup.partition(':')
+        getattr(importlib.import_module(module), function)(server)
+
+    worker = Worker(0, device)
+    stack, observations = _recording(server, histograms)
+    try:
+        with stack:
+            server.load_pipeline(worker)
+    except Exception as e:
+        traceback.print_exc()
+        responses.put(('failed', f"Failed to load pipeline on {device}: {e}"))
+        return
+    responses.put(('ready', worker.info, worker.seconds_per_unit, observations))
+    print(f"Inference process {os.getpid()} ready on {device}")
+
+    pipe = worker.context['pipeline']
+    prompt_memo = {}
+    while True:
+        try:
+            message = requests.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            if os.getppid() != parent_pid:
+                print(f"Front-end process exited, stopping inference process {os.getpid()}")
+                return
+            continue
+        if message is None:
+            print(f"Inference process {os.getpid()} stopping")
+            return
+        call_id, request = message
+        if request['memo'] == 'new':
+            prompt_memo = {}
+        stack, observations = _recording(server, histograms)
+        try:
+            with stack:
+                images = [
+                    server.image_cache.prepare(ref['hash'], ref['size'], ref['target'],
+                                               lambda ref=ref: read_image(ref['pixels']))
+                    for ref in request['images']
+                ]
+                items = [dict(item, image=images[item['image']]) for item in request['items']]
+                jobs = [_ProgressProxy(responses, call_id, index, params)
+                        for index, params in enumerate(request['jobs'])]
+                callback = server.make_progress_callback(jobs, *request['size'], request['extra'])
+                if request['reset_peak']:
+                    server.reset_peak_memory(device)
+                output_images = server.run_pipeline(pipe, items, request['true_cfg_scale'],
+                                                    request['num_inference_steps'], callback,
+                                                    prompt_memo if request['memo'] else None)
+            peak = server.peak_memory(device)
+            outputs = []
+            for image in output_images:
+                memory, descriptor = share_image(image)
+                memory.close()
+                outputs.append(descriptor)
+        except Exception as e:
+            traceback.print_exc()
+            responses.put(('error', call_id, f"{type(e).__name__}: {e}"))
+            continue
+        responses.put(('result', call_id, outputs, observations, peak))
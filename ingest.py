@@ -0,0 +1,50 @@
+"""
+上传图像接收
+只读取文件头即可检查格式和尺寸，在解码前拒绝超大图像和解压炸弹；
+JPEG 使用 draft 模式直接以接近目标分辨率的缩小比例解码
+"""
+
+import io
+
+from PIL import Image, UnidentifiedImageError
+
+
+class ImageRejected(Exception):
+    """上传的图像不符合要求"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def open_image(image_bytes, allowed_formats, max_pixels, max_side):
+    """打开图像但不解码像素，检查格式和尺寸
+
+    像素数超过 Image.MAX_IMAGE_PIXELS 两倍时 PIL 在读取文件头时即抛出 DecompressionBombError；
+    警告被设置为错误时超过 Image.MAX_IMAGE_PIXELS 即抛出 DecompressionBombWarning。两者都按超出尺寸限制处理。
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+        raise ImageRejected(f"Image exceeds the limit of {max_pixels} pixels", status_code=413)
+    except (UnidentifiedImageError, OSError):
+        raise ImageRejected('Unrecognized image data')
+
+    if image.format not in allowed_formats:
+        raise ImageRejected(f"Unsupported image format: {image.format}")
+
+    width, height = image.size
+    if width <= 0 or height <= 0:
+        raise ImageRejected('Invalid image dimensions')
+    if max(width, height) > max_side or width * height > max_pixels:
+        raise ImageRejected(
+            f"Image dimensions {width}x{height} exceed the limit "
+            f"({max_side} px per side, {max_pixels} pixels)", status_code=413)
+    return image
+
+
+def decode_image(image, target_size, draft=True):
+    """解码为 RGB 图像；JPEG 按 draft 模式以不小于目标分辨率的最小比例解码"""
+    if draft and image.format == 'JPEG':
+        image.draft('RGB', target_size)
+    return image.convert("RGB")
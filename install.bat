@@ -33,6 +33,6 @@ echo 安装完成！
 echo.
 echo 使用方法:
 echo 1. 激活虚拟环境: activate.bat
-echo 2. 启动应用: python app.py
+echo 2. 启动应用: python serve.py
 echo.
 pause
@@ -45,5 +45,5 @@ echo "安装完成！"
 echo
 echo "使用方法:"
 echo "1. 激活虚拟环境: ./activate.sh 或 source venv/bin/activate"
-echo "2. 启动应用: python app.py"
+echo "2. 启动应用: python serve.py"
 echo
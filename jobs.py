@@ -0,0 +1,612 @@
+"""
+异步任务队列
+每个推理工作线程独占一个设备上的模型管道，按提交顺序处理图像编辑任务，
+并可在短时间窗口内把参数兼容的任务合并为一次批量推理；
+相同请求在执行期间只计算一次。多个工作线程时，新任务分派给预计等待最短的线程。
+排队任务按提交者（API密钥）加权公平排序，单个提交者的大量任务不会阻塞其他提交者。
+"""
+
+import threading
+import time
+import uuid
+from collections import deque
+
+
+class QueueFullError(Exception):
+    """任务队列已满：reason 为 'length'（排队任务数）或 'backlog'（预计耗时），
+    retry_after 为预计腾出空间所需的秒数"""
+
+    def __init__(self, message, reason='length', retry_after=None):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class WorkerLostError(Exception):
+    """处理函数抛出时工作线程立即失效，由监控线程重新启动（如推理进程意外退出）"""
+
+
+class Job:
+    """图像编辑任务"""
+
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = 'queued'  # queued / running / succeeded / failed
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.batch_key = None
+        self.batch_size = None
+        self.worker = None
+        self.dedupe_key = None
+        self.owner = None  # 提交者（如API密钥名称）
+        self.viewers = set()  # 可查询该任务的提交者（提交者和复用该任务的提交者）
+        self.tag = 0.0  # 加权公平排队的虚拟完成时间
+        self.subscribers = 1
+        self.progress = {}
+        self.preview = None
+        self.timings = {}  # 各阶段耗时（秒），由处理函数填写
+        self.version = 0
+        self._done = threading.Event()
+        self._updated = threading.Condition()
+        self._callbacks = []
+
+    def wait(self, timeout=None):
+        """等待任务完成"""
+        return self._done.wait(timeout)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def finish(self, result=None, error=None):
+        """标记任务完成"""
+        self.result = result
+        self.error = error
+        self.status = 'failed' if error is not None else 'succeeded'
+        self.finished_at = time.time()
+        with self._updated:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        self.touch()
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """任务完成后调用 callback(job)（在完成任务的线程中调用；已完成时立即调用）"""
+        with self._updated:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def touch(self):
+        """通知等待者任务状态已变化"""
+        with self._updated:
+            self.version += 1
+            self._updated.notify_all()
+
+    def update_progress(self, progress, preview=None):
+        """更新推理进度（由推理线程调用）"""
+        self.progress = progress
+        if preview is not None:
+            self.preview = preview
+        self.touch()
+
+    def wait_for_update(self, version, timeout=None):
+        """等待任务状态变化，返回最新版本号"""
+        with self._updated:
+            if self.version == version:
+                self._updated.wait(timeout)
+            return self.version
+
+    def to_dict(self):
+        """转换为可序列化的状态信息"""
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'batch_size': self.batch_size,
+            'worker': self.worker,
+            'subscribers': self.subscribers,
+            'progress': self.progress,
+            'error': self.error,
+        }
+
+
+class Worker:
+    """推理工作线程的状态：所在设备、待执行任务、吞吐估计和健康状况"""
+
+    def __init__(self, index, device=None):
+        self.index = index
+        self.device = device
+        self.state = 'starting'  # starting / idle / busy / dead
+        self.pending = deque()
+        self.running = []
+        self.running_started = None
+        self.seconds_per_unit = None  # 每单位任务成本（如每个推理步）耗时的滑动平均
+        self.context = {}  # 由处理函数使用，例如该设备上的模型管道
+        self.info = {}  # 由处理函数填写、随健康信息一起返回的附加信息
+        self.completed = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.restarts = 0
+        self.last_error = None
+        self.restart_at = None
+        self.thread = None
+
+    @property
+    def alive(self):
+        return self.state != 'dead'
+
+    def to_dict(self):
+        """转换为可序列化的健康信息"""
+        return {
+            'worker': self.index,
+            'device': self.device,
+            'state': self.state,
+            'queued': len(self.pending),
+            'running': len(self.running),
+            'seconds_per_unit': self.seconds_per_unit,
+            'completed': self.completed,
+            'failed': self.failed,
+            'restarts': self.restarts,
+            'last_error': self.last_error,
+            **self.info,
+        }
+
+
+class JobQueue:
+    """任务队列：请求线程提交任务，每个设备一个工作线程依次执行
+
+    handler(jobs, worker) 接收一批任务和执行它的 Worker，按顺序返回每个任务的结果字典。
+    on_start(worker) 在工作线程（重新）启动时调用，用于加载该设备上的模型。
+    提供 batch_key 且 max_batch_size > 1 时，工作线程取出一个任务后
+    最多等待 batch_window 秒，收集 batch_key 相同的任务一起执行。
+
+    新任务分派给预计等待时间最短的工作线程（排队任务的 cost 之和乘以该线程的实测速度），
+    空闲线程会从其他线程的队列末尾领取任务。处理函数抛出的异常只使这一批任务失败；
+    fatal(异常) 为 True 的异常（如 CUDA 上下文损坏）表示设备不可用，连续 max_failures 批
+    出现时工作线程视为失效。工作线程启动失败或处理函数抛出 WorkerLostError 时立即失效。
+    失效的工作线程由监控线程按退避间隔重新启动。
+
+    每个工作线程的队列按加权公平排队（自计时公平排队）排序：任务的虚拟完成时间为
+    max(当前虚拟时间, 同一提交者上一个任务的虚拟完成时间) + cost / weight(提交者)，
+    队首总是虚拟完成时间最小的任务。只有一个提交者时即为先进先出。
+    admit(提交者, 该提交者排队和执行中的任务数, 预计耗时秒数) 在任务入队前调用，
+    可抛出异常拒绝任务（如超出限额）。
+
+    max_size 限制排队任务数，max_backlog 限制全部排队和执行中任务的预计剩余耗时（秒，
+    按各线程实测的每单位成本耗时估计）；超出时抛出 QueueFullError。队列为空时总是接受任务。
+    """
+
+    def __init__(self, handler, max_size=0, retention=3600,
+                 batch_key=None, max_batch_size=1, batch_window=0.0,
+                 devices=None, on_start=None, cost=None, max_failures=3, health_interval=1.0,
+                 weight=None, admit=None, max_backlog=0, fatal=None):
+        self._handler = handler
+        self._max_size = max_size
+        self._max_backlog = max_backlog
+        self._retention = retention
+        self._batch_key = batch_key
+        self._max_batch_size = max(1, max_batch_size)
+        self._batch_window = batch_window
+        self._on_start = on_start
+        cost = cost or (lambda params: 1)
+        # 成本至少为 1：成本为 0 或负数的任务的虚拟完成时间不晚于当前虚拟时间，会一直排在其他提交者前面
+        self._cost = lambda params: max(1, cost(params))
+        self._weight = weight or (lambda owner: 1)
+        self._admit = admit
+        self._max_failures = max_failures
+        self._fatal = fatal or (lambda error: False)
+        self._health_interval = health_interval
+        self._workers = [Worker(i, device) for i, device in enumerate(devices or [None])]
+        self._jobs = {}
+        self._inflight = {}  # dedupe_key -> 排队或执行中的任务
+        self._virtual_time = 0.0  # 最近开始执行的任务的虚拟完成时间
+        self._last_tags = {}  # 提交者 -> 其最近提交任务的虚拟完成时间
+        self._cond = threading.Condition()
+        self._supervisor = None
+
+    def start(self):
+        """启动工作线程和监控线程（幂等）"""
+        with self._cond:
+            if self._supervisor is not None:
+                return
+            for worker in self._workers:
+                self._start_worker(worker)
+            self._supervisor = threading.Thread(target=self._supervise, name='worker-supervisor', daemon=True)
+            self._supervisor.start()
+
+    def _start_worker(self, worker):
+        """启动（或重新启动）工作线程（需持有锁）"""
+        worker.state = 'starting'
+        worker.context = {}
+        worker.info = {}
+        worker.consecutive_failures = 0
+        worker.restart_at = None
+        worker.thread = threading.Thread(target=self._run, args=(worker,),
+                                         name=f'inference-worker-{worker.index}', daemon=True)
+        worker.thread.start()
+
+    def submit(self, params, owner=None):
+        """提交任务，立即返回 Job"""
+        self.start()
+        with self._cond:
+            return self._enqueue(params, owner)
+
+    def submit_shared(self, dedupe_key, params, owner=None):
+        """提交任务；相同 dedupe_key 的任务仍在排队或执行时直接复用它
+
+        复用的任务不计入 owner 的并发数和限额。返回 (Job, 是否复用了已有任务)
+        """
+        self.start()
+        with self._cond:
+            job = self._inflight.get(dedupe_key)
+            if job is not None:
+                job.subscribers += 1
+                job.viewers.add(owner)
+                return job, True
+            job = self._enqueue(params, owner)
+            job.dedupe_key = dedupe_key
+            self._inflight[dedupe_key] = job
+            return job, False
+
+    def check_admission(self, params, dedupe_key=None):
+        """检查队列能否接受任务（不入队），不能时抛出 QueueFullError
+
+        用于在准备任务输入（如解码图像）之前尽早拒绝请求；相同 dedupe_key 的任务
+        正在排队或执行时会直接复用，不占用队列。
+        """
+        with self._cond:
+            if dedupe_key is not None and dedupe_key in self._inflight:
+                return
+            self._check_capacity(params)
+
+    def _check_capacity(self, params):
+        """排队任务数和预计耗时超出上限时抛出 QueueFullError（需持有锁）"""
+        now = time.monotonic()
+        alive = [worker for worker in self._workers if worker.alive] or self._workers
+        backlog = sum(self._estimated_wait(worker, now) for worker in alive)
+        pending = self._pending_count()
+        if self._max_size and pending >= self._max_size:
+            # 平均每个排队任务的耗时即约为腾出一个位置的时间
+            raise QueueFullError('Job queue is full', 'length', backlog / pending / len(alive))
+        if self._max_backlog:
+            # 队列为空时也检查：单个超出上限的任务同样拒绝
+            cost = self._cost(params) * self._default_seconds_per_unit()
+            excess = backlog + cost - self._max_backlog
+            if excess > 0:
+                raise QueueFullError(
+                    f"Job queue is full ({backlog:.0f}s of estimated work queued and {cost:.0f}s for this job, "
+                    f"the limit is {self._max_backlog:.0f}s)",
+                    'backlog', excess / len(alive))
+
+    def backlog(self):
+        """全部排队和执行中任务的预计剩余耗时（秒）"""
+        with self._cond:
+            now = time.monotonic()
+            alive = [worker for worker in self._workers if worker.alive] or self._workers
+            return sum(self._estimated_wait(worker, now) for worker in alive)
+
+    def _enqueue(self, params, owner=None):
+        """创建任务并分派给预计等待最短的工作线程（需持有锁）"""
+        self._check_capacity(params)
+        worker = self._choose_worker()
+        cost = self._cost(params)
+        if self._admit is not None:
+            rate = worker.seconds_per_unit or self._default_seconds_per_unit()
+            self._admit(owner, self._owner_jobs(owner), cost * rate)
+        self._prune()
+        job = Job(params)
+        job.owner = owner
+        job.viewers.add(owner)
+        job.tag = max(self._virtual_time, self._last_tags.get(owner, 0.0)) + cost / self._weight(owner)
+        self._last_tags[owner] = job.tag
+        if self._batch_key is not None and self._max_batch_size > 1:
+            job.batch_key = self._batch_key(params)
+        job.worker = worker.index
+        self._jobs[job.id] = job
+        self._insert(worker, job)
+        self._cond.notify_all()
+        return job
+
+    def _insert(self, worker, job):
+        """按虚拟完成时间把任务插入工作线程的队列（需持有锁）"""
+        index = len(worker.pending)
+        while index > 0 and worker.pending[index - 1].tag > job.tag:
+            index -= 1
+        worker.pending.insert(index, job)
+
+    def _owner_jobs(self, owner):
+        """提交者排队和执行中的任务数（需持有锁）"""
+        return sum(1 for worker in self._workers for job in (*worker.pending, *worker.running)
+                   if job.owner == owner)
+
+    def _choose_worker(self):
+        """预计等待最短的工作线程；全部失效时选择最先重启的一个（需持有锁）"""
+        now = time.monotonic()
+        alive = [worker for worker in self._workers if worker.alive]
+        if not alive:
+            return min(self._workers, key=lambda worker: worker.restart_at or 0)
+        # 已就绪的线程优先于仍在加载模型的线程
+        return min(alive, key=lambda worker: (worker.state == 'starting', self._estimated_wait(worker, now)))
+
+    def _default_seconds_per_unit(self):
+        known = [worker.seconds_per_unit for worker in self._workers if worker.seconds_per_unit is not None]
+        return sum(known) / len(known) if known else 1.0
+
+    def _estimated_wait(self, worker, now):
+        """工作线程处理完当前批次和排队任务的预计耗时（秒，需持有锁）"""
+        rate = worker.seconds_per_unit or self._default_seconds_per_unit()
+        wait = sum(self._cost(job.params) for job in worker.pending) * rate
+        if worker.running:
+            batch_cost = max(self._cost(job.params) for job in worker.running)
+            wait += max(0.0, batch_cost * rate - (now - worker.running_started))
+        return wait
+
+    def estimated_wait(self):
+        """新任务的预计等待时间（秒）"""
+        with self._cond:
+            now = time.monotonic()
+            alive = [worker for worker in self._workers if worker.alive] or self._workers
+            return min(self._estimated_wait(worker, now) for worker in alive)
+
+    def add_completed(self, params, result, owner=None):
+        """登记一个无需推理、已有结果的任务（如缓存命中）"""
+        with self._cond:
+            self._prune()
+            job = Job(params)
+            job.owner = owner
+            job.viewers.add(owner)
+            job.started_at = job.created_at
+            job.finish(result=result)
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        """按ID获取任务"""
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def position(self, job):
+        """任务在所属工作线程队列中的位置（0 表示下一个执行），不在队列中返回 None"""
+        with self._cond:
+            for worker in self._workers:
+                try:
+                    return worker.pending.index(job)
+                except ValueError:
+                    continue
+            return None
+
+    def workers(self):
+        """各工作线程的健康信息"""
+        with self._cond:
+            return [worker.to_dict() for worker in self._workers]
+
+    def owners(self):
+        """各提交者排队和执行中的任务数：{提交者: {'queued': n, 'running': n}}"""
+        with self._cond:
+            counts = {}
+            for worker in self._workers:
+                for state, jobs in (('queued', worker.pending), ('running', worker.running)):
+                    for job in jobs:
+                        entry = counts.setdefault(job.owner, {'queued': 0, 'running': 0})
+                        entry[state] += 1
+            return counts
+
+    def owner_jobs(self, owner):
+        """提交者排队和执行中的任务数"""
+        with self._cond:
+            return self._owner_jobs(owner)
+
+    def wait_idle(self, timeout=None):
+        """等待全部排队和执行中的任务完成，超时返回 False（用于关闭前排空队列）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending_count() or any(worker.running for worker in self._workers):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def __len__(self):
+        with self._cond:
+            return self._pending_count()
+
+    def _pending_count(self):
+        return sum(len(worker.pending) for worker in self._workers)
+
+    def _prune(self):
+        """清理超过保留时间的已完成任务"""
+        cutoff = time.time() - self._retention
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.done and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+        # 虚拟完成时间不晚于当前虚拟时间的提交者与新提交者没有区别
+        idle = [owner for owner, tag in self._last_tags.items() if tag <= self._virtual_time]
+        for owner in idle:
+            del self._last_tags[owner]
+
+    def _steal(self, worker):
+        """从排队最长的忙碌或失效线程末尾领取一个任务（需持有锁）"""
+        victims = [other for other in self._workers
+                   if other is not worker and other.pending and other.state != 'idle']
+        if not victims:
+            return False
+        victim = max(victims, key=lambda other: len(other.pending))
+        job = victim.pending.pop()
+        job.worker = worker.index
+        worker.pending.append(job)
+        return True
+
+    def _take_batch(self, worker):
+        """取出下一批任务并标记为执行中（需持有锁）
+
+        第一个任务在等待批次窗口之前即计入执行中，等待期间 wait_idle、预计耗时和准入检查不会漏掉它。
+        """
+        first = worker.pending.popleft()
+        batch = [first]
+        self._virtual_time = max(self._virtual_time, first.tag)
+        worker.state = 'busy'
+        worker.running = batch
+        worker.running_started = time.monotonic()
+        self._mark_running(worker, batch)
+        if worker.pending:
+            # 空闲线程只从忙碌的线程领取任务：唤醒它们领取剩下的任务
+            self._cond.notify_all()
+        if first.batch_key is not None:
+            deadline = time.monotonic() + self._batch_window
+            while len(batch) < self._max_batch_size:
+                for job in list(worker.pending):
+                    if job.batch_key == first.batch_key:
+                        worker.pending.remove(job)
+                        batch.append(job)
+                        if len(batch) >= self._max_batch_size:
+                            break
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self._max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            # 实测速度只计入推理耗时，不含等待批次窗口的时间
+            worker.running_started = time.monotonic()
+        self._mark_running(worker, batch)
+        return batch
+
+    def _mark_running(self, worker, batch):
+        """把任务标记为执行中（需持有锁）"""
+        now = time.time()
+        for job in batch:
+            if job.started_at is None:
+                job.started_at = now
+            job.status = 'running'
+            job.batch_size = len(batch)
+            job.worker = worker.index
+            job.touch()
+
+    def _run(self, worker):
+        try:
+            if self._on_start is not None:
+                self._on_start(worker)
+        except Exception as e:
+            self._worker_died(worker, f"Worker failed to start: {e}")
+            return
+
+        with self._cond:
+            worker.state = 'idle'
+            self._cond.notify_all()
+        while True:
+            with self._cond:
+                while not worker.pending and not self._steal(worker):
+                    self._cond.wait()
+                batch = self._take_batch(worker)
+            error = None
+            lost = False
+            fatal = False
+            try:
+                results = self._handler(batch, worker)
+            except Exception as e:
+                results = None
+                error = str(e)
+                lost = isinstance(e, WorkerLostError)
+                fatal = lost or self._fatal(e)
+            if results is None:
+                for job in batch:
+                    job.finish(error=error)
+            else:
+                for job, result in zip(batch, results):
+                    job.finish(result=result)
+            with self._cond:
+                self._batch_finished(worker, batch, error, fatal)
+                # 唤醒 wait_idle
+                self._cond.notify_all()
+                for job in batch:
+                    self._forget_inflight(job)
+                if lost or worker.consecutive_failures >= self._max_failures:
+                    break
+        if not lost:
+            error = f"Worker failed {worker.consecutive_failures} batches in a row: {error}"
+        self._worker_died(worker, error)
+
+    def _batch_finished(self, worker, batch, error, fatal=False):
+        """更新工作线程的统计和速度估计（需持有锁）
+
+        只有 fatal 的失败计入连续失败次数；普通错误（如无效输入）只使这一批任务失败。
+        """
+        elapsed = time.monotonic() - worker.running_started
+        worker.running = []
+        worker.running_started = None
+        worker.state = 'idle'
+        if error is not None:
+            worker.failed += len(batch)
+            worker.last_error = error
+            if fatal:
+                worker.consecutive_failures += 1
+            return
+        worker.completed += len(batch)
+        worker.consecutive_failures = 0
+        cost = max(self._cost(job.params) for job in batch)
+        if cost > 0:
+            rate = elapsed / cost
+            worker.seconds_per_unit = rate if worker.seconds_per_unit is None else 0.8 * worker.seconds_per_unit + 0.2 * rate
+
+    def _worker_died(self, worker, error):
+        """工作线程失效（由该线程在退出前调用）"""
+        print(f"Inference worker {worker.index} ({worker.device}) died: {error}")
+        with self._cond:
+            self._mark_dead(worker, error)
+
+    def _mark_dead(self, worker, error):
+        """标记工作线程失效，把它的排队任务转给其他线程；没有可用线程时任务直接失败（需持有锁）"""
+        worker.state = 'dead'
+        worker.last_error = error
+        worker.context = {}
+        worker.restart_at = time.monotonic() + min(60.0, 2.0 ** worker.restarts)
+        # 线程意外退出时正在执行的任务不会再完成
+        for job in worker.running:
+            # 相同的请求不能再复用已失败的任务
+            self._forget_inflight(job)
+            if not job.done:
+                job.finish(error=error)
+        worker.running = []
+        orphaned = list(worker.pending)
+        worker.pending.clear()
+        alive = [other for other in self._workers if other.alive]
+        for job in orphaned:
+            if alive:
+                target = min(alive, key=lambda other: self._estimated_wait(other, time.monotonic()))
+                job.worker = target.index
+                self._insert(target, job)
+            else:
+                self._forget_inflight(job)
+                job.finish(error=error)
+        self._cond.notify_all()
+
+    def _forget_inflight(self, job):
+        """任务结束后不再供相同 dedupe_key 的提交复用（需持有锁）"""
+        if job.dedupe_key is not None and self._inflight.get(job.dedupe_key) is job:
+            del self._inflight[job.dedupe_key]
+
+    def _supervise(self):
+        """监控线程：按退避间隔重新启动失效的工作线程"""
+        while True:
+            time.sleep(self._health_interval)
+            with self._cond:
+                now = time.monotonic()
+                for worker in self._workers:
+                    if worker.state == 'dead' and worker.thread is not None and worker.thread.is_alive():
+                        continue
+                    if worker.state == 'dead' and now >= worker.restart_at:
+                        worker.restarts += 1
+                        print(f"Restarting inference worker {worker.index} ({worker.device})")
+                        self._start_worker(worker)
+                    elif worker.state != 'dead' and not worker.thread.is_alive():
+                        print(f"Inference worker {worker.index} ({worker.device}) exited unexpectedly")
+                        self._mark_dead(worker, 'Worker thread exited unexpectedly')
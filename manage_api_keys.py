@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 API密钥管理工具
-用于生成、列出和删除API密钥
+用于生成、列出和删除API密钥，以及设置密钥的调度优先级和限额
 """
 
 import json
@@ -11,7 +11,12 @@ import hashlib
 import uuid
 from datetime import datetime
 
-API_KEYS_FILE = 'api_keys.json'
+from api_key_store import key_file_lock, write_key_file
+from config import Config
+from scheduling import KEY_ATTRIBUTES, DEFAULT_PRIORITY, parse_key_attribute
+
+# 与服务使用同一个密钥文件；修改时持有文件锁，服务写回 last_used 时不会覆盖修改
+API_KEYS_FILE = Config.API_KEYS_FILE
 
 def load_api_keys():
     """加载API密钥"""
@@ -21,9 +26,8 @@ def load_api_keys():
     return {}
 
 def save_api_keys(api_keys):
-    """保存API密钥"""
-    with open(API_KEYS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(api_keys, f, indent=2, ensure_ascii=False)
+    """保存API密钥（需持有 key_file_lock）"""
+    write_key_file(API_KEYS_FILE, api_keys)
 
 def generate_api_key():
     """生成新的API密钥"""
@@ -31,8 +35,6 @@ def generate_api_key():
 
 def create_api_key(name=None):
     """创建新的API密钥"""
-    api_keys = load_api_keys()
-    
     if name is None:
         name = input("请输入API密钥名称: ").strip()
     
@@ -40,18 +42,19 @@ def create_api_key(name=None):
         print("❌ 错误: API密钥名称不能为空")
         return
     
-    if name in api_keys:
-        print(f"❌ 错误: 名称 '{name}' 已存在")
-        return
-    
-    api_key = generate_api_key()
-    api_keys[name] = {
-        'key': api_key,
-        'created_at': datetime.now().isoformat(),
-        'last_used': None
-    }
-    
-    save_api_keys(api_keys)
+    with key_file_lock(API_KEYS_FILE):
+        api_keys = load_api_keys()
+        if name in api_keys:
+            print(f"❌ 错误: 名称 '{name}' 已存在")
+            return
+        
+        api_key = generate_api_key()
+        api_keys[name] = {
+            'key': api_key,
+            'created_at': datetime.now().isoformat(),
+            'last_used': None
+        }
+        save_api_keys(api_keys)
     print(f"✅ 成功创建API密钥:")
     print(f"   名称: {name}")
     print(f"   密钥: {api_key}")
@@ -74,8 +77,47 @@ def list_api_keys():
         print(f"密钥: {masked_key}")
         print(f"创建时间: {info['created_at']}")
         print(f"最后使用: {info.get('last_used', '从未使用')}")
+        print(f"调度: {format_schedule(info)}")
         print("-" * 80)
 
+def format_schedule(info):
+    """密钥调度属性的简要说明"""
+    parts = [f"priority={info.get('priority') or DEFAULT_PRIORITY}"]
+    for attribute in KEY_ATTRIBUTES[1:]:
+        parts.append(f"{attribute}={info.get(attribute) or '不限'}")
+    return ', '.join(parts)
+
+def set_api_key_attributes(name, assignments):
+    """设置API密钥的调度属性（属性=值，值为 none 时删除该属性）"""
+    if not assignments:
+        print(f"❌ 错误: 请指定要设置的属性，可选: {', '.join(KEY_ATTRIBUTES)}")
+        return
+    
+    updates = {}
+    for assignment in assignments:
+        attribute, _, value = assignment.partition('=')
+        try:
+            if not value:
+                raise ValueError(f"Expected {attribute}=<value>")
+            updates[attribute] = parse_key_attribute(attribute, value)
+        except ValueError as e:
+            print(f"❌ 错误: {e}")
+            return
+    
+    with key_file_lock(API_KEYS_FILE):
+        api_keys = load_api_keys()
+        if name not in api_keys:
+            print(f"❌ 错误: 名称 '{name}' 不存在")
+            return
+        for attribute, value in updates.items():
+            if value is None:
+                api_keys[name].pop(attribute, None)
+            else:
+                api_keys[name][attribute] = value
+        save_api_keys(api_keys)
+    print(f"✅ 已更新API密钥 '{name}' 的调度属性:")
+    print(f"   {format_schedule(api_keys[name])}")
+
 def delete_api_key(name=None):
     """删除API密钥"""
     api_keys = load_api_keys()
@@ -100,8 +142,13 @@ def delete_api_key(name=None):
     
     confirm = input(f"确认要删除API密钥 '{name}' 吗? (y/N): ").strip().lower()
     if confirm in ['y', 'yes']:
-        del api_keys[name]
-        save_api_keys(api_keys)
+        # 确认期间文件可能已被修改，在锁内重新读取
+        with key_file_lock(API_KEYS_FILE):
+            api_keys = load_api_keys()
+            if api_keys.pop(name, None) is None:
+                print(f"❌ 错误: 名称 '{name}' 不存在")
+                return
+            save_api_keys(api_keys)
         print(f"✅ 成功删除API密钥: {name}")
     else:
         print("❌ 取消删除操作")
@@ -118,12 +165,19 @@ def show_help():
     create [名称]     - 创建新的API密钥
     list              - 列出所有API密钥
     delete [名称]     - 删除指定的API密钥
+    set <名称> <属性>=<值> ...
+                      - 设置密钥的调度属性（值为 none 时恢复默认）:
+                        priority                优先级: interactive / standard / bulk
+                        requests_per_minute     每分钟请求数
+                        gpu_seconds_per_minute  每分钟预计推理秒数
+                        max_concurrency         同时排队和执行的任务数
     help              - 显示此帮助信息
 
 示例:
     python manage_api_keys.py create my_key
     python manage_api_keys.py list
     python manage_api_keys.py delete my_key
+    python manage_api_keys.py set batch_client priority=bulk gpu_seconds_per_minute=600 max_concurrency=4
 
 注意:
     - API密钥用于访问图像编辑API
@@ -146,6 +200,11 @@ def main():
     elif command == 'delete':
         name = sys.argv[2] if len(sys.argv) > 2 else None
         delete_api_key(name)
+    elif command == 'set':
+        if len(sys.argv) < 3:
+            print("❌ 错误: 请指定API密钥名称")
+            return
+        set_api_key_attributes(sys.argv[2], sys.argv[3:])
     elif command == 'help':
         show_help()
     else:
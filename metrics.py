@@ -0,0 +1,301 @@
+"""
+运行指标
+计数器、仪表和直方图，以 Prometheus 文本格式导出；
+并为模型管道内部的文本编码、VAE 编码、去噪步和 VAE 解码计时
+"""
+
+import math
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 默认直方图分桶（秒），覆盖从毫秒级的编码到分钟级的推理
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """带标签的指标基类"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda item: [str(v) for _, v in item[0]])
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可任意设置的仪表；也可以在导出时调用函数取值"""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self._function is not None:
+            value = self._function()
+            if self.labelnames:
+                # 带标签时函数返回 [(标签字典, 值), ...]
+                with self._lock:
+                    self._values = {}
+                for labels, item in value:
+                    self.set(item, **labels)
+            else:
+                self.set(value)
+        return super().render()
+
+
+class Histogram(_Metric):
+    """累积分桶的直方图"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._collectors = threading.local()
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+        sinks = getattr(self._collectors, 'sinks', ())
+        if sinks:
+            name = labels[self.labelnames[0]] if self.labelnames else self.name
+            for sink in sinks:
+                sink[name] = sink.get(name, 0.0) + value
+        for recorder in getattr(self._collectors, 'recorders', ()):
+            recorder.append((labels, value))
+
+    @contextmanager
+    def collect(self, *sinks):
+        """在 with 块内把本线程的观测值按第一个标签累加到 sinks 字典中（如单个请求的各阶段耗时）
+
+        为 None 的 sink 会被忽略。
+        """
+        previous = getattr(self._collectors, 'sinks', ())
+        self._collectors.sinks = previous + tuple(sink for sink in sinks if sink is not None)
+        try:
+            yield
+        finally:
+            self._collectors.sinks = previous
+
+    @contextmanager
+    def record(self, observations):
+        """在 with 块内把本线程的每个观测值以 (标签字典, 值) 追加到 observations 列表中
+
+        用于在推理进程中记录观测值，再在前端进程中用 observe 重放。
+        """
+        previous = getattr(self._collectors, 'recorders', ())
+        self._collectors.recorders = previous + (observations,)
+        try:
+            yield
+        finally:
+            self._collectors.recorders = previous
+
+    @contextmanager
+    def time(self, **labels):
+        """记录 with 块的耗时（秒）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                labels = key + (('le', _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {state['count']}")
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus 文本格式"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _is_cuda(device):
+    return torch.cuda.is_available() and (device is None or str(device).startswith('cuda'))
+
+
+def synchronize():
+    """等待 GPU 上已提交的计算完成，使阶段耗时对应实际执行时间"""
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def reset_peak_memory(device=None):
+    """重置显存峰值统计"""
+    if _is_cuda(device):
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_rss_bytes():
+    """进程常驻内存峰值（字节），不支持时返回 0"""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 上 ru_maxrss 的单位为字节，Linux 上为 KB
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def peak_memory(device=None):
+    """返回 (设备, 峰值字节数)
+
+    使用 GPU 时为上次 reset_peak_memory 之后的显存峰值；
+    否则为进程的常驻内存峰值（无法按请求重置），不支持时返回 None。
+    """
+    if _is_cuda(device):
+        return str(device or 'cuda'), torch.cuda.max_memory_allocated(device)
+    if resource is None:
+        return None
+    return 'host', peak_rss_bytes()
+
+
+class PipelineTimer:
+    """为管道内部的各阶段计时
+
+    通过替换管道实例上的方法记录文本编码、VAE 编码和 VAE 解码的耗时；
+    去噪阶段从 prepare_latents 返回开始，每步耗时由步进回调调用 step() 记录。
+    """
+
+    def __init__(self, stage_seconds, step_seconds):
+        self.stage_seconds = stage_seconds
+        self.step_seconds = step_seconds
+        self._state = threading.local()
+
+    def install(self, pipeline):
+        """替换管道的相关方法（在 ImageCache.install 之后调用，使缓存命中也计入 VAE 编码耗时）"""
+        pipeline.encode_prompt = self._timed(pipeline.encode_prompt, 'prompt_encode')
+        pipeline._encode_vae_image = self._timed(pipeline._encode_vae_image, 'vae_encode')
+        pipeline.vae.decode = self._timed(pipeline.vae.decode, 'vae_decode', end_denoise=True)
+        prepare_latents = pipeline.prepare_latents
+
+        def timed_prepare_latents(*args, **kwargs):
+            result = prepare_latents(*args, **kwargs)
+            synchronize()
+            self._state.denoise_started = self._state.last_step = time.perf_counter()
+            return result
+
+        pipeline.prepare_latents = timed_prepare_latents
+
+    def step(self):
+        """记录一个去噪步的耗时（由步进回调调用）"""
+        last = getattr(self._state, 'last_step', None)
+        if last is None:
+            return
+        synchronize()
+        now = time.perf_counter()
+        self.step_seconds.observe(now - last)
+        self._state.last_step = now
+
+    def _timed(self, method, stage, end_denoise=False):
+        def timed(*args, **kwargs):
+            synchronize()
+            started = time.perf_counter()
+            denoise_started = getattr(self._state, 'denoise_started', None)
+            if end_denoise and denoise_started is not None:
+                self.stage_seconds.observe(started - denoise_started, stage='denoise')
+                self._state.denoise_started = self._state.last_step = None
+            result = method(*args, **kwargs)
+            synchronize()
+            self.stage_seconds.observe(time.perf_counter() - started, stage=stage)
+            return result
+        return timed
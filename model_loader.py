@@ -0,0 +1,224 @@
+"""
+模型加载
+从固定版本的本地快照目录并行加载管道各组件，直接以目标精度读取
+（safetensors 分片通过内存映射读取，不会先构建全精度副本），并记录各组件的加载耗时；
+按执行配置在速度和显存占用之间取舍
+"""
+
+import importlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from metrics import peak_rss_bytes
+
+TORCH_DTYPES = {
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+    'float32': torch.float32,
+}
+
+# 执行配置：模型常驻设备还是按需从内存换入，以及 VAE / 注意力的分块计算
+# - fast: 全部组件常驻设备，速度最快、显存占用最大
+# - balanced: 按组件在内存和设备间换入换出（model CPU offload）
+# - lowmem: 按层换入换出（sequential CPU offload），并分块计算注意力和 VAE
+EXECUTION_PROFILES = {
+    'fast': {'offload': None, 'attention_slicing': False, 'vae_slicing': False, 'vae_tiling': False},
+    'balanced': {'offload': 'model', 'attention_slicing': False, 'vae_slicing': False, 'vae_tiling': False},
+    'lowmem': {'offload': 'sequential', 'attention_slicing': True, 'vae_slicing': True, 'vae_tiling': True},
+}
+
+# torch.compile 可编译的组件 -> 编译的模块：管道调用的是 VAE 的 encode/decode 而不是 forward，
+# 因此编译其编码器和解码器
+COMPILE_TARGETS = {
+    'transformer': ('transformer',),
+    'vae': ('vae.encoder', 'vae.decoder'),
+}
+
+
+def resolve_snapshot(model_name, revision=None):
+    """返回模型快照的本地目录
+
+    model_name 为本地目录时直接使用；否则视为 Hugging Face 仓库名，
+    下载（或复用已缓存的）指定 revision 的快照。
+    """
+    if os.path.isdir(model_name):
+        return model_name
+    from huggingface_hub import snapshot_download
+    return snapshot_download(model_name, revision=revision)
+
+
+def _load_component(snapshot, name, library, class_name, dtype, device):
+    """加载单个组件，返回 (组件, 报告)"""
+    started = time.perf_counter()
+    component_class = getattr(importlib.import_module(library), class_name)
+    path = os.path.join(snapshot, name)
+    if issubclass(component_class, torch.nn.Module):
+        component = component_class.from_pretrained(path, torch_dtype=dtype)
+        # from_pretrained 通过 torch.set_default_dtype 等全局状态控制精度，并行加载时
+        # 可能互相干扰，发现精度不一致的张量时再统一转换一次
+        tensors = itertools.chain(component.parameters(), component.buffers())
+        if any(t.is_floating_point() and t.dtype != dtype for t in tensors):
+            component.to(dtype=dtype)
+        if device is not None:
+            component.to(device)
+        size = sum(p.numel() * p.element_size() for p in component.parameters())
+    else:
+        # 调度器、分词器和图像处理器没有权重
+        component = component_class.from_pretrained(path)
+        size = 0
+    return component, {
+        'component': name,
+        'class': class_name,
+        'seconds': round(time.perf_counter() - started, 3),
+        'bytes': size,
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def load_components(snapshot, dtype, device=None, max_workers=4):
+    """按 model_index.json 并行加载管道的全部组件
+
+    返回 (组件字典, 报告列表)
+    """
+    with open(os.path.join(snapshot, 'model_index.json'), 'r', encoding='utf-8') as f:
+        index = json.load(f)
+
+    components, futures = {}, {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='model-load') as executor:
+        for name, spec in index.items():
+            if name.startswith('_') or not isinstance(spec, list):
+                continue
+            library, class_name = spec
+            if library is None or class_name is None:
+                components[name] = None
+                continue
+            futures[name] = executor.submit(_load_component, snapshot, name, library, class_name, dtype, device)
+        reports = []
+        for name, future in futures.items():
+            components[name], report = future.result()
+            reports.append(report)
+    return components, reports
+
+
+def load_pipeline_from_snapshot(pipeline_class, model_name, revision=None, torch_dtype='bfloat16',
+                                device=None, max_workers=4):
+    """从本地快照构建管道，返回 (管道, 加载报告)"""
+    started = time.perf_counter()
+    snapshot = resolve_snapshot(model_name, revision)
+    resolved = time.perf_counter()
+    dtype = TORCH_DTYPES[torch_dtype]
+    components, reports = load_components(snapshot, dtype, device, max_workers)
+    # 全部组件已加载，from_pretrained 只读取管道配置
+    pipeline = pipeline_class.from_pretrained(snapshot, torch_dtype=dtype, **components)
+    report = {
+        'snapshot': snapshot,
+        'dtype': torch_dtype,
+        'device': device,
+        'resolve_seconds': round(resolved - started, 3),
+        'total_seconds': round(time.perf_counter() - started, 3),
+        'peak_rss_bytes': peak_rss_bytes(),
+        'components': reports,
+    }
+    return pipeline, report
+
+
+def format_load_report(report):
+    """把加载报告格式化为便于阅读的多行文本"""
+    mb = 1024 * 1024
+    lines = [f"Model snapshot: {report['snapshot']} ({report['dtype']}, {report['device']})"]
+    for item in sorted(report['components'], key=lambda item: -item['seconds']):
+        lines.append(f"  {item['component']:<16} {item['class']:<40} {item['seconds']:>8.2f}s "
+                     f"{item['bytes'] / mb:>10.1f} MB  peak RSS {item['peak_rss_bytes'] / mb:>10.1f} MB")
+    lines.append(f"  resolve {report['resolve_seconds']:.2f}s, total {report['total_seconds']:.2f}s, "
+                 f"peak RSS {report['peak_rss_bytes'] / mb:.1f} MB")
+    return '\n'.join(lines)
+
+
+def _get_profile(profile):
+    if profile not in EXECUTION_PROFILES:
+        raise ValueError(f"Unknown execution profile: {profile}, expected one of {', '.join(EXECUTION_PROFILES)}")
+    return EXECUTION_PROFILES[profile]
+
+
+def check_settings(profile, compile_components):
+    """检查执行配置和 torch.compile 组件的名称，未知时抛出 ValueError
+
+    在服务启动时调用：名称错误时立即退出，而不是在每个工作线程加载模型时失败并被反复重启。
+    """
+    _get_profile(profile)
+    _compile_targets(compile_components)
+
+
+def _compile_targets(components):
+    components = [component.strip() for component in components if component.strip()]
+    for component in components:
+        if component not in COMPILE_TARGETS:
+            raise ValueError(f"Unknown TORCH_COMPILE component: {component}, expected one of {', '.join(COMPILE_TARGETS)}")
+    return components
+
+
+def _offloads(profile, device):
+    """该执行配置在此设备上是否换入换出模型（CPU 上没有可节省的显存）"""
+    return _get_profile(profile)['offload'] is not None and not str(device).startswith('cpu')
+
+
+def profile_load_device(profile, device):
+    """加载组件的目标设备：需要换入换出时组件先保留在内存中"""
+    return None if _offloads(profile, device) else device
+
+
+def apply_execution_profile(pipeline, profile, device):
+    """按执行配置启用模型换入换出和分块计算，返回实际启用的优化列表"""
+    settings = _get_profile(profile)
+    applied = []
+    if _offloads(profile, device):
+        if settings['offload'] == 'model':
+            pipeline.enable_model_cpu_offload(device=device)
+            applied.append('model_cpu_offload')
+        else:
+            pipeline.enable_sequential_cpu_offload(device=device)
+            applied.append('sequential_cpu_offload')
+    if settings['attention_slicing']:
+        # 只有实现了 set_attention_slice 的组件支持注意力分块
+        if any(hasattr(component, 'set_attention_slice') for component in pipeline.components.values()):
+            pipeline.enable_attention_slicing()
+            applied.append('attention_slicing')
+    vae = getattr(pipeline, 'vae', None)
+    if settings['vae_slicing'] and hasattr(vae, 'enable_slicing'):
+        vae.enable_slicing()
+        applied.append('vae_slicing')
+    if settings['vae_tiling'] and hasattr(vae, 'enable_tiling'):
+        vae.enable_tiling()
+        applied.append('vae_tiling')
+    return applied
+
+
+def compile_pipeline(pipeline, components, mode, profile, device, max_shapes=8):
+    """用 torch.compile 按静态形状编译管道组件，返回实际编译的模块列表
+
+    每种输入形状各编译一份（需要在启动时逐一预热），编译在首次运行时发生。
+    换入换出模型的执行配置下不编译（换入换出的钩子会打断编译后的图）。
+    """
+    components = _compile_targets(components)
+    if _offloads(profile, device):
+        print(f"torch.compile skipped: not supported with the {profile} profile on {device}")
+        return []
+    # 超过重新编译上限的形状会退回未编译执行
+    dynamo_config = torch._dynamo.config
+    limit_name = 'recompile_limit' if hasattr(dynamo_config, 'recompile_limit') else 'cache_size_limit'
+    setattr(dynamo_config, limit_name, max(getattr(dynamo_config, limit_name), max_shapes))
+    compiled = []
+    for component in components:
+        for target in COMPILE_TARGETS[component]:
+            module = pipeline
+            for name in target.split('.'):
+                module = getattr(module, name, None)
+            if isinstance(module, torch.nn.Module):
+                module.compile(mode=mode, dynamic=False)
+                compiled.append(f"compile:{target}")
+    return compiled
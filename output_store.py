@@ -0,0 +1,238 @@
+"""
+输出图像存储
+按文件名哈希分目录保存输出图像，避免单个目录中文件过多；
+写盘交给后台线程完成，写入前的数据保留在内存中，下载不受影响；
+定期清理按保留时间和总大小淘汰旧文件，并删除上传目录中遗留的文件。
+文件写入后不再修改，按内容计算的 ETag 缓存在内存中供下载使用
+"""
+
+import hashlib
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# 内存中缓存 ETag 的文件数
+ETAG_CACHE_ENTRIES = 65536
+
+
+class OutputStore:
+    """分目录的输出图像存储，支持后台写入和按时间/大小回收"""
+
+    def __init__(self, root, shard_levels=2, async_writes=True, max_pending=64,
+                 max_bytes=0, max_age=0, upload_folder=None, upload_max_age=0, stage_seconds=None):
+        self.root = root
+        self.shard_levels = shard_levels
+        self.async_writes = async_writes
+        self.max_bytes = max_bytes  # 0 表示不限制
+        self.max_age = max_age  # 秒，0 表示不限制
+        self.upload_folder = upload_folder
+        self.upload_max_age = upload_max_age
+        self.stage_seconds = stage_seconds
+        self._lock = threading.Lock()
+        self._pending = {}  # 文件名 -> (尚未写入磁盘的数据, 保存时间)
+        self._etags = OrderedDict()  # 文件名 -> 内容哈希
+        self._queue = queue.Queue(maxsize=max_pending)  # 写满时 put 阻塞，限制占用的内存
+        self._stats = {'files': 0, 'bytes': 0, 'writes': 0, 'write_errors': 0,
+                       'gc_runs': 0, 'gc_deleted': 0, 'gc_deleted_bytes': 0, 'uploads_deleted': 0}
+        os.makedirs(root, exist_ok=True)
+        if async_writes:
+            threading.Thread(target=self._write_loop, name='output-writer', daemon=True).start()
+
+    def path(self, filename):
+        """文件在存储中的路径：按文件名哈希的前几位分目录"""
+        digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+        shards = [digest[2 * i:2 * i + 2] for i in range(self.shard_levels)]
+        return os.path.join(self.root, *shards, filename)
+
+    def put(self, filename, data):
+        """保存文件，返回其路径；异步写入时立即返回"""
+        path = self.path(filename)
+        created = time.time()
+        self._remember_etag(filename, hashlib.sha256(data).hexdigest()[:32])
+        if not self.async_writes:
+            self._write(filename, path, data, created)
+            return path
+        with self._lock:
+            self._pending[filename] = (data, created)
+        self._queue.put((filename, path, data, created))
+        return path
+
+    def ensure(self, filename, data):
+        """文件已被回收时重新保存（如结果缓存命中但输出文件已被清理）"""
+        if self.locate(filename) is None and not self.is_pending(filename):
+            self.put(filename, data)
+
+    def is_pending(self, filename):
+        with self._lock:
+            return filename in self._pending
+
+    def pending_entry(self, filename):
+        """尚未写入磁盘的文件，返回 (数据, 保存时间)，否则返回 None"""
+        with self._lock:
+            return self._pending.get(filename)
+
+    def read(self, filename):
+        """读取文件内容（包括尚未写入磁盘的文件），不存在时返回 None"""
+        entry = self.pending_entry(filename)
+        if entry is not None:
+            return entry[0]
+        path = self.locate(filename)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def locate(self, filename):
+        """已写入磁盘的文件路径，兼容旧版本直接保存在根目录下的文件；不存在时返回 None"""
+        for path in (self.path(filename), os.path.join(self.root, filename)):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def etag(self, filename):
+        """按文件内容计算的强 ETag；文件不存在时返回 None"""
+        with self._lock:
+            etag = self._etags.get(filename)
+            if etag is not None:
+                self._etags.move_to_end(filename)
+                return etag
+        data = self.read(filename)
+        if data is None:
+            return None
+        etag = hashlib.sha256(data).hexdigest()[:32]
+        self._remember_etag(filename, etag)
+        return etag
+
+    def _remember_etag(self, filename, etag):
+        with self._lock:
+            self._etags[filename] = etag
+            self._etags.move_to_end(filename)
+            while len(self._etags) > ETAG_CACHE_ENTRIES:
+                self._etags.popitem(last=False)
+
+    def pending(self):
+        """等待写入磁盘的文件数"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """等待已提交的写入全部完成"""
+        if self.async_writes:
+            self._queue.join()
+
+    def stats(self):
+        """存储统计信息（文件数和大小为最近一次清理时的扫描结果）"""
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending), limit_bytes=self.max_bytes, max_age=self.max_age)
+
+    def _write_loop(self):
+        while True:
+            filename, path, data, created = self._queue.get()
+            try:
+                self._write(filename, path, data, created)
+            finally:
+                with self._lock:
+                    self._pending.pop(filename, None)
+                self._queue.task_done()
+
+    def _write(self, filename, path, data, created):
+        started = time.perf_counter()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            # 修改时间设为保存时间，写入前后下载返回的 Last-Modified 一致
+            os.utime(tmp_path, (created, created))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            with self._lock:
+                self._stats['write_errors'] += 1
+            print(f"Failed to write output {filename}: {e}")
+            if not self.async_writes:
+                raise
+            return
+        with self._lock:
+            self._stats['writes'] += 1
+        if self.stage_seconds is not None:
+            self.stage_seconds.observe(time.perf_counter() - started, stage='write')
+
+    def start_gc(self, interval):
+        """启动后台清理线程，每 interval 秒运行一次"""
+        def loop():
+            while True:
+                try:
+                    self.collect_garbage()
+                except Exception as e:
+                    print(f"Output store GC failed: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=loop, name='output-gc', daemon=True).start()
+
+    def collect_garbage(self):
+        """删除超过保留时间的文件，再按修改时间从旧到新删除，直到总大小不超过上限"""
+        now = time.time()
+        files = []
+        for path, stat in _scan(self.root):
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        deleted = deleted_bytes = 0
+        for mtime, size, path in files:
+            expired = self.max_age and now - mtime > self.max_age
+            over_budget = self.max_bytes and total > self.max_bytes
+            if not expired and not over_budget:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            deleted += 1
+            deleted_bytes += size
+
+        uploads_deleted = 0
+        if self.upload_folder and self.upload_max_age and os.path.isdir(self.upload_folder):
+            # 上传的图像在内存中处理，上传目录中只会留下旧版本或异常中断时遗留的文件
+            for path, stat in _scan(self.upload_folder):
+                if now - stat.st_mtime > self.upload_max_age:
+                    try:
+                        os.remove(path)
+                        uploads_deleted += 1
+                    except FileNotFoundError:
+                        pass
+
+        with self._lock:
+            self._stats.update(files=len(files) - deleted, bytes=total)
+            self._stats['gc_runs'] += 1
+            self._stats['gc_deleted'] += deleted
+            self._stats['gc_deleted_bytes'] += deleted_bytes
+            self._stats['uploads_deleted'] += uploads_deleted
+        if deleted or uploads_deleted:
+            print(f"Output store GC: deleted {deleted} outputs ({deleted_bytes / 1024 / 1024:.1f} MB) "
+                  f"and {uploads_deleted} uploads")
+
+
+def _scan(directory):
+    """递归列出目录下的文件 (路径, stat)，跳过写入中的临时文件"""
+    stack = [directory]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not entry.name.endswith('.tmp'):
+                    yield entry.path, entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
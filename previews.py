@@ -0,0 +1,34 @@
+"""
+推理进度预览
+把去噪过程中的中间潜变量直接映射为低分辨率的近似图像，不经过 VAE 解码
+"""
+
+import base64
+import io
+
+import torch
+from PIL import Image
+
+
+def latent_previews(pipeline, latents, height, width, max_size=256):
+    """为一批打包后的潜变量生成预览图，返回 JPEG 的 data URL 列表
+
+    取潜变量的前三个通道按通道做最小-最大归一化作为 RGB，
+    只用于展示大致构图，颜色并不准确。
+    """
+    latents = pipeline._unpack_latents(latents, height, width, pipeline.vae_scale_factor)
+    latents = latents[:, :3, 0].float()  # (B, 3, H/8, W/8)
+    flat = latents.flatten(2)
+    low = flat.min(dim=2).values[..., None, None]
+    high = flat.max(dim=2).values[..., None, None]
+    rgb = ((latents - low) / (high - low).clamp(min=1e-6) * 255).to(torch.uint8)
+    rgb = rgb.permute(0, 2, 3, 1).cpu().numpy()
+
+    previews = []
+    for array in rgb:
+        image = Image.fromarray(array)
+        image.thumbnail((max_size, max_size))
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=70)
+        previews.append(f"data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode()}")
+    return previews
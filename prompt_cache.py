@@ -0,0 +1,97 @@
+"""
+提示词嵌入缓存
+对同一张图像反复编辑（调整种子、步数、CFG）时，文本编码器的输出只取决于
+提示词和缩放后的输入图像，缓存后每次只需重新执行去噪循环
+"""
+
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def tensor_bytes(tensor):
+    """张量占用的字节数"""
+    if tensor is None:
+        return 0
+    return tensor.numel() * tensor.element_size()
+
+
+def concat_prompt_embeds(entries, bucket_length=None):
+    """把多组 (嵌入, 掩码) 填充到相同长度后拼接为一批
+
+    bucket_length 把最大长度映射为实际填充到的长度（如按长度桶填充，使编译后的图可以复用）。
+    """
+    max_len = max(embeds.shape[1] for embeds, _ in entries)
+    if bucket_length is not None:
+        max_len = bucket_length(max_len)
+    if len(entries) == 1 and entries[0][0].shape[1] == max_len:
+        return entries[0]
+    embeds_list, mask_list = [], []
+    for embeds, mask in entries:
+        pad = max_len - embeds.shape[1]
+        embeds_list.append(torch.nn.functional.pad(embeds, (0, 0, 0, pad)))
+        mask_list.append(torch.nn.functional.pad(mask, (0, pad)))
+    return torch.cat(embeds_list, dim=0), torch.cat(mask_list, dim=0)
+
+
+def encode_prompt(pipeline, prompt, prompt_image):
+    """调用管道的文本编码器，返回位于推理设备上的 (嵌入, 掩码)"""
+    embeds, mask = pipeline.encode_prompt(prompt=prompt, image=prompt_image, device=pipeline._execution_device)
+    if mask is None:
+        # 编码器在无填充时返回 None，这里补全掩码以便与其他提示词拼接
+        mask = torch.ones(embeds.shape[:2], dtype=torch.long, device=embeds.device)
+    return embeds, mask
+
+
+class PromptEmbeddingCache:
+    """按 (图像哈希, 目标分辨率, 提示词) 缓存文本编码结果的 LRU 缓存，按字节数限制大小
+
+    同一张图像在不同的目标分辨率下（如声明了不同的原图尺寸）编码结果不同，与 ImageCache 一样按分辨率区分。
+    """
+
+    def __init__(self, max_bytes, storage_device='cpu'):
+        self.max_bytes = max_bytes
+        self.storage_device = storage_device  # 'cpu' 保存在内存，'device' 保留在推理设备上
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get_or_encode(self, pipeline, prompt, prompt_image, image_hash):
+        """返回提示词嵌入和掩码（位于推理设备上），未命中时调用管道的文本编码器
+
+        prompt_image 为已缩放到目标分辨率的输入图像。
+        """
+        device = pipeline._execution_device
+        key = (image_hash, prompt_image.size, prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+        if entry is not None:
+            embeds, mask = entry
+            return embeds.to(device), mask.to(device)
+
+        embeds, mask = encode_prompt(pipeline, prompt, prompt_image)
+
+        storage = device if self.storage_device == 'device' else 'cpu'
+        entry = (embeds.to(storage), mask.to(storage))
+        size = tensor_bytes(entry[0]) + tensor_bytes(entry[1])
+        with self._lock:
+            self._stats['misses'] += 1
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = entry
+                self._size += size
+                while self._size > self.max_bytes:
+                    _, (old_embeds, old_mask) = self._entries.popitem(last=False)
+                    self._size -= tensor_bytes(old_embeds) + tensor_bytes(old_mask)
+                    self._stats['evictions'] += 1
+        return embeds, mask
+
+    def stats(self):
+        """缓存统计信息"""
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._size,
+                        limit_bytes=self.max_bytes, storage_device=self.storage_device)
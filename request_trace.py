@@ -0,0 +1,69 @@
+"""
+请求追踪
+把每个编辑请求的时间戳、密钥名称、输入尺寸、参数、各阶段耗时和结果
+以紧凑的 JSONL 格式追加到追踪文件，用于离线重放生产负载（见 benchmarks/replay.py）
+"""
+
+import json
+import os
+import threading
+import uuid
+
+IMAGE_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'GIF': 'gif', 'BMP': 'bmp', 'WEBP': 'webp'}
+
+
+class TraceWriter:
+    """追加写入追踪记录，可选按内容哈希保存上传的图像"""
+
+    def __init__(self, path, image_folder=None):
+        self.path = path
+        self.image_folder = image_folder
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if image_folder:
+            os.makedirs(image_folder, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def store_image(self, image_hash, image_format, data):
+        """保存上传的图像，返回相对于追踪文件所在目录的路径；未启用时返回 None"""
+        if not self.image_folder:
+            return None
+        path = os.path.join(self.image_folder, f"{image_hash}.{IMAGE_EXTENSIONS.get(image_format, 'bin')}")
+        if not os.path.exists(path):
+            # 追踪失败不影响请求本身
+            try:
+                tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Failed to store traced image: {e}")
+                return None
+        return os.path.relpath(path, os.path.dirname(os.path.abspath(self.path)))
+
+    def write(self, record):
+        """追加一条记录（每条一行）"""
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            try:
+                self._file.write(line + '\n')
+                self._file.flush()
+            except OSError as e:
+                print(f"Failed to write trace record: {e}")
+
+
+def read_trace(path):
+    """读取追踪文件，跳过无法解析的行（如写入中断的最后一行）"""
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
@@ -0,0 +1,161 @@
+"""
+结果缓存
+按输入图像内容和编辑参数计算缓存键，缓存编码后的输出图像。
+内存 LRU 层和磁盘层分别按字节数限制大小。
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+def make_cache_key(image_hash, params):
+    """根据输入图像哈希和影响输出的参数计算缓存键"""
+    digest = hashlib.sha256()
+    digest.update(image_hash.encode('ascii'))
+    digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """两级结果缓存：内存 LRU + 磁盘目录"""
+
+    def __init__(self, directory, memory_bytes, disk_bytes):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # 缓存键 -> (数据, 元信息)
+        self._memory_size = 0
+        self._disk = OrderedDict()  # 缓存键 -> 文件大小
+        self._disk_size = 0
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+        self._scan_disk()
+
+    def _data_path(self, key):
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _scan_disk(self):
+        """启动时按修改时间恢复磁盘层索引"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.bin'):
+                continue
+            path = os.path.join(self.directory, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, name[:-len('.bin')], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    def __contains__(self, key):
+        """是否已缓存（不计入命中统计）"""
+        with self._lock:
+            return key in self._memory or key in self._disk
+
+    def get(self, key):
+        """查询缓存，命中返回 (数据, 元信息)，否则返回 None"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return entry
+            if key not in self._disk:
+                self._stats['misses'] += 1
+                return None
+            self._disk.move_to_end(key)
+
+        try:
+            with open(self._data_path(key), 'rb') as f:
+                data = f.read()
+            with open(self._meta_path(key), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self._drop_disk(key)
+                self._stats['misses'] += 1
+            return None
+
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._put_memory(key, data, meta)
+        return data, meta
+
+    def put(self, key, data, meta):
+        """写入缓存（同时写入内存层和磁盘层）"""
+        with self._lock:
+            self._put_memory(key, data, meta)
+            if len(data) > self.disk_bytes or key in self._disk:
+                return
+        # 并发写入同一个键时各自使用临时文件；先写元信息，数据文件出现时条目即完整
+        suffix = f".{threading.get_ident()}.tmp"
+        self._write_atomic(self._meta_path(key), suffix,
+                           json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+        self._write_atomic(self._data_path(key), suffix, data)
+        with self._lock:
+            # 其他线程可能已写入同一个键
+            if key in self._disk:
+                return
+            self._disk[key] = len(data)
+            self._disk_size += len(data)
+            self._evict_disk()
+
+    @staticmethod
+    def _write_atomic(path, suffix, data):
+        tmp_path = path + suffix
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        """缓存统计信息"""
+        with self._lock:
+            lookups = self._stats['memory_hits'] + self._stats['disk_hits'] + self._stats['misses']
+            hits = self._stats['memory_hits'] + self._stats['disk_hits']
+            return dict(
+                self._stats,
+                hit_rate=hits / lookups if lookups else 0.0,
+                memory_entries=len(self._memory),
+                memory_bytes=self._memory_size,
+                memory_limit_bytes=self.memory_bytes,
+                disk_entries=len(self._disk),
+                disk_bytes=self._disk_size,
+                disk_limit_bytes=self.disk_bytes,
+            )
+
+    def _put_memory(self, key, data, meta):
+        if len(data) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old[0])
+        self._memory[key] = (data, meta)
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, (old_data, _) = self._memory.popitem(last=False)
+            self._memory_size -= len(old_data)
+            self._stats['evictions'] += 1
+
+    def _drop_disk(self, key):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_size -= size
+        for path in (self._data_path(key), self._meta_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _evict_disk(self):
+        while self._disk_size > self.disk_bytes and self._disk:
+            key = next(iter(self._disk))
+            self._drop_disk(key)
+            self._stats['evictions'] += 1
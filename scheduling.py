@@ -0,0 +1,151 @@
+"""
+按API密钥调度
+每个密钥可在 api_keys.json 中设置优先级、每分钟请求数和 GPU 秒数的令牌桶以及最大并发任务数
+（通过 manage_api_keys.py set 管理）。任务队列按优先级对应的权重在密钥之间加权公平排队：
+交互式请求不会排在批量任务之后，没有其他请求时批量任务使用全部推理能力
+"""
+
+import threading
+import time
+
+# 优先级 -> 加权公平排队的权重（权重越大，同样的推理步数占用的排队份额越小）
+PRIORITY_WEIGHTS = {'interactive': 8, 'standard': 4, 'bulk': 1}
+DEFAULT_PRIORITY = 'standard'
+
+# 可在密钥上设置的调度属性；数值属性为 0 或未设置表示不限制
+KEY_ATTRIBUTES = ('priority', 'requests_per_minute', 'gpu_seconds_per_minute', 'max_concurrency')
+
+
+class QuotaExceededError(Exception):
+    """密钥超出限额；retry_after 为建议的重试等待时间（秒），未知时为 None"""
+
+    def __init__(self, message, reason, retry_after=None):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_key_attribute(name, value):
+    """解析并检查密钥调度属性的值，'none' 表示删除该属性（返回 None）
+
+    值不合法时抛出 ValueError。
+    """
+    if name not in KEY_ATTRIBUTES:
+        raise ValueError(f"Unknown attribute {name}, expected one of {', '.join(KEY_ATTRIBUTES)}")
+    if value.lower() == 'none':
+        return None
+    if name == 'priority':
+        if value not in PRIORITY_WEIGHTS:
+            raise ValueError(f"priority must be one of {', '.join(PRIORITY_WEIGHTS)}")
+        return value
+    number = float(value) if name == 'gpu_seconds_per_minute' else int(value)
+    if number < 0:
+        raise ValueError(f"{name} must not be negative")
+    return number
+
+
+class TokenBucket:
+    """令牌桶：每分钟补充 per_minute 个令牌，最多积累一分钟的量
+
+    桶满时允许一次取走超过容量的令牌（余额变为负数），单个大任务不会永远无法执行。
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(float(self.per_minute), self.tokens + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    def take(self, amount):
+        """取走 amount 个令牌，返回 0；令牌不足时不取，返回需要等待的秒数"""
+        if amount <= 0:
+            # 取走 0 或负数个令牌会绕过限额（负数还会增加余额）
+            raise ValueError(f"Token amount must be positive, got {amount}")
+        now = time.monotonic()
+        self._refill(now)
+        needed = min(amount, self.per_minute)
+        if self.tokens >= needed:
+            self.tokens -= amount
+            return 0.0
+        return (needed - self.tokens) * 60.0 / self.per_minute
+
+    def available(self):
+        self._refill(time.monotonic())
+        return self.tokens
+
+
+class KeyScheduler:
+    """按密钥执行限额，并为任务队列提供每个密钥的排队权重"""
+
+    def __init__(self, default_priority=DEFAULT_PRIORITY):
+        self.default_priority = default_priority if default_priority in PRIORITY_WEIGHTS else DEFAULT_PRIORITY
+        self._lock = threading.Lock()
+        self._policies = {}  # 密钥名称 -> 调度属性
+        self._buckets = {}  # (密钥名称, 'requests' 或 'gpu_seconds') -> TokenBucket
+
+    def _bucket(self, name, kind, per_minute):
+        """密钥的令牌桶（需持有锁）；限额修改后按新的速率重新开始"""
+        bucket = self._buckets.get((name, kind))
+        if bucket is None or bucket.per_minute != per_minute:
+            bucket = self._buckets[(name, kind)] = TokenBucket(per_minute)
+        return bucket
+
+    def _update_policy(self, name, info):
+        """记录密钥文件中最新的调度属性（需持有锁）"""
+        policy = self._policies[name] = {attribute: info.get(attribute) for attribute in KEY_ATTRIBUTES}
+        return policy
+
+    def check_request(self, name, info):
+        """记录密钥的最新调度属性并扣除一次请求；超出每分钟请求数时抛出 QuotaExceededError"""
+        with self._lock:
+            policy = self._update_policy(name, info)
+            per_minute = policy['requests_per_minute']
+            if not per_minute:
+                return
+            wait = self._bucket(name, 'requests', per_minute).take(1)
+        if wait > 0:
+            raise QuotaExceededError(f"Rate limit of {per_minute} requests per minute exceeded",
+                                     'rate_limited', wait)
+
+    def priority(self, name):
+        with self._lock:
+            policy = self._policies.get(name) or {}
+        priority = policy.get('priority')
+        return priority if priority in PRIORITY_WEIGHTS else self.default_priority
+
+    def weight(self, name):
+        """任务队列的排队权重"""
+        return PRIORITY_WEIGHTS[self.priority(name)]
+
+    def admit(self, name, inflight, gpu_seconds):
+        """任务入队前检查并发数和 GPU 秒数限额（由任务队列在持有其锁时调用）
+
+        inflight 为该密钥排队和执行中的任务数，gpu_seconds 为新任务的预计推理耗时。
+        """
+        with self._lock:
+            policy = self._policies.get(name) or {}
+            max_concurrency = policy.get('max_concurrency')
+            if max_concurrency and inflight >= max_concurrency:
+                raise QuotaExceededError(f"Concurrency limit of {max_concurrency} jobs reached",
+                                         'concurrency_limited')
+            per_minute = policy.get('gpu_seconds_per_minute')
+            if not per_minute:
+                return
+            wait = self._bucket(name, 'gpu_seconds', per_minute).take(gpu_seconds)
+        if wait > 0:
+            raise QuotaExceededError(f"Quota of {per_minute} GPU seconds per minute exceeded",
+                                     'gpu_quota_exceeded', wait)
+
+    def status(self, name, info):
+        """密钥的调度属性和令牌桶余额"""
+        with self._lock:
+            policy = dict(self._update_policy(name, info))
+            remaining = {kind: round(bucket.available(), 2)
+                         for (owner, kind), bucket in self._buckets.items() if owner == name}
+        policy['priority'] = self.priority(name)
+        policy['weight'] = PRIORITY_WEIGHTS[policy['priority']]
+        policy['remaining'] = remaining
+        return policy
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+生产环境服务入口
+uvicorn 运行的异步 HTTP 前端：请求体在事件循环中异步接收完整后才交给 Flask 应用，
+应用在线程池中执行，响应经有界缓冲交给事件循环发送，慢速客户端的上传和下载不占用处理线程；
+等待推理结果的同步请求和事件流使用单独的线程池，不影响上传、状态查询和下载。
+模型只在每个设备一个的推理进程中加载（见 inference_process.py），前端进程不加载模型。
+
+收到 SIGTERM 或 SIGINT 时先排空队列：不再接受新任务（返回 503）、/readyz 返回 503，
+等待已提交的任务完成（最多 DRAIN_TIMEOUT 秒）后关闭连接和推理进程；再次收到信号时立即退出。
+
+用法: python serve.py [--host 0.0.0.0] [--port 5000]
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+
+# 等待推理结果的请求（同步编辑、变体和任务事件流）
+WAITING_PATHS = re.compile(r'^/(api/)?edit-image$|^/api/variations$|^/api/jobs/[^/]+/events$')
+# 请求体超过该大小时写入临时文件
+SPOOL_BYTES = 1024 * 1024
+# 关闭时等待剩余连接（如排空超时后仍在等待结果的请求）的最长时间（秒）
+GRACEFUL_SHUTDOWN_SECONDS = 30
+
+
+class ClientDisconnected(OSError):
+    """客户端已断开，停止生成响应"""
+
+
+class ResponseChannel:
+    """处理线程向事件循环传递响应消息；缓冲超过上限时处理线程等待客户端读取"""
+
+    def __init__(self, loop, limit):
+        self._loop = loop
+        self._limit = limit
+        self._queue = asyncio.Queue()
+        self._cond = threading.Condition()
+        self._buffered = 0
+        self._closed = False
+
+    def put(self, message):
+        """（处理线程）发送一条 ASGI 消息；客户端已断开时抛出 ClientDisconnected"""
+        size = len(message.get('body', b''))
+        with self._cond:
+            while self._buffered and self._buffered + size > self._limit and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                raise ClientDisconnected()
+            self._buffered += size
+        self._call(message)
+
+    def finish(self):
+        """（处理线程）响应结束"""
+        self._call(None)
+
+    def _call(self, message):
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, message)
+        except RuntimeError:
+            # 事件循环已关闭
+            raise ClientDisconnected()
+
+    async def get(self):
+        """（事件循环）下一条消息，响应结束时返回 None"""
+        message = await self._queue.get()
+        if message is not None:
+            with self._cond:
+                self._buffered -= len(message.get('body', b''))
+                self._cond.notify_all()
+        return message
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class AsgiFrontend:
+    """把 WSGI 应用包装为 ASGI 应用：异步接收请求体，在线程池中执行应用"""
+
+    def __init__(self, wsgi_app, max_body, threads, wait_threads, buffer_bytes, on_startup=None, on_shutdown=None):
+        self.wsgi_app = wsgi_app
+        self.max_body = max_body
+        self.buffer_bytes = buffer_bytes
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='frontend')
+        self.wait_executor = ThreadPoolExecutor(wait_threads, thread_name_prefix='frontend-wait')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                if self.on_startup is not None:
+                    self.on_startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.on_shutdown is not None:
+                    await loop.run_in_executor(None, self.on_shutdown)
+                self.executor.shutdown(wait=False)
+                self.wait_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        body, length = await self._read_body(scope, receive)
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        channel = ResponseChannel(loop, self.buffer_bytes)
+        executor = self.wait_executor if WAITING_PATHS.match(scope['path']) else self.executor
+        future = loop.run_in_executor(executor, self._run, self._environ(scope, body, length), channel)
+        future.add_done_callback(lambda _: body.close())
+        watcher = asyncio.ensure_future(self._watch_disconnect(receive, channel))
+        try:
+            while True:
+                message = await channel.get()
+                if message is None:
+                    break
+                await send(message)
+        finally:
+            watcher.cancel()
+            channel.close()
+
+    async def _read_body(self, scope, receive):
+        """异步接收完整的请求体，返回 (文件, 长度)；客户端中途断开时返回 (None, 0)
+
+        声明或实际的长度超过上限时不再接收，由 Flask 按 MAX_CONTENT_LENGTH 返回 413。
+        """
+        body = tempfile.SpooledTemporaryFile(SPOOL_BYTES)
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit() and int(value) > self.max_body:
+                return body, int(value)
+        length = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None, 0
+            chunk = message.get('body', b'')
+            length += len(chunk)
+            if length > self.max_body:
+                break
+            body.write(chunk)
+            more_body = message.get('more_body', False)
+        body.seek(0)
+        return body, length
+
+    @staticmethod
+    async def _watch_disconnect(receive, channel):
+        """客户端断开时通知处理线程停止生成响应（如事件流）"""
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                channel.close()
+                return
+
+    @staticmethod
+    def _environ(scope, body, length):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'CONTENT_LENGTH': str(length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = name if name == 'CONTENT_TYPE' else f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _run(self, environ, channel):
+        """（处理线程）执行 WSGI 应用，把响应头和响应体依次交给 channel"""
+        response = []
+        started = False
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [int(status.split(' ', 1)[0]),
+                           [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]]
+            return write
+
+        def send_start():
+            nonlocal started
+            if not started:
+                started = True
+                channel.put({'type': 'http.response.start', 'status': response[0], 'headers': response[1]})
+
+        def write(data):
+            send_start()
+            channel.put({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in iterable:
+                    if chunk:
+                        send_start()
+                        channel.put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                send_start()
+                channel.put({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        except ClientDisconnected:
+            pass
+        except Exception:
+            traceback.print_exc()
+            if not started:
+                try:
+                    channel.put({'type': 'http.response.start', 'status': 500,
+                                 'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+                    channel.put({'type': 'http.response.body', 'body': b'Internal Server Error'})
+                except ClientDisconnected:
+                    pass
+        finally:
+            try:
+                channel.finish()
+            except ClientDisconnected:
+                pass
+
+
+class DrainingServer(uvicorn.Server):
+    """第一次收到关闭信号时先排空任务队列再关闭服务，再次收到时立即退出"""
+
+    def __init__(self, config, drain):
+        super().__init__(config)
+        self._drain = drain
+        self._draining = False
+
+    def handle_exit(self, sig, frame):
+        if self._draining:
+            self.force_exit = True
+            super().handle_exit(sig, frame)
+            return
+        self._draining = True
+        threading.Thread(target=self._drain_then_exit, name='drain', daemon=True).start()
+
+    def _drain_then_exit(self):
+        try:
+            self._drain()
+        finally:
+            self.should_exit = True
+
+
+def enable_inference_process():
+    """默认在推理进程中加载模型（配置在导入时读取，必须在导入 config 之前调用）"""
+    os.environ.setdefault('INFERENCE_PROCESS', 'True')
+
+
+def run(host, port):
+    """以生产模式运行服务（阻塞直到关闭）"""
+    enable_inference_process()
+    import app as server
+    from config import Config
+
+    def startup():
+        if Config.EAGER_MODEL_LOAD:
+            server.start_model_loader()
+
+    def shutdown():
+        if not server.draining.is_set():
+            server.drain(Config.DRAIN_TIMEOUT)
+        server.stop_inference_processes()
+
+    frontend = AsgiFrontend(
+        server.app,
+        max_body=server.app.config['MAX_CONTENT_LENGTH'],
+        threads=Config.FRONTEND_THREADS,
+        wait_threads=Config.FRONTEND_WAIT_THREADS,
+        buffer_bytes=Config.RESPONSE_BUFFER_MB * 1024 * 1024,
+        on_startup=startup,
+        on_shutdown=shutdown,
+    )
+    config = uvicorn.Config(frontend, host=host, port=port, lifespan='on',
+                            timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_SECONDS)
+    DrainingServer(config, lambda: server.drain(Config.DRAIN_TIMEOUT)).run()
+
+
+def main():
+    enable_inference_process()
+    from config import Config
+
+    parser = argparse.ArgumentParser(description='Run the production server')
+    parser.add_argument('--host', default=Config.HOST)
+    parser.add_argument('--port', type=int, default=Config.PORT)
+    args = parser.parse_args()
+    run(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,7 @@ def check_dependencies():
     
     required_packages = [
         'torch', 'torchvision', 'diffusers', 'transformers', 
-        'accelerate', 'PIL', 'flask', 'flask_cors'
+        'accelerate', 'PIL', 'flask', 'flask_cors', 'uvicorn'
     ]
     
     missing_packages = []
@@ -76,7 +76,7 @@ def check_api_keys():
     """检查API密钥配置"""
     print("\n🔑 正在检查API密钥配置...")
     
-    api_keys_file = 'api_keys.json'
+    api_keys_file = os.environ.get('API_KEYS_FILE', 'api_keys.json')
     
     if os.path.exists(api_keys_file):
         try:
@@ -103,8 +103,8 @@ def start_application():
     print("\n🚀 正在启动应用程序...")
     
     try:
-        # 启动Flask应用
-        os.system("python app.py")
+        # 生产模式：异步前端 + 推理进程
+        subprocess.call([sys.executable, "serve.py"])
     except KeyboardInterrupt:
         print("\n👋 应用程序已停止")
     except Exception as e:
@@ -119,7 +119,7 @@ def show_usage_info():
     print("📋 使用说明:")
     print("1. 确保已安装所有依赖项 (pip install -r requirements.txt)")
     print("2. 创建API密钥 (python manage_api_keys.py create)")
-    print("3. 启动应用程序 (python start.py 或 python app.py)")
+    print("3. 启动应用程序 (python start.py 或 python serve.py)")
     print("4. 在浏览器中访问 http://localhost:5000")
     print()
     print("🔧 管理命令:")
@@ -171,7 +171,7 @@ def main():
     if start_app in ['y', 'yes']:
         start_application()
     else:
-        print("\n💡 要启动应用程序，请运行: python app.py")
+        print("\n💡 要启动应用程序，请运行: python serve.py")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,77 @@
+"""分辨率分桶、提示词长度桶和预热形状"""
+
+import pytest
+
+from buckets import (ResolutionBuckets, parse_aspect_ratios, text_length_bucket, batch_sizes, warmup_shapes,
+                     TEXT_LENGTH_BUCKETS)
+
+
+@pytest.fixture
+def buckets():
+    return ResolutionBuckets(parse_aspect_ratios('1:1,4:3,3:4,16:9,9:16'))
+
+
+def test_parse_aspect_ratios_skips_duplicates_and_rejects_invalid():
+    assert parse_aspect_ratios('1:1, 4:3,,1:1') == [(1, 1), (4, 3)]
+    with pytest.raises(ValueError):
+        parse_aspect_ratios('0:1')
+    with pytest.raises(ValueError):
+        parse_aspect_ratios('wide')
+
+
+@pytest.mark.parametrize('size, ratio', [
+    ((1000, 1000), (1, 1)),
+    ((4032, 3024), (4, 3)),
+    ((3024, 4032), (3, 4)),
+    ((1920, 1080), (16, 9)),
+    ((1080, 1920), (9, 16)),
+    ((3000, 1000), (16, 9)),
+    ((1100, 1000), (1, 1)),
+])
+def test_nearest_bucket_by_aspect_ratio(buckets, size, ratio):
+    assert buckets.nearest(*size)[0] == ratio
+
+
+def test_bucket_sizes_match_target_area(buckets):
+    for (width, height), (ratio_width, ratio_height) in zip(buckets.sizes, buckets.ratios):
+        assert width % 32 == 0 and height % 32 == 0
+        assert abs(width * height - 1024 * 1024) / (1024 * 1024) < 0.1
+        assert abs(width / height - ratio_width / ratio_height) < 0.05
+
+
+def test_sample_sizes_fall_into_their_own_bucket(buckets):
+    samples = buckets.sample_sizes()
+    assert len(samples) == len(buckets)
+    for (width, height), ratio in zip(samples, buckets.ratios):
+        assert width * ratio[1] == height * ratio[0]
+        assert buckets.nearest(width, height)[0] == ratio
+
+
+def test_text_length_bucket_always_leaves_padding():
+    assert text_length_bucket(1) == TEXT_LENGTH_BUCKETS[0]
+    assert text_length_bucket(127) == 128
+    assert text_length_bucket(128) == 256
+    assert text_length_bucket(700) == 1024
+    # 超过最大的桶时不填充
+    assert text_length_bucket(1024) == 1024
+    assert text_length_bucket(1500) == 1500
+
+
+def test_batch_sizes_cover_partial_batches():
+    assert batch_sizes(1, 1) == [1]
+    assert batch_sizes(1, 4) == [1, 2, 3, 4]
+    assert batch_sizes(3, 2) == [1, 2, 3]
+    assert batch_sizes(0, 0) == [1]
+
+
+def test_warmup_shapes_without_compile_run_each_size_once():
+    assert warmup_shapes([(1024, 1024), (1024, 768)], [1, 2, 3], compiled=False) == \
+        [((1024, 1024), 1), ((1024, 768), 1)]
+
+
+def test_warmup_shapes_with_compile_cover_every_batch_size():
+    sizes = [(1024, 1024), (1024, 768)]
+    shapes = warmup_shapes(sizes, batch_sizes(2, 4), compiled=True)
+    assert set(shapes) == {(size, batch_size) for size in sizes for batch_size in (1, 2, 3, 4)}
+    # 最后一次运行已编译的形状，作为稳定状态的耗时
+    assert len(shapes) == 9 and shapes[-1] == ((1024, 1024), 1)
@@ -0,0 +1,62 @@
+"""输入图像缓存：并发请求同一图像时只解码一次"""
+
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from image_cache import ImageCache
+
+
+def prepare_concurrently(cache, decode, count=8):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = cache.prepare('hash', (640, 480), (64, 48), decode)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+@pytest.mark.parametrize('max_bytes', [1 << 20, 0])
+def test_concurrent_misses_decode_once(max_bytes):
+    cache = ImageCache(max_bytes)
+    calls = []
+
+    def decode():
+        calls.append(1)
+        time.sleep(0.1)
+        return Image.new('RGB', (640, 480))
+
+    results = prepare_concurrently(cache, decode)
+    assert len(calls) == 1
+    assert all(result.resized.size == (64, 48) for result in results)
+    stats = cache.stats()
+    assert stats['image_misses'] == 1 and stats['image_hits'] == 7
+
+
+def test_failed_decode_is_retried_by_waiters():
+    cache = ImageCache(1 << 20)
+    calls = []
+
+    def decode():
+        calls.append(1)
+        time.sleep(0.05)
+        if len(calls) == 1:
+            raise OSError('truncated image')
+        return Image.new('RGB', (640, 480))
+
+    results = prepare_concurrently(cache, decode)
+    assert sum(isinstance(result, OSError) for result in results) == 1
+    assert len(calls) == 2
+    assert cache.stats()['entries'] == 1
@@ -0,0 +1,80 @@
+"""上传图像的文件头检查"""
+
+import io
+import struct
+import warnings
+import zlib
+
+import pytest
+from PIL import Image
+
+from ingest import ImageRejected, open_image
+
+FORMATS = {'PNG', 'JPEG'}
+MAX_PIXELS = 50_000_000
+MAX_SIDE = 12000
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def png_header(width, height):
+    """只有文件头（IHDR 和空的 IDAT 块）、没有像素数据的 PNG：解码前的检查只应读取文件头"""
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', ihdr) + png_chunk(b'IDAT', b'')
+
+
+@pytest.fixture(autouse=True)
+def max_image_pixels(monkeypatch):
+    # 与 app 一致：PIL 的解压炸弹保护使用相同的像素上限
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', MAX_PIXELS)
+
+
+def test_accepts_image_within_limits():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48)).save(buffer, format='PNG')
+    image = open_image(buffer.getvalue(), FORMATS, MAX_PIXELS, MAX_SIDE)
+    assert image.size == (64, 48)
+
+
+def test_rejects_decompression_bomb_from_header():
+    # 超过 MAX_IMAGE_PIXELS 两倍，PIL 在打开时即抛出 DecompressionBombError
+    with pytest.raises(ImageRejected) as excinfo:
+        open_image(png_header(11000, 10000), FORMATS, MAX_PIXELS, MAX_SIDE)
+    assert excinfo.value.status_code == 413
+
+
+@pytest.mark.filterwarnings('ignore::PIL.Image.DecompressionBombWarning')
+def test_rejects_oversized_image_from_header():
+    with pytest.raises(ImageRejected) as excinfo:
+        open_image(png_header(9000, 8000), FORMATS, MAX_PIXELS, MAX_SIDE)
+    assert excinfo.value.status_code == 413
+
+
+def test_rejects_oversized_image_when_warnings_are_errors():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with pytest.raises(ImageRejected) as excinfo:
+            open_image(png_header(9000, 8000), FORMATS, MAX_PIXELS, MAX_SIDE)
+    assert excinfo.value.status_code == 413
+
+
+def test_rejects_side_over_limit():
+    with pytest.raises(ImageRejected) as excinfo:
+        open_image(png_header(13000, 100), FORMATS, MAX_PIXELS, MAX_SIDE)
+    assert excinfo.value.status_code == 413
+
+
+def test_rejects_unsupported_format():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, format='GIF')
+    with pytest.raises(ImageRejected) as excinfo:
+        open_image(buffer.getvalue(), FORMATS, MAX_PIXELS, MAX_SIDE)
+    assert excinfo.value.status_code == 400
+
+
+def test_rejects_garbage():
+    with pytest.raises(ImageRejected) as excinfo:
+        open_image(b'not an image', FORMATS, MAX_PIXELS, MAX_SIDE)
+    assert excinfo.value.status_code == 400
@@ -0,0 +1,223 @@
+"""任务队列：多工作线程分派、领取任务、失败处理和监控线程重启（使用替身管道，在 CPU 上运行）"""
+
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from benchmarks.stub_pipeline import StubPipeline
+from jobs import JobQueue, QueueFullError, WorkerLostError
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def load_stub(worker):
+    worker.context['pipeline'] = StubPipeline(step_seconds=0.001)
+
+
+def run_stub(jobs, worker):
+    """用替身管道执行一批任务；params 中的 gate 用于让测试控制任务何时开始，error 使这一批失败"""
+    for job in jobs:
+        gate = job.params.get('gate')
+        if gate is not None:
+            gate.wait(5)
+        if 'error' in job.params:
+            raise job.params['error']
+    images = [Image.new('RGB', (64, 64)) for _ in jobs]
+    output = worker.context['pipeline'](image=images, prompt=['edit'] * len(jobs),
+                                        num_inference_steps=jobs[0].params['steps'])
+    return [{'size': image.size, 'worker': worker.index} for image in output.images]
+
+
+def make_queue(**kwargs):
+    options = dict(devices=['cpu', 'cpu'], on_start=load_stub, cost=lambda params: params['steps'],
+                   health_interval=0.05)
+    options.update(kwargs)
+    return JobQueue(run_stub, **options)
+
+
+def test_dispatches_to_worker_with_shortest_wait():
+    queue = make_queue()
+    gate = threading.Event()
+    queue.start()
+    assert wait_until(lambda: all(w['state'] == 'idle' for w in queue.workers()))
+
+    first = queue.submit({'steps': 10, 'gate': gate})
+    assert wait_until(lambda: first.status == 'running')
+    second = queue.submit({'steps': 10, 'gate': gate})
+    assert second.worker != first.worker
+    gate.set()
+    assert first.wait(5) and second.wait(5)
+    assert {first.result['worker'], second.result['worker']} == {0, 1}
+
+
+def test_idle_worker_steals_queued_jobs():
+    ready = threading.Event()
+
+    def start(worker):
+        # 第二个工作线程迟迟未就绪，任务先全部分派给第一个
+        if worker.index == 1:
+            ready.wait(5)
+        load_stub(worker)
+
+    queue = make_queue(on_start=start)
+    queue.start()
+    assert wait_until(lambda: queue.workers()[0]['state'] == 'idle')
+    gate = threading.Event()
+    jobs = [queue.submit({'steps': 5, 'gate': gate}) for _ in range(4)]
+    assert all(job.worker == 0 for job in jobs)
+
+    # 第一个工作线程仍在执行时，就绪的第二个工作线程从它的队列末尾领取任务
+    ready.set()
+    assert wait_until(lambda: any(job.worker == 1 for job in jobs))
+    gate.set()
+    assert all(job.wait(5) for job in jobs)
+    assert all(job.status == 'succeeded' for job in jobs)
+    assert 1 in {job.result['worker'] for job in jobs}
+
+
+def test_ordinary_errors_only_fail_their_jobs():
+    queue = make_queue(devices=['cpu'], max_failures=2)
+    failed = [queue.submit({'steps': 1, 'error': ValueError('bad prompt')}) for _ in range(5)]
+    ok = queue.submit({'steps': 1})
+    assert ok.wait(5)
+    assert all(job.status == 'failed' and job.error == 'bad prompt' for job in failed)
+    assert ok.status == 'succeeded'
+    worker = queue.workers()[0]
+    assert worker['restarts'] == 0 and worker['failed'] == 5 and worker['state'] != 'dead'
+
+
+def test_repeated_fatal_errors_restart_worker():
+    starts = []
+
+    def start(worker):
+        starts.append(worker.index)
+        load_stub(worker)
+
+    queue = make_queue(devices=['cpu'], on_start=start, max_failures=2,
+                       fatal=lambda error: 'CUDA error' in str(error))
+    failed = [queue.submit({'steps': 1, 'error': RuntimeError('CUDA error: an illegal memory access')})
+              for _ in range(2)]
+    assert all(job.wait(5) for job in failed)
+    assert wait_until(lambda: queue.workers()[0]['restarts'] == 1)
+
+    ok = queue.submit({'steps': 1})
+    assert ok.wait(5) and ok.status == 'succeeded'
+    assert len(starts) == 2
+
+
+def test_lost_worker_restarts_immediately():
+    starts = []
+
+    def start(worker):
+        starts.append(worker.index)
+        load_stub(worker)
+
+    queue = make_queue(devices=['cpu', 'cpu'], on_start=start)
+    gate = threading.Event()
+    lost = queue.submit({'steps': 1, 'gate': gate, 'error': WorkerLostError('inference process exited')})
+    assert wait_until(lambda: lost.status == 'running')
+    gate.set()
+
+    assert lost.wait(5) and lost.status == 'failed'
+    assert wait_until(lambda: queue.workers()[lost.worker]['restarts'] == 1)
+    assert wait_until(lambda: queue.workers()[lost.worker]['state'] == 'idle')
+    assert sorted(starts) == sorted([0, 1, lost.worker])
+
+
+def test_jobs_of_dead_worker_move_to_other_workers():
+    queue = make_queue()
+    queue.start()
+    assert wait_until(lambda: all(w['state'] == 'idle' for w in queue.workers()))
+    gate = threading.Event()
+    busy = queue.submit({'steps': 100, 'gate': gate})
+    lost = queue.submit({'steps': 1, 'gate': gate, 'error': WorkerLostError('inference process exited')})
+    assert wait_until(lambda: busy.status == 'running' and lost.status == 'running')
+    # 排在失效线程之后的任务转给仍可用的线程
+    queued = queue.submit({'steps': 1})
+    assert queued.worker == lost.worker
+    gate.set()
+
+    assert lost.wait(5) and lost.status == 'failed'
+    assert queued.wait(5) and queued.status == 'succeeded'
+    assert queued.result['worker'] == busy.worker
+
+
+def test_first_job_counts_as_running_during_batch_window():
+    queue = make_queue(devices=['cpu'], batch_key=lambda params: params['steps'], max_batch_size=4,
+                       batch_window=0.5)
+    queue.start()
+    assert wait_until(lambda: queue.workers()[0]['state'] == 'idle')
+
+    first = queue.submit({'steps': 2})
+    assert wait_until(lambda: first.status == 'running')
+    assert queue.backlog() > 0
+    assert not queue.wait_idle(0.05)
+
+    second = queue.submit({'steps': 2})
+    assert first.wait(5) and second.wait(5)
+    assert first.batch_size == second.batch_size == 2
+    assert queue.wait_idle(1)
+
+
+def test_done_callbacks_run_once_job_finishes():
+    queue = make_queue(devices=['cpu'])
+    gate = threading.Event()
+    finished = []
+    job = queue.submit({'steps': 1, 'gate': gate})
+    job.add_done_callback(lambda job: finished.append(job.status))
+    assert finished == []
+    gate.set()
+    assert job.wait(5) and wait_until(lambda: finished == ['succeeded'])
+
+    # 已完成的任务立即调用
+    job.add_done_callback(lambda job: finished.append(job.worker))
+    assert finished == ['succeeded', 0]
+
+
+def test_zero_cost_jobs_do_not_jump_ahead_of_other_owners():
+    ready = threading.Event()
+
+    def start(worker):
+        ready.wait(5)
+        load_stub(worker)
+
+    # 工作线程就绪前虚拟时间不变
+    queue = make_queue(devices=['cpu'], on_start=start)
+    first = queue.submit({'steps': 1}, owner='a')
+    free = queue.submit({'steps': 0}, owner='b')
+    negative = queue.submit({'steps': -10}, owner='b')
+    ready.set()
+    assert free.tag == first.tag == 1
+    assert negative.tag == 2
+    assert all(job.wait(5) for job in (first, free, negative))
+
+
+def test_oversize_job_rejected_even_when_queue_is_empty():
+    queue = make_queue(devices=['cpu'], max_backlog=50)
+    with pytest.raises(QueueFullError) as raised:
+        queue.submit({'steps': 60})
+    assert raised.value.reason == 'backlog'
+    assert queue.submit({'steps': 40}).wait(5)
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_unexpected_thread_exit_releases_dedupe_key():
+    queue = make_queue()
+    queue.start()
+    assert wait_until(lambda: all(w['state'] == 'idle' for w in queue.workers()))
+    # SystemExit 不被处理函数的异常处理捕获，工作线程直接退出，由监控线程发现
+    crashed, _ = queue.submit_shared('same', {'steps': 1, 'error': SystemExit()})
+    assert crashed.wait(5) and crashed.status == 'failed'
+
+    retried, coalesced = queue.submit_shared('same', {'steps': 1})
+    assert not coalesced and retried is not crashed
+    assert retried.wait(5) and retried.status == 'succeeded'
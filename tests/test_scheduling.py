@@ -0,0 +1,21 @@
+"""按密钥限额：令牌桶"""
+
+import pytest
+
+from scheduling import TokenBucket
+
+
+def test_token_bucket_allows_one_oversize_take_when_full():
+    bucket = TokenBucket(per_minute=10)
+    assert bucket.take(25) == 0.0
+    assert bucket.available() < 0
+    assert bucket.take(1) > 0
+
+
+@pytest.mark.parametrize('amount', [0, -5])
+def test_token_bucket_rejects_non_positive_amounts(amount):
+    bucket = TokenBucket(per_minute=10)
+    bucket.take(10)
+    with pytest.raises(ValueError):
+        bucket.take(amount)
+    assert bucket.available() < 1
@@ -0,0 +1,104 @@
+"""
+下载版本
+按查询参数（?size=256&format=webp）按需生成输出图像的缩略图和转码版本，
+保存在单独的存储中，每个版本只生成一次，之后与原图一样直接从磁盘发送
+"""
+
+import io
+import threading
+
+from PIL import Image
+
+# 查询参数中的格式 -> (编码格式, 文件扩展名)
+VARIANT_FORMATS = {
+    'png': ('png', 'png'),
+    'webp': ('webp', 'webp'),
+    'jpeg': ('jpeg', 'jpg'),
+    'jpg': ('jpeg', 'jpg'),
+}
+
+
+def parse_sizes(spec):
+    """解析逗号分隔的尺寸列表"""
+    return tuple(sorted(int(size) for size in spec.split(',') if size.strip()))
+
+
+class VariantCache:
+    """按需生成并缓存输出图像的缩略图和转码版本"""
+
+    def __init__(self, store, sizes, encode):
+        self.store = store
+        self.sizes = tuple(sizes)
+        self.encode = encode  # encode(图像, 格式) -> 编码后的数据
+        self._lock = threading.Lock()
+        self._inflight = {}  # 版本文件名 -> 生成完成事件
+        self._stats = {'hits': 0, 'generated': 0}
+
+    def parse(self, args, filename):
+        """解析查询参数，返回 (最长边, 编码格式, 版本文件名)；与原图相同时返回 None
+
+        参数不合法时抛出 ValueError。
+        """
+        size = args.get('size')
+        output_format = args.get('format')
+        if size is None and output_format is None:
+            return None
+        stem, extension = filename.rsplit('.', 1)
+        if size is not None:
+            try:
+                size = int(size)
+            except ValueError:
+                raise ValueError('size must be an integer')
+            if size not in self.sizes:
+                raise ValueError(f"Unsupported size {size}, expected one of {', '.join(map(str, self.sizes))}")
+        if output_format is not None:
+            if output_format.lower() not in VARIANT_FORMATS:
+                raise ValueError(f"Unsupported format, expected one of {', '.join(VARIANT_FORMATS)}")
+            output_format, variant_extension = VARIANT_FORMATS[output_format.lower()]
+        else:
+            output_format, variant_extension = VARIANT_FORMATS.get(extension.lower(), ('png', 'png'))
+        if size is None and variant_extension == extension.lower():
+            return None
+        return size, output_format, f"{stem}_{size or 'full'}.{variant_extension}"
+
+    def resolve(self, variant, load):
+        """确保版本已生成，返回其文件名；原图不存在时返回 None
+
+        load() 返回原图数据。并发请求同一版本时只生成一次，其余请求等待。
+        """
+        size, output_format, name = variant
+        while True:
+            if self.store.is_pending(name) or self.store.locate(name) is not None:
+                with self._lock:
+                    self._stats['hits'] += 1
+                return name
+            with self._lock:
+                event = self._inflight.get(name)
+                owner = event is None
+                if owner:
+                    event = self._inflight[name] = threading.Event()
+            if not owner:
+                event.wait()
+                continue
+            try:
+                data = load()
+                if data is None:
+                    return None
+                image = Image.open(io.BytesIO(data))
+                if size is not None:
+                    # thumbnail 保持宽高比且不会放大
+                    image.thumbnail((size, size), Image.LANCZOS)
+                if output_format == 'jpeg' and image.mode != 'RGB':
+                    image = image.convert('RGB')
+                self.store.put(name, self.encode(image, output_format))
+                with self._lock:
+                    self._stats['generated'] += 1
+                return name
+            finally:
+                with self._lock:
+                    del self._inflight[name]
+                event.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, sizes=list(self.sizes))